@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+'''
+microbenchmarks for websocket hot paths
+
+`make benchmark` to run, failing if anything in the suite got slower, or
+allocates more, than its baseline by more than BENCHMARK_TOLERANCE (a
+fraction, default .25). `make baseline` saves this machine's results as
+the baseline, in BENCHMARK_BASELINE (default benchmark.json); timings from
+one machine mean nothing on another, so the file isn't checked in.
+'''
+# pylint: disable=multiple-imports
+import sys, os, json, timeit, tracemalloc, logging
+import wsserver
+from wsserver import unmask, package, frame_header, create_key, FrameDecoder
+from wsserver import MASKED, pack
+from keylog import encode_key, decode_key
+from sessions import Event, Sequencer
+
+SIZES = [100, 65536, 4194304]  # keystroke, pasted block, uploaded file
+MASKING_KEY = b'\x37\xfa\x21\x3d'
+BUDGET = .5  # seconds to spend timing each case
+KEY_EVENT = {'key': 'a', 'direction': 'down', 'echo': True, 'sent': 42}
+BASELINE = os.getenv('BENCHMARK_BASELINE') or 'benchmark.json'
+TOLERANCE = float(os.getenv('BENCHMARK_TOLERANCE') or .25)
+REPEAT = 5  # times each case in the suite is timed
+SLACK = 256  # bytes of allocation growth never counted as a regression
+# pylint: disable=consider-using-f-string
+
+def unmask_bytewise(payload, masking_key):
+    r'''
+    the original loop, kept here for comparison
+
+    >>> unmask_bytewise(b'\t\x07\x0f\x08\x0eNC', b'abcd')
+    bytearray(b'hello, ')
+    '''
+    payload = bytearray(payload)
+    for i in range(len(payload)):  # pylint: disable=consider-using-enumerate
+        payload[i] = payload[i] ^ masking_key[i % 4]
+    return payload
+
+def unmask_integer(payload, masking_key):
+    '''
+    unmask with the pure Python fallback, even if numpy is installed
+    '''
+    saved, wsserver.numpy = wsserver.numpy, None
+    try:
+        return unmask(payload, masking_key)
+    finally:
+        wsserver.numpy = saved
+
+def timed(function, *args, budget=BUDGET):
+    '''
+    return seconds per call of function(*args)
+
+    >>> timed(len, b'', budget=.001) < .001
+    True
+    '''
+    timer = timeit.Timer(lambda: function(*args))
+    count, elapsed = timer.autorange()
+    if elapsed < budget:
+        count = max(count, int(count * budget / elapsed))
+        elapsed = timer.timeit(count)
+    return elapsed / count
+
+def fastest(function, *args, repeat=REPEAT):
+    '''
+    seconds per call of function(*args) in the fastest of `repeat` runs,
+    slower runs only measuring whatever else the machine was doing
+
+    >>> fastest(len, b'', repeat=2) < .001
+    True
+    '''
+    timer = timeit.Timer(lambda: function(*args))
+    count = max(1, timer.autorange()[0] // 4)
+    return min(timer.repeat(repeat, count)) / count
+
+def bench_unmask(sizes=None):
+    '''
+    compare unmasking implementations at various payload sizes
+    '''
+    results = {}
+    for size in sizes or SIZES:
+        payload = os.urandom(size)
+        expected = unmask_bytewise(payload, MASKING_KEY)
+        cases = {'bytewise': unmask_bytewise, 'integer': unmask_integer}
+        if wsserver.numpy is not None:
+            cases['numpy'] = unmask
+        results[size] = {}
+        for name, function in cases.items():
+            if function(payload, MASKING_KEY) != expected:
+                raise AssertionError('%s unmask gave wrong result' % name)
+            results[size][name] = timed(function, payload, MASKING_KEY)
+    return results
+
+def report(results):
+    '''
+    print timings, with speedup relative to the bytewise loop
+    '''
+    for size, cases in results.items():
+        baseline = cases['bytewise']
+        for name, seconds in cases.items():
+            print('unmask %8d bytes %-8s %12.3f us %8.1fx' % (
+                size, name, seconds * 1e6, baseline / seconds))
+
+def key_json(payload, sequencer):
+    '''
+    what the server does with a JSON key event before fanning it out
+
+    >>> key_json(pack(KEY_EVENT), Sequencer())
+    b'\x81){"key":"a","direction":"down","serial":1}'
+    '''
+    message = json.loads(payload)
+    echo = message.pop('echo')
+    event = sequencer.stamp(Event(message, None, echo),
+                            message.pop('sent', None))
+    return package(event.json())
+
+def key_binary(payload, sequencer):
+    '''
+    the same for a binary key record, which is restamped in place
+
+    >>> len(key_binary(encode_key(KEY_EVENT), Sequencer()))
+    34
+    '''
+    record = bytearray(payload)
+    message, sent, echo = decode_key(record)
+    event = sequencer.stamp(Event(message, None, echo, record), sent)
+    return package(event.record(), 'binary')
+
+def bench_keys():
+    '''
+    per-key server CPU, and bytes on the wire each way, for both encodings
+    '''
+    results = {}
+    for name, function, payload in (
+            ('json', key_json, pack(KEY_EVENT)),
+            ('binary', key_binary, encode_key(KEY_EVENT))):
+        sequencer = Sequencer()
+        results[name] = {
+            'seconds': timed(function, payload, sequencer),
+            # client frames are masked, adding 4 bytes
+            'received': len(frame_header(len(payload))) + 4 + len(payload),
+            'sent': len(function(payload, sequencer)),
+        }
+    return results
+
+def report_keys(results):
+    '''
+    print key event timings and sizes
+    '''
+    for name, result in results.items():
+        print('key event %-8s %12.3f us %4d bytes in %4d bytes out' % (
+            name, result['seconds'] * 1e6, result['received'],
+            result['sent']))
+
+def masked(payload, opcode='text'):
+    r'''
+    payload as a client would frame it
+
+    >>> masked(b'hi')
+    b'\x81\x827\xfa!=_\x93'
+    '''
+    header = bytearray(frame_header(len(payload), opcode))
+    header[1] |= MASKED
+    return bytes(header) + MASKING_KEY + unmask(payload, MASKING_KEY)
+
+def decode(data, decoder):
+    '''
+    feed client frames to decoder, returning the messages parsed from them
+
+    >>> decode(masked(b'hi') * 2, FrameDecoder())
+    [('text', bytearray(b'hi')), ('text', bytearray(b'hi'))]
+    '''
+    decoder.feed(data)
+    return list(decoder)
+
+def suite():
+    '''
+    the primitives regressions are checked for, by name, with arguments
+    '''
+    keystroke = pack(dict(KEY_EVENT, serial=1))
+    replay = [dict(KEY_EVENT, serial=serial) for serial in range(100)]
+    typing = b''.join(masked(pack(KEY_EVENT)) for _ in range(20))
+    cases = {
+        'create_key': (create_key, b'dGhlIHNhbXBsZSBub25jZQ=='),
+        'pack key event': (pack, KEY_EVENT),
+        'pack control': (pack, {'control': 'ack', 'transfer': 1,
+                                'offset': 65536}),
+        'pack replay of 100': (pack, replay),
+        'package keystroke': (package, keystroke),
+        'decode typing burst': (decode, typing, FrameDecoder()),
+    }
+    for size in SIZES[:2]:
+        payload = os.urandom(size)
+        cases['package %d' % size] = (package, payload)
+        cases['unmask %d' % size] = (unmask, payload, MASKING_KEY)
+        cases['decode %d' % size] = (decode, masked(payload, 'binary'),
+                                     FrameDecoder())
+    return cases
+
+def allocated(function, *args):
+    '''
+    peak bytes allocated during one call of function(*args)
+
+    >>> allocated(bytes, 100000) >= 100000
+    True
+    '''
+    function(*args)  # so one-time setup isn't counted
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        function(*args)
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+def bench_suite(cases=None):
+    '''
+    operations per second and bytes allocated per call, by case name
+    '''
+    results = {}
+    for name, (function, *args) in (cases or suite()).items():
+        results[name] = {
+            'ops': 1 / fastest(function, *args),
+            'allocated': allocated(function, *args),
+        }
+    return results
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    '''
+    list of what got slower, or allocates more, than baseline allows
+
+    >>> regressions({'a': {'ops': 70, 'allocated': 1000}},
+    ...             {'a': {'ops': 100, 'allocated': 500}})
+    ['a: 70 ops/s, baseline 100', 'a: 1000 bytes, baseline 500']
+    >>> regressions({'a': {'ops': 80, 'allocated': 600}, 'b': {}},
+    ...             {'a': {'ops': 100, 'allocated': 500}})
+    []
+    '''
+    problems = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['ops'] < expected['ops'] * (1 - tolerance):
+            problems.append('%s: %d ops/s, baseline %d' % (
+                name, result['ops'], expected['ops']))
+        if result['allocated'] > max(expected['allocated'] * (
+                1 + tolerance), expected['allocated'] + SLACK):
+            problems.append('%s: %d bytes, baseline %d' % (
+                name, result['allocated'], expected['allocated']))
+    return problems
+
+def report_suite(results, baseline):
+    '''
+    print suite results, with change in speed from baseline where known
+    '''
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            change = '%+6.1f%%' % (
+                (result['ops'] / baseline[name]['ops'] - 1) * 100)
+        print('%-24s %14.0f ops/s %10d bytes %s' % (
+            name, result['ops'], result['allocated'], change))
+
+def main(args):
+    '''
+    run everything, comparing the suite with (or saving it as) baseline
+
+    returns exit status, nonzero if there were regressions
+    '''
+    report(bench_unmask([int(size) for size in args if size.isdigit()]))
+    report_keys(bench_keys())
+    results = bench_suite()
+    if '--baseline' in args:
+        with open(BASELINE, 'w', encoding='utf-8') as outfile:
+            json.dump(results, outfile, indent=2)
+            outfile.write('\n')
+        report_suite(results, {})
+        return 0
+    try:
+        with open(BASELINE, encoding='utf-8') as infile:
+            baseline = json.load(infile)
+    except FileNotFoundError:
+        logging.warning('no %s: `make baseline` to save one', BASELINE)
+        baseline = {}
+    report_suite(results, baseline)
+    problems = regressions(results, baseline)
+    for problem in problems:
+        logging.error('regression: %s', problem)
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
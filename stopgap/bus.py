@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+'''
+messages between the hub process and the workers it forks
+
+each message is a JSON object, optionally followed by a body of raw bytes
+(an uploaded document, say), preceded by the sizes of both, over a
+Unix-domain socket. a stream socket keeps them in order, which is the
+whole point: every worker sees the hub's key events in the same order.
+
+a message can also carry open file descriptors (SCM_RIGHTS), which is how
+a supervisor hands live connections from one server process to the next
+'''
+import json, struct, socket, logging  # pylint: disable=multiple-imports
+from threading import Lock
+
+HEADER = struct.Struct('>II')  # sizes of JSON and of body
+BUFFERSIZE = 65536
+MAXFDS = 253  # per message, Linux's SCM_MAX_FD
+# pylint: disable=consider-using-f-string
+
+class Bus:
+    r'''
+    one end of the connection between hub and a worker
+
+    >>> import socket
+    >>> hub, worker = (Bus(end, 0) for end in socket.socketpair())
+    >>> worker.post({'key': {'key': 'a'}})
+    >>> worker.post({'load': 'a.txt'}, b'abc')
+    >>> list(hub.receive())
+    [({'key': {'key': 'a'}}, b''), ({'load': 'a.txt'}, b'abc')]
+    >>> worker.connection.close()
+    >>> list(hub.receive())
+    Traceback (most recent call last):
+        ...
+    EOFError: worker 0 bus closed
+    >>> hub, worker = (Bus(end, 0) for end in socket.socketpair())
+    >>> with open(__file__, 'rb') as infile:
+    ...     worker.post({'file': 'bus.py'}, fds=[infile.fileno()])
+    >>> [(fields, body)] = hub.receive()
+    >>> with open(fields['fds'][0], 'rb') as infile:
+    ...     infile.readline()
+    b'#!/usr/bin/python3\n'
+    '''
+    def __init__(self, connection, worker, pid=None):
+        self.connection = connection
+        self.worker = worker  # number, from 0
+        self.pid = pid  # of the worker, as seen from the hub
+        self.lock = Lock()  # handler threads share the worker's end
+        self.received = bytearray()
+        self.fds = []  # received, not yet claimed by a message
+
+    def __repr__(self):
+        return '<Bus to worker %d>' % self.worker
+
+    def fileno(self):
+        '''
+        allow Bus to be registered with a selector
+        '''
+        return self.connection.fileno()
+
+    def post(self, fields, body=b'', fds=()):
+        '''
+        send message, as dict, with optional body and file descriptors
+
+        the receiver finds the descriptors, duplicated for it, as a list
+        in the message's `fds`. the sender still has to close its own.
+        '''
+        if len(fds) > MAXFDS:
+            raise ValueError('%d descriptors, at most %d allowed' % (
+                len(fds), MAXFDS))
+        if fds:
+            fields = dict(fields, fds=len(fds))
+        packed = json.dumps(fields, separators=(',', ':')).encode()
+        message = HEADER.pack(len(packed), len(body)) + packed + body
+        with self.lock:
+            if fds:  # they go along with the first byte sent
+                sent = socket.send_fds(self.connection, [message], fds)
+                message = message[sent:]
+            self.connection.sendall(message)
+
+    def receive(self):
+        '''
+        read what's available, yielding (fields, body) of each message
+
+        raises EOFError when the other end has gone
+        '''
+        data, fds = socket.recv_fds(self.connection, BUFFERSIZE, MAXFDS)[:2]
+        self.fds.extend(fds)
+        if not data:
+            raise EOFError('worker %d bus closed' % self.worker)
+        self.received += data
+        while len(self.received) >= HEADER.size:
+            size, length = HEADER.unpack_from(self.received)
+            end = HEADER.size + size + length
+            if len(self.received) < end:
+                break
+            fields = json.loads(self.received[HEADER.size:HEADER.size + size])
+            body = bytes(self.received[HEADER.size + size:end])
+            del self.received[:end]
+            if 'fds' in fields:
+                count, fields['fds'] = fields['fds'], []
+                while len(fields['fds']) < count:
+                    fields['fds'].append(self.fds.pop(0))
+            logging.debug('%s: %s and %d bytes', self, fields, len(body))
+            yield fields, body
+
+    def close(self):
+        '''
+        close this end
+        '''
+        self.connection.close()
+
+class Links:  # pylint: disable=too-few-public-methods
+    '''
+    the buses this process has, and the socket it inherited, if any
+
+    set as the process finds out what it is: a worker forked by the hub,
+    or the child of a supervisor
+    '''
+    hub = None  # worker's Bus to the hub, in forked workers only
+    supervisor = None  # child's Bus to its supervisor
+    listener = None  # listening socket the child inherited from it
+
+LINKS = Links()
@@ -0,0 +1,3 @@
+// generated by chords.py from its layouts: edit those, not this
+const CHORDS = {"version": "82bb2c0302bbd726", "layouts": {"gkos": ["", "a", "b", "o", "c", "th", "s", "Backspace", "d", "Up", "'", "p", "!", "that ", "t", "Left", "e", "-", "SHIFT", "q", ",", "the ", "u", "HOME", "g", "h", "i", "PgUp", "j", "to ", "/", "Escape", "f", "?", ".", "r", "Down", "of ", "v", "Home", "w", "x", "y", "Ins", "z", "SYMB", "with ", "Ctrl", "k", "l", "m", "\\", "n", "and ", "PgDn", "Alt", " ", "Right", "END", "Enter", "End", "\t", "Delete", "ABC123", "", "A", "B", "O", "C", "Th", "S", "Backspace", "D", "Up", "\"", "P", "|", "That ", "T", "Left", "E", "_", "SHIFT", "Q", ";", "The ", "U", "HOME", "G", "H", "I", "PgUp", "J", "To ", "́", "Escape", "F", "~", ":", "R", "Down", "Of ", "V", "Home", "W", "X", "Y", "Ins", "Z", "SYMB", "With ", "Ctrl", "K", "L", "M", "̀", "N", "And ", "PgDn", "Alt", " ", "Right", "END", "Enter", "End", "\t", "Delete", "ABC123", "", "1", "2", "+", "3", ")", "*", "Backspace", "4", "Up", "'", "%", "!", "]", "$", "Left", "5", "-", "SHIFT", "=", ",", ">", "€", "HOME", "0", "7", "8", "PgUp", "9", "", "/", "Escape", "6", "?", ".", "^", "Down", "}", "£", "Home", "(", "[", "<", "Ins", "{", "SYMB", "§", "Ctrl", "#", "@", "½", "\\", "&", "μ", "PgDn", "Alt", " ", "Right", "END", "Enter", "End", "\t", "Delete", "ABC123", "", "1", "2", "+", "3", ")", "*", "Backspace", "4", "Up", "\"", "%", "|", "]", "$", "Left", "5", "_", "SHIFT", "=", ";", ">", "€", "HOME", "0", "7", "8", "PgUp", "9", "̌", "́", "Escape", "6", "~", ":", "^", "Down", "}", "£", "Home", "(", "[", "<", "°", "{", "SYMB", "§", "Ctrl", "#", "@", "½", "̀", "&", "μ", "PgDn", "Alt", " ", "Right", "END", "Enter", "End", "\t", "Delete", "ABC123"]}};
+// vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+'''
+GKOS chord layouts, compiled to flat lookup tables
+
+a layout names, for each chord of the six softkeys, what it types in
+plain, shifted, numbers and SYMBols mode. compiled, it is a list of 256
+strings indexed by the chord's key bits ORed with the mode's offset, the
+same table the server's document and every editor look chords up in.
+
+run as a script, writes `chords.js`, which stopgap.html loads before
+stopgap.js; the Makefile rebuilds it whenever this file changes
+
+    python3 chords.py > chords.js
+'''
+import sys, json  # pylint: disable=multiple-imports
+from hashlib import sha1
+
+# the GKOS standard for English: keys pressed, and what they type in
+# plain, shifted, numbers, and SYMBols mode respectively. END (cf. 'End')
+# is for what looks like a "Play" button in the GKOS test page, and HOME
+# for its reverse; neither does anything there, so their intended purposes
+# are unclear
+GKOS = {
+    '': ('', '', '', ''),
+    'A': ('a', 'A', '1', '1'),
+    'B': ('b', 'B', '2', '2'),
+    'AB': ('o', 'O', '+', '+'),
+    'C': ('c', 'C', '3', '3'),
+    'AC': ('th', 'Th', ')', ')'),
+    'BC': ('s', 'S', '*', '*'),
+    'ABC': ('Backspace', 'Backspace', 'Backspace', 'Backspace'),
+    'D': ('d', 'D', '4', '4'),
+    'AD': ('Up', 'Up', 'Up', 'Up'),
+    'BD': ("'", '"', "'", '"'),
+    'ABD': ('p', 'P', '%', '%'),
+    'CD': ('!', '|', '!', '|'),
+    'ACD': ('that ', 'That ', ']', ']'),
+    'BCD': ('t', 'T', '$', '$'),
+    'ABCD': ('Left', 'Left', 'Left', 'Left'),
+    'E': ('e', 'E', '5', '5'),
+    'AE': ('-', '_', '-', '_'),
+    'BE': ('SHIFT', 'SHIFT', 'SHIFT', 'SHIFT'),
+    'ABE': ('q', 'Q', '=', '='),
+    'CE': (',', ';', ',', ';'),
+    'ACE': ('the ', 'The ', '>', '>'),
+    'BCE': ('u', 'U', '€', '€'),
+    'ABCE': ('HOME', 'HOME', 'HOME', 'HOME'),
+    'DE': ('g', 'G', '0', '0'),
+    'ADE': ('h', 'H', '7', '7'),
+    'BDE': ('i', 'I', '8', '8'),
+    'ABDE': ('PgUp', 'PgUp', 'PgUp', 'PgUp'),
+    'CDE': ('j', 'J', '9', '9'),
+    'ACDE': ('to ', 'To ', '', '\u030c'),
+    'BCDE': ('/', '\u0301', '/', '\u0301'),
+    'ABCDE': ('Escape', 'Escape', 'Escape', 'Escape'),
+    'F': ('f', 'F', '6', '6'),
+    'AF': ('?', '~', '?', '~'),
+    'BF': ('.', ':', '.', ':'),
+    'ABF': ('r', 'R', '^', '^'),
+    'CF': ('Down', 'Down', 'Down', 'Down'),
+    'ACF': ('of ', 'Of ', '}', '}'),
+    'BCF': ('v', 'V', '£', '£'),
+    'ABCF': ('Home', 'Home', 'Home', 'Home'),
+    'DF': ('w', 'W', '(', '('),
+    'ADF': ('x', 'X', '[', '['),
+    'BDF': ('y', 'Y', '<', '<'),
+    'ABDF': ('Ins', 'Ins', 'Ins', '°'),
+    'CDF': ('z', 'Z', '{', '{'),
+    'ACDF': ('SYMB', 'SYMB', 'SYMB', 'SYMB'),
+    'BCDF': ('with ', 'With ', '§', '§'),
+    'ABCDF': ('Ctrl', 'Ctrl', 'Ctrl', 'Ctrl'),
+    'EF': ('k', 'K', '#', '#'),
+    'AEF': ('l', 'L', '@', '@'),
+    'BEF': ('m', 'M', '½', '½'),
+    'ABEF': ('\\', '\u0300', '\\', '\u0300'),
+    'CEF': ('n', 'N', '&', '&'),
+    'ACEF': ('and ', 'And ', 'μ', 'μ'),
+    'BCEF': ('PgDn', 'PgDn', 'PgDn', 'PgDn'),
+    'ABCEF': ('Alt', 'Alt', 'Alt', 'Alt'),
+    'DEF': (' ', ' ', ' ', ' '),
+    'ADEF': ('Right', 'Right', 'Right', 'Right'),
+    'BDEF': ('END', 'END', 'END', 'END'),
+    'ABDEF': ('Enter', 'Enter', 'Enter', 'Enter'),
+    'CDEF': ('End', 'End', 'End', 'End'),
+    'ACDEF': ('\t', '\t', '\t', '\t'),
+    'BCDEF': ('Delete', 'Delete', 'Delete', 'Delete'),
+    'ABCDEF': ('ABC123', 'ABC123', 'ABC123', 'ABC123'),
+}
+LAYOUTS = {'gkos': GKOS}  # by name, as found in chords.js
+# softkey values, and chord offsets for shifted, numbers and SYMBols mode
+CHORD_KEYS = {key: 1 << n for n, key in enumerate('abcdef')}
+X, Y, Z = 0x40, 0x80, 0xc0
+TABLE_SIZE = 256
+SCRIPT = '''\
+// generated by chords.py from its layouts: edit those, not this
+const CHORDS = %s;
+// vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+# pylint: disable=consider-using-f-string
+
+def value(softkeys):
+    '''
+    bits of a chord, from the softkeys in it
+
+    >>> value('de'), value('ABCDEF')
+    (24, 63)
+    '''
+    return sum(CHORD_KEYS.get(key, 0) for key in set(softkeys.lower()))
+
+def keys(bits):
+    '''
+    softkeys in a chord, from its bits
+
+    >>> keys(24), keys(0)
+    ('de', '')
+    '''
+    return ''.join(key for key, bit in CHORD_KEYS.items() if bits & bit)
+
+def compiled(layout):
+    '''
+    lookup table for a layout: what chord bits ORed with a mode's offset
+    type, '' for chords it leaves out
+
+    >>> table = compiled(GKOS)
+    >>> len(table), table[value('de')], table[value('de') | X]
+    (256, 'g', 'G')
+    >>> table[value('a') | Y], table[value('acdf') | Z]
+    ('1', 'SYMB')
+    '''
+    table = [''] * TABLE_SIZE
+    for chord, characters in layout.items():
+        for offset, character in zip((0, X, Y, Z), characters):
+            table[value(chord) | offset] = character
+    return table
+
+def tables(layouts=None):
+    '''
+    all layouts compiled, with a version that changes when any of them does
+
+    >>> sorted(tables())
+    ['layouts', 'version']
+    '''
+    compiled_layouts = {name: compiled(layout)
+                        for name, layout in (layouts or LAYOUTS).items()}
+    version = sha1(json.dumps(compiled_layouts, sort_keys=True).encode())
+    return {'version': version.hexdigest()[:16], 'layouts': compiled_layouts}
+
+def script(layouts=None):
+    '''
+    chords.js, defining the compiled layouts as `CHORDS` for stopgap.js
+    '''
+    return SCRIPT % json.dumps(tables(layouts), ensure_ascii=False)
+
+class Chord:  # pylint: disable=too-few-public-methods
+    '''
+    softkeys one editor has pressed, when the server resolves chords
+
+    the chord is complete when the first of its keys is let go, as in
+    stopgap.js; `sent` is the latest count, from the editor, of key
+    events added to it, so that those resent on reconnection are ignored
+
+    >>> chord = Chord()
+    >>> [chord.add(key, direction, sent) for sent, (key, direction)
+    ...  in enumerate([('d', 'down'), ('e', 'down'), ('d', 'up'),
+    ...                ('e', 'up')], 1)]
+    [None, None, 'de', None]
+    >>> chord.add('d', 'down', 2), chord.bits
+    (None, 0)
+    '''
+    __slots__ = ('bits', 'ready', 'sent')
+
+    def __init__(self):
+        self.bits = 0
+        self.ready = False  # a key was pressed since the last chord
+        self.sent = 0
+
+    def add(self, key, direction, sent=None):
+        '''
+        add one softkey event to the chord, returning its keys once it is
+        complete, otherwise None
+        '''
+        if sent is not None:
+            if sent <= self.sent:
+                return None
+            self.sent = sent
+        if direction == 'down':
+            self.bits |= CHORD_KEYS.get(key, 0)
+            self.ready = True
+            return None
+        if not self.ready:
+            return None
+        chord = keys(self.bits)
+        self.bits, self.ready = 0, False
+        return chord
+
+if __name__ == '__main__':
+    sys.stdout.write(script())
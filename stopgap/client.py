@@ -0,0 +1,456 @@
+#!/usr/bin/python3
+'''
+connections to the server, and what is queued to go out on them
+
+a Client is an HTTP connection at first, and usually a websocket after.
+what it is sent is queued, and sent as far as its socket will take it
+without blocking; the rest goes once the socket is writable again, which
+the event loop's selector, or the threaded engine's writer thread, finds
+out. a client that falls too far behind is dealt with as OVERFLOW says.
+'''
+# pylint: disable=multiple-imports
+import os, time, socket, logging, selectors
+from collections import deque
+from bisect import bisect_left
+from threading import Thread, Lock
+from wsserver import package, pack, FrameDecoder
+from metrics import Counter, Histogram, Gauge, LATENCY_BUCKETS, number
+
+BUFFERSIZE = 65536  # bytes per recv()
+# a connection that would make more than MAX_CONNECTIONS in all, websockets
+# included, gets a quick `503 Service Unavailable`; one that sends nothing
+# for HTTP_TIMEOUT seconds while its request is being read is dropped.
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS') or 256)
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT') or 10)  # seconds
+UNAVAILABLE = (b'HTTP/1.1 503 Service Unavailable\r\n'
+               b'Retry-After: 1\r\nContent-Length: 0\r\n'
+               b'Connection: close\r\n\r\n')
+# what to do when a client's outbound queue is full:
+# `coalesce` merges queued key events into one frame,
+# `drop-oldest` discards the oldest key events, `disconnect` hangs up.
+# each falls back to `disconnect` if it doesn't relieve the overflow.
+OVERFLOW = os.getenv('OVERFLOW') or 'coalesce'
+QUEUE_LENGTH = 64  # frames
+QUEUE_BYTES = 8388608  # bytes, allowing for a large message or two
+DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)  # non-blocking send()
+# every websocket gets a ping each HEARTBEAT_INTERVAL seconds, and one that
+# doesn't answer HEARTBEAT_MISSES of them within HEARTBEAT_TIMEOUT is closed
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL') or 5)
+HEARTBEAT_TIMEOUT = float(os.getenv('HEARTBEAT_TIMEOUT') or 10)
+HEARTBEAT_MISSES = int(os.getenv('HEARTBEAT_MISSES') or 3)
+HEARTBEAT_TICK = min(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT) / 4  # seconds
+CONNECTIONS = set()  # all websockets, editors or not
+FRAMES_SENT = Counter('stopgap_frames_sent_total', 'frames sent')
+BYTES_SENT = Counter('stopgap_bytes_sent_total', 'bytes sent')
+REFUSED = Counter('stopgap_refused_total',
+                  'connections turned away with 503, server being saturated')
+RTT_SECONDS = Histogram('stopgap_rtt_seconds',
+                        'round trip time from ping to pong, all clients')
+Gauge('stopgap_client_rtt_seconds', 'latest round trip time, by client',
+      function=lambda: {client.label(): client.rtt
+                        for client in list(CONNECTIONS)
+                        if client.rtt is not None}, label='client')
+Gauge('stopgap_client_rtt_bucket', 'round trips no longer than le, by client',
+      function=lambda: {
+          (client.label(), number(bucket)): count
+          for client in list(CONNECTIONS)
+          for bucket, count in client.round_trips()
+      }, label=('client', 'le'))
+# pylint: disable=consider-using-f-string
+
+class Client:
+    '''
+    state of one connection: HTTP at first, and then (usually) websocket
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, connection, address=None):
+        self.connection = connection
+        self.address = address
+        self.websocket = False
+        self.origin = None  # page identifier sent by editor on connection
+        self.session = None  # Session, once upgraded to websocket
+        self.received = bytearray()  # HTTP request data
+        self.spool = None  # request still arriving, too big to hold in memory
+        self.pending = 0  # bytes yet to be spooled
+        self.decoder = FrameDecoder()  # websocket frames
+        self.deflate = None  # permessage-deflate state, if negotiated
+        self.binary = False  # key events as records rather than JSON
+        self.queue = deque()  # (frame, messages) waiting to be sent
+        self.queued = 0  # bytes in queue
+        self.offset = 0  # bytes of first frame in queue already sent
+        self.lock = Lock()  # handler threads and writer share the queue
+        self.transfer = None  # document being sent in chunks
+        self.transferred = 0  # bytes of it queued so far
+        self.acknowledged = 0  # bytes of it the editor has received
+        self.writing = False  # waiting for socket to become writable
+        self.closed = False
+        self.active = time.monotonic()  # when HTTP request data last arrived
+        self.pings = deque()  # (payload, time sent) of pings not yet answered
+        self.pinged = 0  # pings sent, which is also the payload of the last
+        self.pinged_at = 0  # when last ping was sent
+        self.missed = 0  # pings in a row that went unanswered
+        self.rtt = None  # seconds for latest ping to be answered
+        self.rtts = [0] * (len(LATENCY_BUCKETS) + 1)  # histogram of them
+
+    def __repr__(self):
+        return '<Client %s>' % (self.address or self.connection,)
+
+    def fileno(self):
+        '''
+        allow Client to be registered with a selector
+        '''
+        return self.connection.fileno()
+
+    def label(self):
+        '''
+        short name for metrics
+        '''
+        if self.address:
+            return '%s:%s' % self.address[:2]
+        return str(self.connection.fileno())
+
+    def send(self, frame, messages=None):
+        '''
+        queue frame for client, and send as much as possible without blocking
+
+        `messages` is the list of key Events packaged in the frame,
+        if any, so that they can be coalesced on overflow
+        '''
+        with self.lock:
+            self.enqueue(frame, messages)
+        self.flush()
+
+    def send_message(self, *pieces, opcode='text', messages=None):
+        '''
+        package message, given in pieces, for this client alone and send it
+
+        compressed if permessage-deflate was negotiated and the message is
+        big enough. each compressed frame depends on the ones before it,
+        so it is compressed with the lock held, in queue order, and is
+        never dropped or coalesced on overflow.
+        '''
+        length = sum(len(piece) for piece in pieces)
+        with self.lock:
+            if self.deflate is not None and self.deflate.wanted(
+                    length, opcode):
+                self.enqueue(self.deflate.package(*pieces, opcode=opcode))
+            else:
+                self.enqueue(package(b''.join(pieces), opcode), messages)
+        self.flush()
+
+    def enqueue(self, frame, messages=None):
+        '''
+        add frame to queue, applying OVERFLOW policy if it's now too long
+
+        must be called with lock held
+        '''
+        if self.closed:
+            return
+        self.queue.append((frame, messages))
+        self.queued += len(frame)
+        if self.websocket and (
+                len(self.queue) > QUEUE_LENGTH or self.queued > QUEUE_BYTES):
+            self.overflow()
+
+    def upgrade(self, session, deflate=None, binary=False):
+        '''
+        become a websocket editing session, with permessage-deflate if it
+        was negotiated during the upgrade
+        '''
+        self.websocket = True
+        self.session, self.binary = session, binary
+        if deflate is not None:
+            self.deflate = deflate
+            self.decoder.deflate = deflate
+        CONNECTIONS.add(self)
+
+    def overflow(self):
+        '''
+        apply OVERFLOW policy to a client that isn't keeping up
+
+        must be called with lock held
+        '''
+        logging.warning('%s has %d frames, %d bytes queued, applying %s',
+                        self, len(self.queue), self.queued, OVERFLOW)
+        keep = 1 if self.offset else 0  # never touch partially sent frame
+        if OVERFLOW == 'drop-oldest':
+            # only key events can be spared, not control messages or chunks
+            queue, count = deque(), len(self.queue)
+            for index, (frame, messages) in enumerate(self.queue):
+                if messages is not None and keep <= index < count - 1 and (
+                        len(self.queue) - index + len(queue) > QUEUE_LENGTH or
+                        self.queued > QUEUE_BYTES):
+                    self.queued -= len(frame)
+                else:
+                    queue.append((frame, messages))
+            self.queue = queue
+        elif OVERFLOW == 'coalesce':
+            # merge each run of key event frames in place, so that nothing
+            # overtakes a control message or chunk queued between runs
+            queue = deque(self.queue.popleft() for _ in range(keep))
+            batch, size = [], 0
+            for frame, events in [*self.queue, (None, None)]:
+                for event in events or ():
+                    length = len(event.json()) + 1
+                    if batch and size + length > QUEUE_BYTES // QUEUE_LENGTH:
+                        queue.append((package(*batched(batch, self.binary)),
+                                      batch))
+                        batch, size = [], 0
+                    batch.append(event)
+                    size += length
+                if events is None:  # end of run, or of queue
+                    if batch:
+                        queue.append((package(*batched(batch, self.binary)),
+                                      batch))
+                    batch, size = [], 0
+                    if frame is not None:
+                        queue.append((frame, None))
+            self.queue = queue
+            self.queued = sum(len(frame) for frame, _ in self.queue)
+        if len(self.queue) > QUEUE_LENGTH or self.queued > QUEUE_BYTES:
+            self.disconnect('outbound queue overflow')
+
+    def pong(self, payload):
+        '''
+        record round trip time of ping that `payload` answers
+
+        an endpoint may answer only the latest of several pings, so any
+        sent before it are forgotten too
+        '''
+        now = time.monotonic()
+        with self.lock:
+            if not any(payload == pinged for pinged, _ in self.pings):
+                logging.warning('pong %s from %s unsolicited or too late',
+                                payload, self)
+                return
+            while self.pings:
+                pinged, sent = self.pings.popleft()
+                if pinged == payload:
+                    break
+            self.missed = 0
+            self.rtt = now - sent
+            self.rtts[bisect_left(LATENCY_BUCKETS, self.rtt)] += 1
+        RTT_SECONDS.observe(self.rtt)
+
+    def round_trips(self):
+        '''
+        cumulative histogram of round trip times, as (bucket, count) pairs
+        '''
+        count, counts = 0, []
+        for bucket, observed in zip(LATENCY_BUCKETS + ('+Inf',), self.rtts):
+            count += observed
+            counts.append((bucket, count))
+        return counts
+
+    def disconnect(self, reason):
+        '''
+        give up on client; its reader will notice and clean up
+        '''
+        logging.warning('disconnecting %s: %s', self, reason)
+        self.closed = True
+        self.queue.clear()
+        self.queued = self.offset = 0
+        if self.session is not None:
+            self.session.clients.discard(self)
+        CONNECTIONS.discard(self)
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def flush(self):
+        '''
+        send as much of the queue as the socket will take without blocking
+        '''
+        with self.lock:
+            try:
+                while self.queue:
+                    frame = self.queue[0][0]
+                    if isinstance(frame, Gather):
+                        sent = frame.send(self.connection, self.offset)
+                    else:
+                        sent = self.connection.send(
+                            memoryview(frame)[self.offset:], DONTWAIT)
+                    BYTES_SENT.add(sent)
+                    self.offset += sent
+                    if self.offset < len(frame):
+                        break
+                    FRAMES_SENT.add()
+                    self.queue.popleft()
+                    self.queued -= len(frame)
+                    self.offset = 0
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as broken:
+                self.disconnect('failed send: %s' % broken)
+            self.wait(bool(self.queue) and not self.closed)
+
+    def wait(self, pending):
+        '''
+        have the rest of the queue sent when the socket becomes writable
+
+        must be called with lock held
+        '''
+        if pending == self.writing:
+            return
+        self.writing = pending
+        if WRITER.selector is not None:
+            if not self.closed:
+                WRITER.selector.modify(self, selectors.EVENT_READ | (
+                    selectors.EVENT_WRITE if pending else 0), self)
+        elif pending and WRITER.wakeup is not None:
+            WRITER.pending.append(self)
+            WRITER.wakeup.send(b'\0')
+
+class Gather:
+    '''
+    frame in several pieces, to be sent without first copying them together
+    '''
+    def __init__(self, *pieces):
+        self.pieces = [memoryview(piece) for piece in pieces]
+        self.length = sum(piece.nbytes for piece in self.pieces)
+
+    def __len__(self):
+        return self.length
+
+    def send(self, connection, offset=0):
+        '''
+        send what the socket will take of the frame after `offset` bytes
+        '''
+        pieces = []
+        for piece in self.pieces:
+            if offset < piece.nbytes:
+                pieces.append(piece[offset:])
+            offset = max(offset - piece.nbytes, 0)
+        return connection.sendmsg(pieces, (), DONTWAIT)
+
+def refuse(connection, address):
+    '''
+    send a quick `503 Service Unavailable`, without waiting for the
+    request or for the send to complete, leaving caller to close
+    '''
+    REFUSED.add()
+    logging.warning('server saturated, refusing %s', address)
+    try:  # read what's arrived of the request, so close() doesn't reset
+        connection.recv(BUFFERSIZE, DONTWAIT)
+    except OSError:
+        pass
+    try:
+        connection.send(UNAVAILABLE, DONTWAIT)
+    except OSError:
+        pass
+
+def control(name, **fields):
+    '''
+    package a message for the editor itself, rather than a key event
+
+    >>> control('snapshot', serial=0)
+    b'\\x81!{"control":"snapshot","serial":0}'
+    '''
+    return package(pack({'control': name, **fields}))
+
+def batched(events, binary=False):
+    '''
+    (payload, opcode) for several key events in one frame
+
+    records are simply concatenated; otherwise, or if any event won't fit
+    in a record, it's a JSON array
+
+    >>> from sessions import Event
+    >>> batched([Event({'key': 'a', 'serial': 1})] * 2)
+    (b'[{"key":"a","serial":1},{"key":"a","serial":1}]', 'text')
+    >>> len(batched([Event({'key': 'a', 'serial': 1})] * 2, True)[0])
+    64
+    '''
+    records = [event.record() for event in events] if binary else [None]
+    if None not in records:
+        return b''.join(records), 'binary'
+    return b'[' + b','.join(event.json() for event in events) + b']', 'text'
+
+def ping(client):
+    '''
+    send ping packet, remembering when
+    '''
+    with client.lock:
+        client.pinged += 1
+        client.pinged_at = time.monotonic()
+        payload = str(client.pinged).encode()
+        client.pings.append((payload, client.pinged_at))
+    client.send(package(payload, 'ping'))
+
+def heartbeat():
+    '''
+    ping websockets that are due, and close those that stopped answering
+
+    called every HEARTBEAT_TICK seconds, from a thread of its own or the
+    event loop
+    '''
+    now = time.monotonic()
+    for client in list(CONNECTIONS):
+        with client.lock:
+            while client.pings and (
+                    now - client.pings[0][1] > HEARTBEAT_TIMEOUT):
+                client.pings.popleft()
+                client.missed += 1
+            if client.missed >= HEARTBEAT_MISSES:
+                client.disconnect('%d pings unanswered' % client.missed)
+                continue
+            due = now - client.pinged_at >= HEARTBEAT_INTERVAL
+        if due:
+            ping(client)
+
+class Writer:
+    '''
+    where clients slow to receive wait for their sockets to be writable
+
+    in the event loop, that is its selector, watching for EVENT_WRITE; in
+    the threaded engine, a thread of its own, which the handler threads
+    wake up with clients to watch
+    '''
+    def __init__(self):
+        self.selector = None  # event loop's, once it is running
+        self.wakeup = None  # writer thread's, once it is started
+        self.pending = deque()  # clients for the writer thread to watch
+
+    def start(self):
+        '''
+        start the threaded engine's writer thread
+        '''
+        self.wakeup, wakeup = socket.socketpair()
+        Thread(target=self.run, args=(wakeup,), daemon=True).start()
+
+    def run(self, wakeup):
+        '''
+        finish sending outbound queues the handler threads could not
+        '''
+        selector = selectors.DefaultSelector()
+        selector.register(wakeup, selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is wakeup:
+                    wakeup.recv(BUFFERSIZE)
+                    self.watch(selector)
+                    continue
+                client = key.data
+                if client.fileno() != -1:
+                    client.flush()
+                if not client.writing or client.fileno() == -1:
+                    selector.unregister(client)
+
+    def watch(self, selector):
+        '''
+        register pending clients with the writer thread's selector, in
+        place of any closed socket whose descriptor was reused
+        '''
+        while self.pending:
+            client = self.pending.popleft()
+            if client.fileno() == -1:
+                continue
+            stale = selector.get_map().get(client.fileno())
+            if stale is not None:
+                if stale.data is client:
+                    continue
+                selector.unregister(stale.fileobj)
+            selector.register(client, selectors.EVENT_WRITE, client)
+
+WRITER = Writer()
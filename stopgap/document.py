@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+'''
+server's copy of the text being edited
+
+kept in a rope (a treap of text chunks, ordered by position) so that
+inserting or deleting anywhere in a large file takes O(log n) time. each
+node also counts the newlines under it, so the rope doubles as an index
+of where lines start, kept current by every edit
+'''
+import random, logging  # pylint: disable=multiple-imports
+from chords import GKOS, CHORD_KEYS, Z, compiled, value
+
+CHUNK = 2048  # characters per node; splicing short strings beats new nodes
+# chords resolved as in stopgap.js, by the table it gets from chords.js
+MAPPING = compiled(GKOS)
+MODIFIER_KEYS = ['Shift', 'Ctrl', 'Alt', 'Meta', 'AltGr', 'Win', 'Cmd']
+LEFT_ALT, LEFT_CTRL = 0x01, 0x02  # modifier bits the editor can set
+# pylint: disable=consider-using-f-string
+
+class Node:  # pylint: disable=too-few-public-methods
+    '''
+    chunk of text, and the subtree of chunks before and after it
+    '''
+    __slots__ = ('text', 'size', 'newlines', 'priority', 'left', 'right')
+
+    def __init__(self, text):
+        self.text = text
+        self.size = len(text)  # characters in whole subtree
+        self.newlines = text.count('\n')  # likewise
+        self.priority = random.random()
+        self.left = self.right = None
+
+def size(node):
+    '''
+    number of characters in subtree
+    '''
+    return node.size if node is not None else 0
+
+def newlines(node):
+    '''
+    number of newlines in subtree
+    '''
+    return node.newlines if node is not None else 0
+
+def update(node):
+    '''
+    recalculate size of node after its children change
+    '''
+    node.size = len(node.text) + size(node.left) + size(node.right)
+    node.newlines = node.text.count('\n') + newlines(node.left) + (
+        newlines(node.right))
+    return node
+
+def merge(left, right):
+    '''
+    join two trees, all of `left` coming before all of `right`
+    '''
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        return update(left)
+    right.left = merge(left, right.left)
+    return update(right)
+
+def split(node, offset):
+    '''
+    divide tree into the first `offset` characters and the rest
+    '''
+    if node is None:
+        return None, None
+    before = size(node.left)
+    if offset <= before:
+        left, node.left = split(node.left, offset)
+        return left, update(node)
+    offset -= before
+    if offset >= len(node.text):
+        node.right, right = split(node.right, offset - len(node.text))
+        return update(node), right
+    right = merge(Node(node.text[offset:]), node.right)
+    node.text, node.right = node.text[:offset], None
+    return update(node), right
+
+class Rope:
+    '''
+    text supporting fast insertion and deletion at any offset
+
+    >>> rope = Rope('hello world')
+    >>> rope.insert(5, ',')
+    >>> rope.delete(0)
+    >>> rope.insert(0, 'J')
+    >>> str(rope), len(rope)
+    ('Jello, world', 12)
+    >>> rope = Rope('x' * 10000)
+    >>> rope.insert(5000, 'abc')
+    >>> rope.delete(9000, 2000)
+    >>> text = str(rope)
+    >>> len(text), len(rope), text[4999:5004]
+    (9000, 9000, 'xabcx')
+    >>> rope = Rope('one\\ntwo\\n' * 1000)
+    >>> rope.insert(4, 'and a half\\n')
+    >>> rope.delete(8000, 12)
+    >>> rope.lines(), rope.line_start(2), rope.line_of(15), rope.slice(
+    ...     rope.line_start(1), rope.line_start(3))
+    (1999, 15, 2, 'and a half\\ntwo\\n')
+    '''
+    def __init__(self, text=''):
+        '''
+        build a treap of CHUNK-sized nodes in one pass
+        '''
+        self.root = None
+        spine = []  # nodes on the right edge of the tree built so far
+        for offset in range(0, len(text), CHUNK):
+            node, last = Node(text[offset:offset + CHUNK]), None
+            while spine and spine[-1].priority < node.priority:
+                last = update(spine.pop())
+            node.left = last
+            if spine:
+                spine[-1].right = node
+            spine.append(node)
+        while spine:
+            self.root = update(spine.pop())
+
+    def __len__(self):
+        return size(self.root)
+
+    def __str__(self):
+        chunks, stack, node = [], [], self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            chunks.append(node.text)
+            node = node.right
+        return ''.join(chunks)
+
+    def lines(self):
+        '''
+        number of lines, the last of them not ending in a newline
+        '''
+        return newlines(self.root) + 1
+
+    def line_start(self, line):
+        '''
+        offset at which line number `line` (from 0) starts, or the end of
+        the text if there are fewer lines
+        '''
+        if line <= 0:
+            return 0
+        if line > newlines(self.root):
+            return len(self)
+        node, offset = self.root, 0
+        while True:
+            if line <= newlines(node.left):
+                node = node.left
+                continue
+            line -= newlines(node.left)
+            offset += size(node.left)
+            if line <= node.text.count('\n'):
+                index = -1
+                for _ in range(line):
+                    index = node.text.index('\n', index + 1)
+                return offset + index + 1
+            line -= node.text.count('\n')
+            offset += len(node.text)
+            node = node.right
+
+    def line_of(self, offset):
+        '''
+        number of the line that offset is in: the newlines before it
+        '''
+        line, node = 0, self.root
+        while node is not None:
+            if offset < size(node.left):
+                node = node.left
+                continue
+            line += newlines(node.left)
+            offset -= size(node.left)
+            if offset <= len(node.text):
+                return line + node.text.count('\n', 0, offset)
+            line += node.text.count('\n')
+            offset -= len(node.text)
+            node = node.right
+        return line
+
+    def slice(self, start, end):
+        '''
+        text from offset `start` up to `end`, visiting only the nodes that
+        hold some of it
+
+        >>> Rope('x' * 5000 + 'abc' + 'y' * 5000).slice(4999, 5004)
+        'xabcy'
+        '''
+        chunks, stack = [], []
+        node, offset = self.root, 0  # offset of node's subtree in the text
+        while stack or node is not None:
+            while node is not None and offset < end and (
+                    offset + node.size > start):
+                stack.append((node, offset))
+                node = node.left
+            if not stack:
+                break
+            node, offset = stack.pop()
+            here = offset + size(node.left)
+            chunks.append(node.text[max(start - here, 0):max(end - here, 0)])
+            node, offset = node.right, here + len(node.text)
+        return ''.join(chunks)
+
+    def find(self, offset, after=False):
+        '''
+        path from root to node holding the character just before `offset`,
+        or just after it if `after` is set, with `offset` within that node
+        '''
+        path, node = [], self.root
+        while node is not None:
+            path.append(node)
+            before = size(node.left)
+            if node.left is not None and (
+                    offset < before or offset == before and not after):
+                node = node.left
+                continue
+            offset -= before
+            if offset < len(node.text) + (not after):
+                break
+            offset -= len(node.text)
+            node = node.right
+        else:  # offset is past the end of the text
+            return [], offset
+        return path, offset
+
+    def insert(self, offset, text):
+        '''
+        insert text at offset
+        '''
+        if not text:
+            return
+        path, index = self.find(offset)
+        if path and len(path[-1].text) + len(text) <= CHUNK:
+            node, breaks = path[-1], text.count('\n')
+            node.text = node.text[:index] + text + node.text[index:]
+            for node in path:
+                node.size += len(text)
+                node.newlines += breaks
+            return
+        left, right = split(self.root, offset)
+        self.root = merge(merge(left, Rope(text).root), right)
+
+    def delete(self, offset, count=1):
+        '''
+        delete `count` characters starting at offset
+        '''
+        if count <= 0:
+            return
+        path, index = self.find(offset, after=True)
+        if path and index + count < len(path[-1].text):
+            node = path[-1]
+            breaks = node.text.count('\n', index, index + count)
+            node.text = node.text[:index] + node.text[index + count:]
+            for node in path:
+                node.size -= count
+                node.newlines -= breaks
+            return
+        left, right = split(self.root, offset)
+        self.root = merge(left, split(right, count)[1])
+
+class Document:
+    '''
+    the text being edited, changed by key events as the editors change it
+
+    >>> document = Document('ello')
+    >>> for key in 'H', 'Alt', 'x':
+    ...     document.apply({'key': key, 'direction': 'down'})
+    'H'
+    'Alt'
+    'Alt-X'
+    >>> for key, direction in ('d', 'down'), ('e', 'down'), ('d', 'up'):
+    ...     document.apply({'key': key, 'direction': direction,
+    ...                     'keytype': 'gkos'})
+    'g'
+    >>> document.apply({'key': 'ab', 'direction': 'up', 'keytype': 'chord'})
+    'o'
+    >>> str(document), document.caret
+    ('Hgoello', 3)
+    >>> document.apply({'key': 'abc', 'direction': 'up', 'keytype': 'chord'})
+    'Backspace'
+    >>> str(document), document.caret
+    ('Hgello', 2)
+    >>> document.apply({'key': 'Backspace', 'direction': 'down'})
+    'Backspace'
+    >>> str(document), document.caret
+    ('Hello', 1)
+
+    the caret is where the key events put it; clicks in a page aren't seen
+    '''
+    def __init__(self, text=''):
+        self.rope = Rope()
+        self.caret = self.chord = self.shift = self.modifiers = 0
+        self.ready = False  # chord key was pressed
+        self.load(text)
+
+    def __str__(self):
+        return str(self.rope)
+
+    def load(self, text, caret=0):
+        '''
+        replace the whole document, e.g. with a newly opened file
+        '''
+        self.rope = Rope(text)
+        self.caret = caret
+        self.chord = self.shift = self.modifiers = 0
+        self.ready = False
+
+    def apply(self, message):
+        '''
+        update document with one key event, as stopgap.js would
+
+        returns the key acted on, after chord resolution and modifiers,
+        or None if the event only contributed to a chord
+        '''
+        key = message.get('key', '')
+        if message.get('direction') == 'down':
+            if message.get('keytype') == 'gkos':
+                self.chord |= CHORD_KEYS.get(key, 0)
+                self.ready = True
+                return None
+            key = self.modified(key)
+            self.handle(key, 'down')
+            return key
+        if message.get('keytype') == 'chord':  # resolved by the server
+            self.chord = value(key)
+            self.ready = True
+        if self.ready:
+            key = MAPPING[self.chord | self.shift]
+            self.chord = self.shift = 0
+            self.ready = False
+            key = self.modified(key)
+            self.handle(key, 'up')
+            return key
+        return None
+
+    def before(self, count):
+        '''
+        up to `count` characters just before the caret
+
+        >>> document = Document('Hello, world')
+        >>> document.caret = 10
+        >>> document.before(4)
+        ' wor'
+        '''
+        return self.rope.slice(max(self.caret - count, 0), self.caret)
+
+    def line(self):
+        '''
+        number of the line the caret is in
+        '''
+        return self.rope.line_of(self.caret)
+
+    def text(self, first, last):
+        '''
+        lines `first` up to `last`, each with its newline
+        '''
+        return self.rope.slice(self.rope.line_start(first),
+                               self.rope.line_start(last))
+
+    def page(self, first, count, held=None):
+        '''
+        fields of a `page` message, for the editor of a document too large
+        to send whole: `count` lines from line `first`, where they start,
+        and their `text`; or if `held`, the (first line, count) an editor
+        has, still current, overlaps them, the lines `above` and `below`
+        the ones it is to `keep`
+
+        >>> document = Document(''.join('line %d\\n' % n for n in range(9)))
+        >>> page = document.page(7, 5)
+        >>> page['line'], page['lines'], page['total'], page['offset']
+        (7, 3, 10, 49)
+        >>> page['text']
+        'line 7\\nline 8\\n'
+        >>> page = document.page(2, 3, (3, 6))
+        >>> page['above'], page['keep'], page['below']
+        ('line 2\\n', [3, 5], '')
+        '''
+        total = self.rope.lines()
+        first = max(0, min(first, total - 1))
+        last = min(first + max(count, 1), total)
+        fields = {'line': first, 'lines': last - first, 'total': total,
+                  'offset': self.rope.line_start(first)}
+        if held:
+            low, high = max(first, held[0]), min(last, held[0] + held[1])
+            if low < high:
+                return dict(fields, above=self.text(first, low),
+                            keep=[low, high], below=self.text(high, last))
+        return dict(fields, text=self.text(first, last))
+
+    def modified(self, key):
+        '''
+        prefix key with any modifiers waiting for it, clearing them
+        '''
+        if key in MODIFIER_KEYS or not self.modifiers:
+            return key
+        prefix = ('Ctrl-' if self.modifiers & LEFT_CTRL else '') + (
+            'Alt-' if self.modifiers & LEFT_ALT else '')
+        self.modifiers = 0
+        return prefix + key[:1].upper() + key[1:]
+
+    def handle(self, key, direction):
+        '''
+        act on key after chord resolution and modifiers
+        '''
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('document handling %r at %d', key, self.caret)
+        if key == 'Alt':
+            self.modifiers |= LEFT_ALT
+        elif key == 'Ctrl':
+            self.modifiers |= LEFT_CTRL
+        elif key == 'SYMB':
+            if direction == 'up':
+                self.shift |= Z
+        elif key == 'Backspace':
+            if self.caret > 0:
+                self.caret -= 1
+                self.rope.delete(self.caret)
+        elif key == 'Enter':
+            self.insert('\n')
+        elif len(key) == 1:
+            self.insert(key)
+
+    def insert(self, text):
+        '''
+        type text at the caret
+        '''
+        self.rope.insert(self.caret, text)
+        self.caret += len(text)
@@ -0,0 +1,498 @@
+#!/usr/bin/python3
+'''
+what the server does with HTTP requests, and with the messages editors
+send over their websockets, whichever engine reads them
+
+WebSocketHandler serves the static files and `/metrics`, takes uploads,
+and upgrades websockets. the threaded engine gives each websocket a
+thread running `handler`, while the event loop reads them all itself;
+either way, each complete message goes to `respond`.
+'''
+# pylint: disable=multiple-imports
+import sys, os, time, socket, logging, json
+import posixpath as httppath
+from http.server import HTTPStatus
+from io import BytesIO
+from threading import enumerate as threading_enumerate
+from select import poll, POLLIN
+from wsserver import WebSocketHandler as DemoHandler, launch_websocket, \
+    package, closed_remotely, Deflate, CLOSE
+from multipart import read_multipart, uploaded_file
+from keylog import KEY_RECORD, KEY_PROTOCOL, decode_key
+from static import cached, bundled, service_worker
+from metrics import Counter, Histogram, REGISTRY
+from bus import LINKS
+from client import Client, CONNECTIONS, ping, batched
+from sessions import Event, opened, session_name, chorded, sequenced, \
+    broadcast, suggest
+from transfer import load, mapped, page, snapshot, PAGE_THRESHOLD
+from supervisor import HANDOFF, SERVICE_RESTART, readable
+
+# editors that offer it get key events as fixed-width binary records
+# instead of JSON, unless KEY_ENCODING=json. JSON_PROTOCOL is for those
+# that ask for a subprotocol but can't have the binary one.
+KEY_ENCODING = os.getenv('KEY_ENCODING') or 'binary'
+JSON_PROTOCOL = 'stopgap.json'
+# with CHORDS=server, GKOS softkey events are gathered into chords here,
+# and each editor sent one `chord` event per chord rather than one per
+# finger going down and up; by default, editors resolve chords themselves
+CHORDS = os.getenv('CHORDS') or 'client'
+FILE_CONTENT = 'multipart/form-data; boundary='
+METRICS_PATH = '/metrics'
+# static files are revalidated on every use by default, getting a `304 Not
+# Modified` if unchanged; `max-age=3600`, say, would skip even that
+STATIC_CACHE_CONTROL = os.getenv('STATIC_CACHE_CONTROL') or 'no-cache'
+# the editor page goes out as one bundle, its stylesheets and script
+# inlined, unless STATIC_BUNDLE=0 (to debug the script, say); either way
+# the service worker keeps it on the device for the next load
+STATIC_BUNDLE = (os.getenv('STATIC_BUNDLE') or '1') != '0'
+EDITOR_PAGE = 'stopgap.html'
+SERVICE_WORKER = 'serviceworker.js'
+FRAMES_RECEIVED = Counter('stopgap_frames_received_total',
+                          'websocket messages received')
+BYTES_RECEIVED = Counter('stopgap_bytes_received_total',
+                         'websocket bytes received')
+DECODE_SECONDS = Histogram('stopgap_decode_seconds',
+                           'time to decode each message received')
+# pylint: disable=consider-using-f-string
+
+class WebSocketHandler(DemoHandler):
+    '''
+    wsserver's handler, serving the editor rather than the demo
+    '''
+    def do_POST(self):  # pylint: disable=invalid-name
+        '''
+        handle POST calls with command functions
+        '''
+        logging.debug('handling POST request for %s', self.path)
+        command = self.path.lstrip('/')
+        if command in dir(self) and callable(getattr(self, command)):
+            return getattr(self, command)()
+        logging.debug('POST headers: %s', self.headers)
+        content_length = request_length(self.headers)
+        if content_length is None:
+            self.send_error(HTTPStatus.BAD_REQUEST, 'bad Content-Length')
+            return None
+        content_type = self.headers.get('content-type')
+        response = None
+        try:
+            session = opened(session_name(self.path))
+        except ValueError as problem:
+            logging.error('not accepting upload: %s', problem)
+            content_length = 0
+        if (content_length > 0 and content_type
+                and content_type.startswith(FILE_CONTENT)):
+            edit_file = session.edit_file
+            boundary = content_type[len(FILE_CONTENT):].strip().strip('"')
+            try:
+                upload = uploaded_file(read_multipart(
+                    self.rfile, boundary.encode(), content_length))
+            except ValueError as problem:
+                logging.error('not accepting file contents for editing: %s',
+                              problem)
+            else:
+                if edit_file['body'] is not None:
+                    edit_file['body'].close()
+                edit_file['headers'], edit_file['body'] = upload
+                # browsers send only the name, but don't trust them on that
+                edit_file['name'] = httppath.basename(
+                    upload[0].get_filename().replace('\\', '/')
+                ).lstrip('.') or 'untitled.txt'
+                logging.info('file being edited in %s: %s', session,
+                             edit_file['name'])
+                contents = mapped(edit_file['body'])
+                if LINKS.hub is not None:
+                    LINKS.hub.post({'load': edit_file['name'],
+                                    'session': session.name}, contents)
+                else:
+                    with session.sequencer.lock:
+                        load(session, contents)
+                response = 'file contents arriving over websocket'
+        else:
+            logging.error(
+                'POST content %d bytes, type %s not supported',
+                 content_length, content_type
+            )
+            response = 'file contents unavailable, check log'
+        self.send_response(HTTPStatus.NOT_MODIFIED, response)
+        self.end_headers()
+        return None
+
+    def send_head(self):
+        '''
+        serve `/metrics` too
+        '''
+        if self.path == METRICS_PATH:
+            metrics = REGISTRY.render().encode()
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(metrics)))
+            self.end_headers()
+            return BytesIO(metrics)
+        return super().send_head()
+
+    def send_upgrade(self):
+        '''
+        accept websocket request into the session its path names, with
+        whatever compression and subprotocol both ends can use
+        '''
+        try:
+            session = opened(session_name(self.path))
+        except ValueError as problem:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(problem))
+            return None
+        nonce = self.headers['Sec-WebSocket-Key'].encode()
+        deflate = Deflate.negotiate(
+            self.headers.get('Sec-WebSocket-Extensions'))
+        protocol = subprotocol(self.headers.get('Sec-WebSocket-Protocol'))
+        headers = []
+        if deflate is not None:
+            headers.append(('Sec-WebSocket-Extensions', deflate.response))
+        if protocol is not None:
+            headers.append(('Sec-WebSocket-Protocol', protocol))
+        self.switch_protocols(nonce, headers)
+        self.upgrade(nonce.decode(), session, deflate,
+                     protocol == KEY_PROTOCOL)
+        return None
+
+    def send_static(self):
+        '''
+        serve file from the static cache, with the best encoding the
+        browser accepts, or `304 Not Modified` if it has it already; the
+        editor page is served bundled, and the service worker filled in
+
+        directories, missing files, and files too big to cache are left to
+        SimpleHTTPRequestHandler
+        '''
+        path = self.translate_path(self.path)
+        directory, name = os.path.split(path)
+        try:
+            if os.path.isdir(path):
+                asset = None
+            elif name == EDITOR_PAGE and STATIC_BUNDLE:
+                asset = bundled(path)
+            elif name == SERVICE_WORKER:
+                asset = service_worker(path, os.path.join(
+                    directory, EDITOR_PAGE), STATIC_BUNDLE)
+            else:
+                asset = cached(path, self.guess_type(path))
+        except OSError:
+            asset = None
+        if asset is None:
+            return super().send_static()
+        encoding = asset.negotiate(self.headers.get('Accept-Encoding'))
+        if asset.matches(self.headers.get('If-None-Match')):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            body = None
+        else:
+            self.send_response(HTTPStatus.OK)
+            body = asset.encodings[encoding]
+            self.send_header('Content-Type', asset.content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if encoding is not None:
+                self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', asset.variant(encoding))
+        self.send_header('Cache-Control', STATIC_CACHE_CONTROL)
+        if len(asset.encodings) > 1:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        return None if body is None else BytesIO(body)
+
+    def copyfile(self, source, outputfile):
+        '''
+        send file too big for the static cache with `sendfile`, straight
+        from the page cache, if the connection is a socket of our own
+        (the event loop buffers responses instead)
+        '''
+        if isinstance(self.connection, socket.socket) and not isinstance(
+                source, BytesIO):
+            outputfile.flush()
+            self.connection.sendfile(source)
+        else:
+            super().copyfile(source, outputfile)
+
+    def upgrade(self, nonce, session, deflate=None, binary=False):
+        '''
+        hand the connection off to a websocket handler thread
+
+        `session` is the Session asked for, `deflate` the permessage-deflate
+        state, if negotiated, and `binary` whether key events are to be sent
+        as records
+        '''
+        logging.debug('socket before launch_websocket: %s', self.connection)
+        self.connection.settimeout(None)  # HTTP_TIMEOUT was for the request
+        launch_websocket(nonce, self.connection, handler, session, deflate,
+                         binary)
+
+def handler(connection, session, deflate=None, binary=False, client=None):
+    '''
+    handle two-way communications with websocket client
+
+    `client` is given, already set up, for a websocket handed off by the
+    server this one replaced
+    '''
+    logging.debug('thread starting handle(%s)', connection)
+    if not HANDOFF.admit():  # upgraded just as handoff started
+        connection.sendall(package(
+            SERVICE_RESTART.to_bytes(2, 'big'), 'close'))
+        connection.close()
+        return
+    if client is None:
+        try:
+            client = Client(connection, connection.getpeername())
+        except OSError:  # already gone
+            client = Client(connection)
+        client.upgrade(session, deflate, binary)
+        ping(client)  # send a ping to break the ice
+    poller = None
+    if HANDOFF.wakeup is not None:
+        poller = poll()
+        poller.register(connection, POLLIN)
+        poller.register(HANDOFF.wakeup[0], POLLIN)
+    try:
+        while True: # receive keyhits and dispatch them back out to all threads
+            if poller is not None:
+                readable(poller)
+            received = client.decoder.recv_into(connection)
+            if not received:
+                raise StopIteration('remote end closed unexpectedly')
+            BYTES_RECEIVED.add(received)
+            answer(client)
+    except (StopIteration, ConnectionResetError, BrokenPipeError,
+            BufferError) as ended:
+        logging.info('remote end closed: %s', ended)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('%s failed, hanging up', client)
+    finally:
+        closed(client)
+
+def closed(client):
+    '''
+    end of a websocket handler thread: forget about client, and close its
+    socket
+    '''
+    client.session.clients.discard(client)
+    CONNECTIONS.discard(client)
+    client.closed = True
+    if client.deflate is not None:
+        logging.info('%s compression: %s', client, client.deflate)
+    HANDOFF.leave()
+    try:  # ignore failure on shutdown
+        client.connection.shutdown(socket.SHUT_WR)
+        client.connection.close()
+    finally:
+        threads = threading_enumerate()
+        logging.debug('threads remaining: %s', threads)
+        sys.exit(0)
+
+def answer(client):
+    '''
+    act on every complete message client's decoder has, logging any that
+    can't be acted on
+
+    raises StopIteration when the connection is to be closed, or its
+    frames can't be made sense of
+    '''
+    try:
+        for opcode, payload in decoded(client):
+            try:
+                respond(client, opcode, payload)
+            except (NotImplementedError, ValueError, IndexError) as error:
+                logging.error('error in processing message: %s', error)
+    except BufferError as error:
+        raise StopIteration(error) from error
+
+def respond(client, opcode, payload):
+    '''
+    act on one complete message from websocket client
+
+    raises StopIteration when the connection is to be closed
+    '''
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('payload: %s', payload)
+    if opcode == 'close':
+        raise closed_remotely(payload)
+    if opcode == 'ping':
+        client.send(package(payload, 'pong'))
+    elif opcode == 'pong':
+        client.pong(bytes(payload))
+    elif payload == b'stop':
+        client.send(package(
+            CLOSE.to_bytes(2, 'big') +
+                b"server closed on client's request",
+            'close')
+        )
+    elif opcode == 'binary':
+        if not client.binary or len(payload) != KEY_RECORD.size:
+            logging.warning('unexpected binary message %r', payload[:64])
+            return
+        record = bytearray(payload)
+        keyed(client, *decode_key(record), record)
+    elif payload.startswith(b'stopgap editor'):
+        greet(client, payload[len(b'stopgap editor'):].decode().split())
+    else:
+        respond_json(client, payload)
+
+def respond_json(client, payload):
+    '''
+    act on a JSON message from websocket client: a key event, or a control
+    message
+    '''
+    try:
+        message = json.loads(payload)
+    except ValueError:  # JSONDecodeError, or UnicodeDecodeError
+        logging.warning('could not decode %r', payload)
+        return
+    if isinstance(message, dict) and isinstance(message.get('control'), str):
+        respond_control(client, message)
+        return
+    if not well_formed(message):
+        logging.warning('ignoring malformed message %r', bytes(payload[:256]))
+        return
+    echo = message.pop('echo', True)
+    keyed(client, message, message.pop('sent', None), echo)
+
+def well_formed(message):
+    '''
+    whether a JSON message is a key event the server can apply, journal
+    and pass on: anything else is dropped
+
+    >>> well_formed({'key': 'a', 'direction': 'down', 'sent': 3})
+    True
+    >>> [well_formed(message) for message in (5, {'echo': True},
+    ...  {'key': 1}, {'key': 'a', 'echo': 'no'}, {'key': 'a', 'sent': 'x'},
+    ...  {'key': 'a', 'modifiers': 256})]
+    [False, False, False, False, False, False]
+    '''
+    if not isinstance(message, dict):
+        return False
+    sent, modifiers = message.get('sent'), message.get('modifiers', 0)
+    return (isinstance(message.get('key'), str) and
+            isinstance(message.get('echo', True), bool) and
+            isinstance(message.get('direction', ''), str) and
+            isinstance(message.get('keytype') or '', str) and
+            (sent is None or isinstance(sent, int) and 0 <= sent < 2**32) and
+            isinstance(modifiers, int) and 0 <= modifiers < 256)
+
+def respond_control(client, message):
+    '''
+    act on a control message from websocket client: acknowledging chunks
+    of a document, or asking for a page of it
+    '''
+    with client.session.sequencer.lock:
+        if message['control'] == 'ack':
+            transfer = client.transfer
+            offset = message.get('offset', 0)
+            if not isinstance(offset, int):
+                logging.warning('bad acknowledgement %s', message)
+            elif transfer and transfer.id == message.get('transfer'):
+                transfer.acknowledge(client, offset)
+        elif message['control'] == 'page':
+            try:
+                client.send(page(client.session, message))
+            except (KeyError, TypeError, ValueError) as problem:
+                logging.warning('bad page request %s: %r', message, problem)
+        else:
+            logging.warning('unknown control message %s', message)
+
+def keyed(client, message, sent, echo, record=None):
+    '''
+    sequence key event from client, apply it, and send it to the editors
+
+    same key/serial number gets sent to all clients. in a worker process,
+    the hub does the sequencing, and the event comes back by way of
+    `relayed`. with CHORDS=server, only the event completing a GKOS chord
+    goes on, as a `chord` event.
+    '''
+    session = client.session
+    if CHORDS == 'server' and message.get('keytype') == 'gkos':
+        message, record = chorded(session, message, client.origin, sent), None
+        if message is None:
+            return
+    if LINKS.hub is not None:
+        LINKS.hub.post({'key': message, 'origin': client.origin,
+                        'sent': sent, 'echo': echo, 'sender': id(client),
+                        'session': session.name})
+        return
+    with session.sequencer.lock:
+        event = sequenced(session, Event(message, client.origin, echo,
+                                         record), sent)
+        if event is not None:
+            broadcast(session, event, None if echo else client)
+            suggest(session)
+
+def greet(client, args):
+    '''
+    register editor client, bringing it up to date
+
+    greeting is `stopgap editor [ORIGIN [LAST_SERIAL [TRANSFER OFFSET]]]`,
+    where ORIGIN identifies the page across reconnects, and TRANSFER and
+    OFFSET tell how much of a document it had received. a resuming client
+    is replayed what it missed if possible, otherwise sent the document,
+    or the page of it around the caret if it is large.
+    '''
+    logging.info('stopgap editor found at %s: %s', client, args)
+    session = client.session
+    client.origin = args[0] if args else None
+    since = int(args[1]) if len(args) > 1 else None
+    with session.sequencer.lock:
+        if not session.ready:  # worker still waiting for it from the hub
+            session.waiting.append((client, args))
+            return
+        transfer, offset = None, 0
+        if len(args) > 3:
+            transfer = session.transfers.get(int(args[2]))
+            offset = int(args[3])
+            since = transfer.serial if transfer else None
+        missed = None if since is None else session.sequencer.replay(
+            since, client.origin)
+        if missed is None and len(session.document.rope) > PAGE_THRESHOLD:
+            client.send(page(session))
+        elif missed is None:
+            snapshot(session).start(client)
+        else:
+            if transfer is not None:
+                transfer.start(client, offset)
+            if missed:
+                logging.info('replaying %d events to %s', len(missed), client)
+                payload, opcode = batched(missed, client.binary)
+                client.send_message(payload, opcode=opcode, messages=missed)
+        session.clients.add(client)
+
+def decoded(client):
+    '''
+    messages from client's decoder, each timed and counted
+    '''
+    started = time.perf_counter()
+    for opcode, payload in client.decoder:
+        DECODE_SECONDS.observe(time.perf_counter() - started)
+        FRAMES_RECEIVED.add()
+        yield opcode, payload
+        started = time.perf_counter()
+
+def request_length(headers):
+    '''
+    the Content-Length of a request, 0 if it has none, or None if it isn't
+    a non-negative integer
+
+    >>> request_length({'content-length': '42'}), request_length({})
+    (42, 0)
+    >>> request_length({'content-length': '-1'})
+    >>> request_length({'content-length': '4_2'})
+    '''
+    length = headers.get('content-length', '0').strip()
+    if not (length.isascii() and length.isdigit()):
+        return None
+    return int(length)
+
+def subprotocol(offers):
+    '''
+    which of the Sec-WebSocket-Protocol values offered we will use, if any
+
+    >>> subprotocol('chat, stopgap.json, stopgap.binary')
+    'stopgap.binary'
+    '''
+    offered = [offer.strip() for offer in (offers or '').split(',')]
+    if KEY_ENCODING == 'binary' and KEY_PROTOCOL in offered:
+        return KEY_PROTOCOL
+    return JSON_PROTOCOL if JSON_PROTOCOL in offered else None
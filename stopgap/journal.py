@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+'''
+write-ahead journal of key events, with snapshots of the document
+
+everything is written from a background thread, so typing never waits on
+the disk. fsync is batched by time and by size, and a snapshot replaces
+the journal so that recovery only replays what came after it.
+'''
+import os, time, json, logging  # pylint: disable=multiple-imports
+from collections import deque
+from threading import Thread, Condition
+
+SAVE_DIR = os.getenv('SAVE_DIR') or 'saved'  # saved files, journal, snapshot
+FSYNC_INTERVAL = float(os.getenv('FSYNC_INTERVAL') or 1.0)  # seconds
+FSYNC_BYTES = int(os.getenv('FSYNC_BYTES') or 65536)
+COMPACT_EVENTS = 10000  # key events journaled before taking a new snapshot
+JOURNAL = 'stopgap.journal'
+SNAPSHOT = 'stopgap.snapshot'
+# saved files go in a directory of their own, so that whatever they're
+# called, they can't replace the journal's files, nor those beside it
+FILES = 'files'
+# pylint: disable=consider-using-f-string
+
+class Journal:
+    r'''
+    key events since the last snapshot, kept safe on disk
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> journal = Journal(directory)
+    >>> journal.start()
+    >>> journal.append({'key': 'a', 'serial': 1, 'origin': 'page', 'sent': 1})
+    >>> journal.snapshot('a', save=True, serial=1, caret=1, sent={'page': 1},
+    ...                  filename='a.txt')
+    >>> journal.append({'key': 'b', 'serial': 2, 'origin': 'page', 'sent': 2})
+    >>> journal.close()
+    >>> header, text, events = Journal(directory).recover()
+    >>> header
+    {'serial': 1, 'caret': 1, 'sent': {'page': 1}, 'filename': 'a.txt'}
+    >>> text, events
+    ('a', [{'key': 'b', 'serial': 2, 'origin': 'page', 'sent': 2}])
+    >>> with open(os.path.join(directory, FILES, 'a.txt')) as saved:
+    ...     saved.read()
+    'a'
+    >>> with open(os.path.join(directory, SNAPSHOT), 'wb') as clobbered:
+    ...     clobbered.write(b'not a snapshot')
+    14
+    >>> Journal(directory).recover()[:2]
+    ({'serial': 0, 'caret': 0, 'sent': {}}, '')
+    >>> sorted(os.listdir(directory))
+    ['files', 'stopgap.journal', 'stopgap.snapshot.corrupt']
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, directory=SAVE_DIR, interval=FSYNC_INTERVAL,
+                 size=FSYNC_BYTES):
+        self.directory = directory
+        self.path = os.path.join(directory, JOURNAL)
+        self.interval = interval  # longest time an event can go unsynced
+        self.size = size  # most bytes that can go unsynced
+        self.condition = Condition()
+        self.queue = deque()  # events, and snapshots, to write
+        self.events = 0  # journaled since the last snapshot
+        self.file = self.thread = None
+        self.keylog = None  # KeyLog, flushed whenever the journal is synced
+
+    def recover(self):
+        '''
+        header and text of the last snapshot, and the events journaled since
+
+        the header's `sent` has the latest count of messages sent by each
+        origin, as journaled events from one have theirs. a partly written
+        event at the end of the journal, from a crash, is ignored. a
+        snapshot that can't be read is set aside, and the journal replayed
+        from nothing
+        '''
+        header, text, events = {'serial': 0, 'caret': 0, 'sent': {}}, '', []
+        path = os.path.join(self.directory, SNAPSHOT)
+        try:
+            with open(path, 'rb') as infile:
+                header = json.loads(infile.readline())
+                text = infile.read().decode()
+            header['serial'], header['caret'] = (
+                int(header['serial']), int(header['caret']))
+            header['sent'] = {str(origin): int(count) for origin, count
+                              in header.get('sent', {}).items()}
+        except FileNotFoundError:
+            logging.info('no snapshot found in %s', self.directory)
+        except (ValueError, TypeError, KeyError, AttributeError) as problem:
+            logging.error('setting aside unreadable %s: %r', path, problem)
+            os.replace(path, path + '.corrupt')
+            header, text = {'serial': 0, 'caret': 0, 'sent': {}}, ''
+        try:
+            with open(self.path, 'rb') as infile:
+                for line in infile:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logging.warning('ignoring torn journal entry %r',
+                                        line[:80])
+                        break
+                    if event['serial'] > header['serial']:
+                        events.append(event)
+        except FileNotFoundError:
+            logging.info('no journal found in %s', self.directory)
+        logging.info('recovered %d characters at serial %d, and %d events',
+                     len(text), header['serial'], len(events))
+        return header, text, events
+
+    def start(self):
+        '''
+        open the journal and start the thread that writes it
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        self.file = open(self.path, 'ab')  # pylint: disable=consider-using-with
+        self.thread = Thread(target=self.run, name='journal', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        '''
+        write and sync everything still queued, then stop the thread
+        '''
+        with self.condition:
+            self.queue.append(None)
+            self.condition.notify()
+        self.thread.join()
+        self.file.close()
+
+    def append(self, event):
+        '''
+        queue a key event for the journal
+
+        serializing it is left to the thread, off the path of the keystroke
+        '''
+        with self.condition:
+            self.queue.append(event)
+            self.events += 1
+            self.condition.notify()
+
+    def due(self):
+        '''
+        whether enough events have been journaled to be worth a snapshot
+        '''
+        return self.events >= COMPACT_EVENTS
+
+    def snapshot(self, text, save=False, **header):
+        '''
+        queue the whole document, to replace the journal so far
+
+        `header` must include the serial of the last event in `text`.
+        with `save`, the text is also written to the file being edited.
+        '''
+        with self.condition:
+            self.queue.append((header, text, save))
+            self.events = 0
+            self.condition.notify()
+
+    def run(self):
+        '''
+        write queued entries, syncing every `interval` or `size` bytes
+        '''
+        unsynced, synced = 0, time.monotonic()
+        while True:
+            with self.condition:
+                while not self.queue:
+                    if not unsynced:
+                        self.condition.wait()
+                    elif not self.condition.wait(
+                            synced + self.interval - time.monotonic()):
+                        break
+                entries, self.queue = self.queue, deque()
+            for entry in entries:
+                if entry is None:
+                    self.attempt(self.sync)
+                    return
+                if isinstance(entry, tuple):
+                    self.attempt(self.sync)
+                    self.attempt(self.compact, *entry)
+                    unsynced = 0
+                else:
+                    line = json.dumps(entry, separators=(',', ':')).encode()
+                    if self.attempt(self.file.write, line + b'\n'):
+                        unsynced += len(line) + 1
+            if unsynced and (unsynced >= self.size or
+                             time.monotonic() - synced >= self.interval):
+                self.attempt(self.sync)
+                unsynced, synced = 0, time.monotonic()
+
+    def attempt(self, action, *args):
+        '''
+        call action, logging any error from the disk rather than raising
+        it, so that one failed write (a full disk, say) doesn't stop the
+        thread, and with it the journal, for good
+        '''
+        try:
+            action(*args)
+            return True
+        except OSError as failed:
+            logging.error('journal in %s: %s', self.directory, failed)
+            return False
+
+    def sync(self):
+        '''
+        make sure everything written so far is on disk
+        '''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.keylog is not None:
+            self.keylog.flush()
+
+    def compact(self, header, text, save):
+        '''
+        write snapshot, and only then empty the journal
+
+        a crash in between leaves journal events the snapshot already
+        includes, which recovery skips by serial number
+        '''
+        contents = text.encode()
+        replace(os.path.join(self.directory, SNAPSHOT),
+                json.dumps(header).encode() + b'\n', contents)
+        self.file.truncate(0)
+        self.sync()
+        logging.info('snapshot of %d bytes at serial %d',
+                     len(contents), header['serial'])
+        if save and header.get('filename'):
+            os.makedirs(os.path.join(self.directory, FILES), exist_ok=True)
+            replace(os.path.join(self.directory, FILES, header['filename']),
+                    contents)
+            logging.info('saved %s', header['filename'])
+
+def replace(path, *pieces):
+    '''
+    atomically replace file at `path` with the concatenated pieces
+    '''
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as outfile:
+        for piece in pieces:
+            outfile.write(piece)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temporary, path)
+    directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+'''
+binary log of every key event sequenced, for replay and analysis
+
+each event is a fixed-size record: the time it was sequenced, then the
+same 32 bytes as its binary WebSocket record (serial, count sent, flags,
+keytype, modifier bits, key), which is laid out here for stopgap.py and
+the tools that talk to it. every INDEX_EVERY records, the time, serial
+and number of a record go into a sparse index, so that a range of times
+or serials is found by bisecting the index, then one stretch of the log.
+the log is only ever read through mmap, a record at a time
+
+    python3 keylog.py [DIRECTORY [FROM [TO]]]
+
+prints how many keys were typed in DIRECTORY (default SAVE_DIR) between
+FROM and TO (times, as seconds since the epoch or ISO 8601, or serials
+as #SERIAL), how many were backspaces, and which chords were most often
+backspaced over straight away
+'''
+# pylint: disable=multiple-imports
+import sys, os, mmap, struct, logging
+from bisect import bisect_left
+from datetime import datetime
+from chords import CHORD_KEYS, Z, value
+from document import MAPPING
+# pylint: disable=consider-using-f-string
+
+KEYLOG = 'stopgap.keylog'
+INDEX_EVERY = 256  # records per index entry
+# key record, as stopgap.py and its pages send it: serial, count sent by
+# origin, flags, keytype, modifier bits, then key in UTF-8 padded with nulls
+KEY_SIZE = 21  # bytes of key, at most
+KEY_RECORD = struct.Struct('>IIBBB%ds' % KEY_SIZE)
+KEY_DOWN, KEY_ECHO = 0x01, 0x02  # flags
+KEYTYPES = [None, 'gkos', 'chord']  # by code in record
+KEY_PROTOCOL = 'stopgap.binary'  # WebSocket subprotocol for records
+GKOS, CHORD = KEYTYPES.index('gkos'), KEYTYPES.index('chord')
+TIME = struct.Struct('>d')  # seconds since the epoch, before each record
+RECORD = struct.Struct(TIME.format + KEY_RECORD.format[1:])  # whole record
+INDEX = struct.Struct('>dII')  # time, serial, record number
+SOFTKEYS = {key.encode().ljust(KEY_SIZE, b'\0'): bit
+            for key, bit in CHORD_KEYS.items()}
+
+def encode_key(message):
+    r'''
+    key event as binary record, or None if it won't fit in one
+
+    >>> record = encode_key({'key': 'a', 'direction': 'down', 'serial': 7,
+    ...                      'keytype': 'gkos'})
+    >>> len(record), record[:12]
+    (32, b'\x00\x00\x00\x07\x00\x00\x00\x00\x03\x01\x00a')
+    '''
+    key = message.get('key', '').encode()
+    if len(key) > KEY_SIZE or message.get('keytype') not in (
+            KEYTYPES):
+        return None
+    return KEY_RECORD.pack(
+        message.get('serial', 0), message.get('sent') or 0,
+        (KEY_DOWN if message.get('direction') == 'down' else 0) |
+        (KEY_ECHO if message.get('echo', True) else 0),
+        KEYTYPES.index(message.get('keytype')), message.get('modifiers', 0),
+        key)
+
+def decode_key(record):
+    '''
+    (message, sent, echo) from binary record
+
+    `message` has only what a JSON key event would, except `echo` and
+    `sent`, which are returned separately
+
+    >>> decode_key(encode_key({'key': 'Enter', 'direction': 'up',
+    ...                        'echo': False, 'sent': 5, 'modifiers': 4}))
+    ({'key': 'Enter', 'direction': 'up', 'modifiers': 4}, 5, False)
+    '''
+    serial, sent, flags, keytype, modifiers, key = KEY_RECORD.unpack(record)
+    message = {
+        'key': key.rstrip(b'\0').decode(errors='replace'),
+        'direction': 'down' if flags & KEY_DOWN else 'up'
+    }
+    if keytype:
+        message['keytype'] = KEYTYPES[keytype]
+    if modifiers:
+        message['modifiers'] = modifiers
+    if serial:
+        message['serial'] = serial
+    return message, sent, bool(flags & KEY_ECHO)
+
+def clipped(key):
+    '''
+    key cut short, at a character, to fit in a record
+
+    >>> clipped('Backspace'), clipped('\u00e9' * 11)
+    ('Backspace', 'éééééééééé')
+    '''
+    return key.encode()[:KEY_SIZE].decode(errors='ignore')
+
+class KeyLog:
+    '''
+    log being written, and its index
+
+    writes are buffered, so appending costs no system call; the journal
+    thread flushes them whenever it syncs the journal
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> keylog = KeyLog(directory)
+    >>> keylog.open()
+    >>> for serial in range(1, 301):
+    ...     keylog.append(bytes(4) + serial.to_bytes(4, 'big') + bytes(24),
+    ...                   1000.0 + serial)
+    >>> keylog.close()
+    >>> with open(keylog.path, 'ab') as torn:
+    ...     torn.write(b'half a record')
+    13
+    >>> keylog.open()
+    >>> keylog.count, os.path.getsize(keylog.index_path) // INDEX.size
+    (300, 2)
+    >>> keylog.close()
+    '''
+    def __init__(self, directory):
+        self.path = os.path.join(directory, KEYLOG)
+        self.index_path = self.path + '.index'
+        self.file = self.index = None
+        self.count = 0  # records in the log
+
+    def open(self):
+        '''
+        open log for appending, dropping any torn record at its end and
+        reindexing it if the index doesn't match
+        '''
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # pylint: disable=consider-using-with
+        self.file = open(self.path, 'ab')
+        size = self.file.seek(0, os.SEEK_END)
+        if size % RECORD.size:
+            logging.warning('dropping torn record at end of %s', self.path)
+            self.file.truncate(size - size % RECORD.size)
+            self.file.seek(0, os.SEEK_END)
+        self.count = size // RECORD.size
+        entries = -(-self.count // INDEX_EVERY)
+        try:
+            indexed = os.path.getsize(self.index_path) // INDEX.size
+        except FileNotFoundError:
+            indexed = None
+        self.index = open(self.index_path, 'ab')
+        if indexed != entries:
+            logging.info('reindexing %s', self.path)
+            self.index.truncate(0)
+            with Reader(os.path.dirname(self.path), indexed=False) as log:
+                for number in range(0, self.count, INDEX_EVERY):
+                    self.index.write(INDEX.pack(
+                        log.time(number), log.serial(number), number))
+
+    def append(self, record, when):
+        '''
+        log the binary record of a key event, sequenced at time `when`
+
+        must be called with the session's sequencer lock held
+        '''
+        if self.count % INDEX_EVERY == 0:
+            self.index.write(INDEX.pack(
+                when, int.from_bytes(record[:4], 'big'), self.count))
+        self.file.write(TIME.pack(when) + record)
+        self.count += 1
+
+    def flush(self):
+        '''
+        hand everything appended so far to the system
+        '''
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        '''
+        flush and close log and index
+        '''
+        self.file.close()
+        self.index.close()
+
+class Column:  # pylint: disable=too-few-public-methods
+    '''
+    one field of fixed-size records in a buffer, as a sequence that
+    `bisect` can search without unpacking the rest
+    '''
+    def __init__(self, buffer, layout, field, count):
+        self.buffer, self.layout, self.field = buffer, layout, field
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, number):
+        return self.layout.unpack_from(
+            self.buffer, number * self.layout.size)[self.field]
+
+class Reader:
+    '''
+    log and index of a directory, mmapped read-only
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> keylog = KeyLog(directory)
+    >>> keylog.open()
+    >>> for serial in range(1, 1001):
+    ...     keylog.append(serial.to_bytes(4, 'big') + bytes(28), serial / 10)
+    >>> keylog.close()
+    >>> with Reader(directory) as log:
+    ...     len(log), log.find(when=50), log.find(serial=700), log.find(
+    ...         when=1000), log.serial(log.find(when=25.05))
+    (1000, 499, 699, 1000, 251)
+    '''
+    def __init__(self, directory, indexed=True):
+        self.maps = []
+        self.log = self.mapped(os.path.join(directory, KEYLOG))
+        self.count = len(self.log) // RECORD.size
+        self.index = self.mapped(os.path.join(directory, KEYLOG + '.index'))
+        if not indexed or len(self.index) // INDEX.size != -(
+                -self.count // INDEX_EVERY):
+            self.index.release()  # stale or missing: bisect the log instead
+            self.index = memoryview(b'')
+
+    def mapped(self, path):
+        '''
+        contents of file, mmapped, or empty if there's nothing to map
+        '''
+        try:
+            with open(path, 'rb') as infile:
+                self.maps.append(mmap.mmap(
+                    infile.fileno(), 0, access=mmap.ACCESS_READ))
+                return memoryview(self.maps[-1])
+        except (FileNotFoundError, ValueError):  # ValueError if empty
+            return memoryview(b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        '''
+        unmap log and index
+        '''
+        self.log.release()
+        self.index.release()
+        for mapping in self.maps:
+            mapping.close()
+
+    def __len__(self):
+        return self.count
+
+    def time(self, number):
+        '''
+        when record `number` was sequenced
+        '''
+        return RECORD.unpack_from(self.log, number * RECORD.size)[0]
+
+    def serial(self, number):
+        '''
+        serial of record `number`
+        '''
+        return RECORD.unpack_from(self.log, number * RECORD.size)[1]
+
+    def find(self, when=None, serial=None):
+        '''
+        number of the first record at or after time `when`, or with at
+        least serial `serial`; len(self) if there is none
+        '''
+        field, target = (0, when) if serial is None else (1, serial)
+        low, high = 0, self.count
+        if self.index:
+            entries = len(self.index) // INDEX.size
+            entry = bisect_left(Column(self.index, INDEX, field, entries),
+                                target)
+            low = (entry - 1) * INDEX_EVERY if entry else 0
+            high = min(entry * INDEX_EVERY, self.count)
+        return bisect_left(Column(self.log, RECORD, field, self.count),
+                           target, low, high)
+
+    def records(self, first=0, last=None):
+        '''
+        records `first` up to `last`, as they are in the log
+        '''
+        last = self.count if last is None else last
+        return self.log[first * RECORD.size:last * RECORD.size]
+
+    def span(self, start=None, end=None):
+        '''
+        (first, last) record numbers for the range from `start` up to
+        `end`, each a time, a '#SERIAL', or empty for no limit
+        '''
+        return (self.find(**bound(start)) if start else 0,
+                self.find(**bound(end)) if end else self.count)
+
+def bound(limit):
+    '''
+    keyword arguments to `Reader.find` for a limit given on the command line
+
+    >>> bound('#12'), bound('1700000000.5')
+    ({'serial': 12}, {'when': 1700000000.5})
+    '''
+    if limit.startswith('#'):
+        return {'serial': int(limit[1:])}
+    try:
+        return {'when': float(limit)}
+    except ValueError:
+        return {'when': datetime.fromisoformat(limit).timestamp()}
+
+def typed(records):
+    '''
+    (key, chord) for each key typed, resolving chords and the shift as
+    stopgap.js would; `chord` is the softkeys that made it, or None
+
+    records are unpacked one at a time, straight from the buffer
+    '''
+    chord = shift = 0
+    ready = False
+    for fields in RECORD.iter_unpack(records):
+        flags, keytype, key = fields[3], fields[4], fields[6]
+        if keytype == GKOS:
+            if flags & KEY_DOWN:
+                chord |= SOFTKEYS.get(key, 0)
+                ready = True
+                continue
+        elif keytype == CHORD:
+            chord, ready = value(key.rstrip(b'\0').decode()), True
+        elif flags & KEY_DOWN:
+            yield key.rstrip(b'\0').decode(errors='replace'), None
+            continue
+        if not ready:
+            continue
+        bits, chord, ready = chord, 0, False
+        key, shift = MAPPING[bits | shift], 0
+        if key == 'SYMB':
+            shift = Z
+        yield key, bits
+
+def statistics(records):
+    '''
+    (keys typed, backspaces, {chord: [times typed, times backspaced over
+    straight after]})
+
+    >>> records = b''.join(RECORD.pack(0, n, 0, 1, 0, 0, key.encode())
+    ...                    for n, key in enumerate('xy', 1))
+    >>> for chord in 'de', 'abc', 'de':
+    ...     records += b''.join(RECORD.pack(0, 0, 0, flags, 1, 0, key.encode())
+    ...                         for flags in (1, 0) for key in chord)
+    >>> statistics(records)
+    (5, 1, {24: [2, 1], 7: [1, 0]})
+    '''
+    keys = backspaces = 0
+    chords, previous = {}, None
+    for key, bits in typed(records):
+        keys += 1
+        if key == 'Backspace':
+            backspaces += 1
+            if previous is not None:
+                chords[previous][1] += 1
+        if bits is not None:
+            chords.setdefault(bits, [0, 0])[0] += 1
+        previous = bits
+    return keys, backspaces, chords
+
+def report(directory, start=None, end=None, top=20):
+    '''
+    print statistics for the keys typed between `start` and `end`
+    '''
+    with Reader(directory) as log:
+        first, last = log.span(start, end)
+        keys, backspaces, chords = statistics(log.records(first, last))
+        print('%d records, serials %s to %s' % (
+            last - first, log.serial(first) if last > first else '-',
+            log.serial(last - 1) if last > first else '-'))
+    print('%d keys typed, %d backspaces (%.1f%%)' % (
+        keys, backspaces, 100 * backspaces / (keys or 1)))
+    if chords:
+        print('%-8s %-10s %8s %8s %7s' % (
+            'chord', 'key', 'typed', 'undone', 'rate'))
+    ranked = sorted(chords.items(), key=lambda item: (
+        -item[1][1] / item[1][0], -item[1][0]))
+    for bits, (count, undone) in ranked[:top]:
+        print('%-8s %-10r %8d %8d %6.1f%%' % (
+            ''.join(key for key, bit in CHORD_KEYS.items() if bits & bit),
+            MAPPING[bits], count, undone, 100 * undone / count))
+
+if __name__ == '__main__':
+    report(*(sys.argv[1:] or [os.getenv('SAVE_DIR') or 'saved']))
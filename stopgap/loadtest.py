@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+'''
+load test: many synthetic editors against a freshly started stopgap.py
+
+`make loadtest` to run, with results written as JSON to the file named
+on the command line (default loadtest.json). the environment sets what
+is tried, each combination with a server of its own:
+
+LOAD_CLIENTS: comma-separated numbers of editors connected
+LOAD_RATES: comma-separated key events per second from each typist
+LOAD_TYPISTS: fraction of the editors that type (at least one does)
+LOAD_SECONDS: how long each combination types for
+ENGINE: comma-separated server engines, as for stopgap.py
+KEY_ENCODING: `json` to have the server refuse binary key records,
+  which every editor asks for
+
+every editor gets every key event; latency is from a typist sending a key
+to each editor receiving it. each typist types its own key, and the server
+keeps each typist's events in order, so the nth of that key anyone
+receives is the typist's nth.
+'''
+# pylint: disable=multiple-imports
+import sys, os, time, json, random, socket, selectors, subprocess, tempfile
+import logging
+from base64 import b64encode
+from wsserver import unmask, frame_header, OPCODE, MASKED, PAYLOAD_SIZE
+from keylog import KEY_RECORD, KEY_PROTOCOL, encode_key
+
+ADDRESS = '127.0.0.1'
+PORT = int(os.getenv('LOAD_PORT') or 8765)
+CLIENTS = [int(n) for n in
+           (os.getenv('LOAD_CLIENTS') or '1,10,50').split(',')]
+RATES = [float(n) for n in (os.getenv('LOAD_RATES') or '4,16').split(',')]
+TYPISTS = float(os.getenv('LOAD_TYPISTS') or .1)
+SECONDS = float(os.getenv('LOAD_SECONDS') or 5)
+ENGINES = (os.getenv('ENGINE') or 'threads').split(',')
+DRAIN = 2  # seconds to wait for stragglers after typing stops
+STARTUP = 10  # seconds to wait for server to accept connections
+# pylint: disable=consider-using-f-string
+
+class Editor:
+    '''
+    one synthetic editor: a masked websocket client that may also type
+    '''
+    def __init__(self, number, port=PORT, address=ADDRESS, path='/',
+                 origin=None):
+        self.connection = socket.create_connection((address, port))
+        # browsers don't hold back small writes, so neither do we
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        nonce = b64encode(os.urandom(16))
+        self.connection.sendall(
+            b'GET %s HTTP/1.1\r\nHost: %s\r\nUpgrade: websocket\r\n'
+            b'Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\n'
+            b'Sec-WebSocket-Version: 13\r\n'
+            b'Sec-WebSocket-Protocol: %s\r\n\r\n' % (
+                path.encode(), address.encode(), nonce,
+                KEY_PROTOCOL.encode()))
+        self.buffer = bytearray()
+        while b'\r\n\r\n' not in self.buffer:
+            data = self.connection.recv(4096)
+            if not data:
+                raise ConnectionError('server closed during handshake')
+            self.buffer += data
+        head, _, rest = bytes(self.buffer).partition(b'\r\n\r\n')
+        self.binary = b'\r\nsec-websocket-protocol: %s' % (
+            KEY_PROTOCOL.encode()) in head.lower()
+        self.buffer = bytearray(rest)
+        self.connection.setblocking(False)
+        self.outbox = bytearray()
+        self.key = 'L%d' % number  # what this editor types, if it does
+        self.typed = []  # when each key event was sent
+        self.received = {}  # key events received, by key
+        self.send(b'stopgap editor %s' % (
+            origin or 'load%d' % number).encode())
+
+    def fileno(self):
+        '''
+        allow Editor to be registered with a selector
+        '''
+        return self.connection.fileno()
+
+    def send(self, payload, opcode='text'):
+        '''
+        send masked frame, queueing what the socket won't take
+        '''
+        mask = os.urandom(4)
+        header = bytearray(frame_header(len(payload), opcode))
+        header[1] |= MASKED
+        self.outbox += header + mask + unmask(payload, mask)
+        self.flush()
+
+    def flush(self):
+        '''
+        send as much of the outbox as the socket will take
+        '''
+        try:
+            while self.outbox:
+                del self.outbox[:self.connection.send(self.outbox)]
+        except BlockingIOError:
+            pass
+
+    def type(self, sent):
+        '''
+        send one key event, alternating down and up
+        '''
+        message = {'key': self.key,
+                   'direction': 'down' if sent % 2 else 'up',
+                   'echo': True, 'sent': sent}
+        record = self.binary and encode_key(message)
+        self.typed.append(time.perf_counter())
+        if record:
+            self.send(record, 'binary')
+        else:
+            self.send(json.dumps(message, separators=(',', ':')).encode())
+
+    def frames(self):
+        '''
+        receive what's available, yielding (opcode, payload) of each frame
+        '''
+        try:
+            data = self.connection.recv(1048576)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionError('server closed connection')
+        self.buffer += data
+        while len(self.buffer) >= 2:
+            size, offset = self.buffer[1] & PAYLOAD_SIZE, 2
+            if size == 126:
+                size, offset = int.from_bytes(self.buffer[2:4], 'big'), 4
+            elif size == 127:
+                size, offset = int.from_bytes(self.buffer[2:10], 'big'), 10
+            if len(self.buffer) < offset + size:
+                return
+            opcode = OPCODE[self.buffer[0] & 0xf]
+            payload = bytes(self.buffer[offset:offset + size])
+            del self.buffer[:offset + size]
+            yield opcode, payload
+
+    def keys(self, opcode, payload):
+        '''
+        keys of the key events in a message, acting on anything else
+        '''
+        if opcode == 'ping':
+            self.send(payload, 'pong')
+        elif opcode == 'binary' and payload[:1] >= b'\x80':  # document chunk
+            transfer, offset = int.from_bytes(payload[:4], 'big'), (
+                int.from_bytes(payload[4:12], 'big') + len(payload) - 12)
+            self.send(json.dumps({'control': 'ack', 'transfer': transfer,
+                                  'offset': offset}).encode())
+        elif opcode == 'binary':
+            for index in range(0, len(payload), KEY_RECORD.size):
+                yield KEY_RECORD.unpack_from(payload, index)[-1].rstrip(
+                    b'\0').decode()
+        elif opcode == 'text':
+            messages = json.loads(payload)
+            if not isinstance(messages, list):  # unless several were batched
+                messages = [messages]
+            for message in messages:
+                if 'key' in message:
+                    yield message['key']
+
+def serve(engine, port=PORT):
+    '''
+    start stopgap.py with its own empty SAVE_DIR, returning the process
+    '''
+    environment = dict(os.environ, ENGINE=engine, PORT=str(port),
+                       LOCAL=ADDRESS, SAVE_DIR=tempfile.mkdtemp())
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, '-O', 'stopgap.py'], env=environment,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((ADDRESS, port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(.1)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+def usage(pid):
+    '''
+    (CPU seconds, peak RSS bytes) used so far by process and its children
+    (the workers, if WORKERS is set), or Nones if the system has no /proc
+    to tell
+    '''
+    cpu = rss = 0
+    ticks = os.sysconf('SC_CLK_TCK')
+    for process in [pid] + children(pid):
+        try:
+            with open('/proc/%d/stat' % process, encoding='utf-8') as infile:
+                # fields after the parenthesized command name; utime and
+                # stime are the 14th and 15th fields of the whole line
+                fields = infile.read().rpartition(')')[2].split()
+            with open('/proc/%d/status' % process,
+                      encoding='utf-8') as infile:
+                peak = [line.split()[1] for line in infile
+                        if line.startswith('VmHWM:')]
+        except FileNotFoundError:
+            if process == pid:
+                return None, None
+            continue  # child exited meanwhile
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(peak[0]) * 1024
+    return cpu, rss
+
+def children(pid):
+    '''
+    ids of processes whose parent is `pid`
+    '''
+    found = []
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        try:
+            with open('/proc/%s/stat' % entry, encoding='utf-8') as infile:
+                if int(infile.read().rpartition(')')[2].split()[1]) == pid:
+                    found.append(int(entry))
+        except (ValueError, OSError):  # not a process, or already gone
+            continue
+    return found
+
+def percentile(ordered, fraction):
+    '''
+    nearest-rank percentile of already sorted values
+
+    >>> percentile([1, 2, 3, 4], .5), percentile([1, 2, 3, 4], .99)
+    (2, 4)
+    >>> percentile([], .5) is None
+    True
+    '''
+    if not ordered:
+        return None
+    return ordered[max(0, -int(-fraction * len(ordered) // 1) - 1)]
+
+def run(clients, rate, seconds=SECONDS, typists=TYPISTS, port=PORT):
+    '''
+    connect `clients` editors, have some type at `rate` keys per second,
+    and measure how long each key takes to reach each of them
+    '''
+    # pylint: disable=too-many-locals
+    editors = [Editor(number, port) for number in range(clients)]
+    typing = editors[:max(1, round(clients * typists))]
+    by_key = {editor.key: editor for editor in typing}
+    selector = selectors.DefaultSelector()
+    for editor in editors:
+        selector.register(editor, selectors.EVENT_READ, editor)
+    latencies, delivered = [], 0
+    start = time.perf_counter()
+    due = {editor: start + random.random() / rate for editor in typing}
+    stop = start + seconds
+    while True:
+        now = time.perf_counter()
+        if now >= stop + DRAIN or now >= stop and delivered >= sum(
+                len(editor.typed) for editor in typing) * clients:
+            break
+        for editor, when in due.items():
+            if when <= now < stop:
+                editor.type(len(editor.typed) + 1)
+                due[editor] = when + 1 / rate
+        timeout = min([when for when in due.values() if when < stop] +
+                      [stop + DRAIN]) - now
+        for key, _ in selector.select(max(timeout, 0)):
+            editor = key.data
+            editor.flush()
+            received = time.perf_counter()
+            for opcode, payload in editor.frames():
+                for typed in editor.keys(opcode, payload):
+                    if typed not in by_key:
+                        continue
+                    count = editor.received.get(typed, 0)
+                    editor.received[typed] = count + 1
+                    latencies.append(received - by_key[typed].typed[count])
+                    delivered += 1
+    elapsed = min(time.perf_counter(), stop) - start
+    for editor in editors:
+        selector.unregister(editor)
+        editor.connection.close()
+    sent = sum(len(editor.typed) for editor in typing)
+    latencies.sort()
+    return {
+        'binary': editors[0].binary, 'clients': clients,
+        'typists': len(typing), 'rate': rate,
+        'seconds': elapsed, 'sent': sent, 'delivered': delivered,
+        'lost': sent * clients - delivered,
+        'sent_per_second': sent / elapsed,
+        'delivered_per_second': delivered / elapsed,
+        'latency': {name: percentile(latencies, fraction) for name, fraction
+                    in (('p50', .5), ('p95', .95), ('p99', .99))},
+    }
+
+def main(output='loadtest.json'):
+    '''
+    run every combination of engine, clients, and rate, writing results
+    '''
+    runs = []
+    for engine in ENGINES:
+        for clients in CLIENTS:
+            for rate in RATES:
+                server = serve(engine)
+                try:
+                    before = usage(server.pid)[0]
+                    result = run(clients, rate)
+                    cpu, rss = usage(server.pid)
+                finally:
+                    server.terminate()
+                    server.wait()
+                result.update({
+                    'engine': engine,
+                    'server_cpu_seconds': None if cpu is None else (
+                        cpu - before),
+                    'server_peak_rss': rss,
+                })
+                runs.append(result)
+                print('%-7s %4d editors %5.1f keys/s: %7.1f delivered/s, '
+                      'p50 %s p99 %s, cpu %.2fs, rss %dKiB' % (
+                          engine, clients, rate,
+                          result['delivered_per_second'],
+                          milliseconds(result['latency']['p50']),
+                          milliseconds(result['latency']['p99']),
+                          result['server_cpu_seconds'] or 0,
+                          (rss or 0) // 1024))
+    with open(output, 'w', encoding='utf-8') as outfile:
+        json.dump({'time': time.time(), 'python': sys.version.split()[0],
+                   'runs': runs}, outfile, indent=2)
+        outfile.write('\n')
+
+def milliseconds(seconds):
+    '''
+    seconds as milliseconds, for display
+
+    >>> milliseconds(.0123), milliseconds(None)
+    ('12.30ms', '-')
+    '''
+    return '-' if seconds is None else '%.2fms' % (seconds * 1000)
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    main(*sys.argv[1:])
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+'''
+the `loop` engine: HTTP and every websocket served from a single
+`selectors` event loop, which holds many idle editors in flat memory
+
+each HTTP request is buffered until it's complete, a large upload being
+spooled to a temporary file, and then run through WebSocketHandler as if
+it had come from a socket. a connection that it upgrades stays with the
+loop as a websocket, each message from which goes to `respond`, as it
+would from a handler thread.
+'''
+# pylint: disable=multiple-imports
+import sys, time, socket, logging, selectors
+from io import BytesIO
+from http.client import parse_headers
+from tempfile import SpooledTemporaryFile
+from wsserver import MAXPACKET
+from multipart import SPOOL_SIZE
+from bus import LINKS
+from client import Client, CONNECTIONS, WRITER, MAX_CONNECTIONS, \
+    HTTP_TIMEOUT, HEARTBEAT_TICK, BUFFERSIZE, refuse, ping, heartbeat
+from sessions import evict
+from supervisor import handoff, adopt
+from handlers import WebSocketHandler, BYTES_RECEIVED, answer, \
+    request_length
+from relay import relayed
+
+SELECTOR = None  # set when event loop is running
+BAD_REQUEST = (b'HTTP/1.1 400 Bad Request\r\n'
+               b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+class LoopHandler(WebSocketHandler):
+    '''
+    handle exactly one buffered request on behalf of the event loop
+    '''
+    protocol_version = 'HTTP/1.1'  # as the threaded engine's, for keep-alive
+    upgraded = None  # set to nonce when request was a websocket upgrade
+    session = None  # and to the Session asked for
+    deflate = None  # and to Deflate if compression was negotiated
+    binary = False  # and to True if key events are to be sent as records
+
+    def handle(self):
+        '''
+        only one request at a time, so the loop can see `close_connection`
+        '''
+        # pylint: disable=attribute-defined-outside-init
+        self.close_connection = True
+        self.handle_one_request()
+
+    def upgrade(self, nonce, session, deflate=None, binary=False):
+        '''
+        let the event loop know it now has a websocket connection
+        '''
+        self.upgraded, self.session = nonce, session
+        self.deflate, self.binary = deflate, binary
+
+class Buffered:
+    '''
+    stands in for a socket so that http.server can work on a buffered
+    request, in memory or spooled to a file
+    '''
+    def __init__(self, request):
+        self.rfile = request
+        self.written = bytearray()
+
+    def makefile(self, *args, **kwargs):  # pylint: disable=unused-argument
+        '''
+        http.server only asks for a reader; writes go through `sendall`
+        '''
+        return self.rfile
+
+    def sendall(self, data):
+        '''
+        collect response for the event loop to send
+        '''
+        self.written += data
+
+def loop_serve(address, port, reuse_port=False):
+    '''
+    serve HTTP and all websockets from a single `selectors` event loop
+    '''
+    global SELECTOR  # pylint: disable=global-statement
+    WRITER.selector = SELECTOR = selectors.DefaultSelector()
+    listener = LINKS.listener or socket.create_server(
+        (address, int(port)), reuse_port=reuse_port)
+    listener.setblocking(False)
+    SELECTOR.register(listener, selectors.EVENT_READ)
+    for bus in (LINKS.hub, LINKS.supervisor):
+        if bus is not None:
+            SELECTOR.register(bus, selectors.EVENT_READ)
+    adopt(SELECTOR)
+    logging.info('event loop serving on %s port %s', address, port)
+    beat = time.monotonic() + HEARTBEAT_TICK
+    try:
+        while True:
+            if time.monotonic() >= beat:
+                heartbeat()
+                evict()
+                expire()
+                beat = time.monotonic() + HEARTBEAT_TICK
+            for key, events in SELECTOR.select(beat - time.monotonic()):
+                ready(key, events, listener)
+    except KeyboardInterrupt:
+        logging.info('keyboard interrupt received, exiting')
+        sys.exit(0)
+    finally:
+        SELECTOR.close()
+        listener.close()
+
+def ready(key, events, listener):
+    '''
+    act on one socket the selector found ready: the listening socket, a
+    bus, or a client
+    '''
+    if key.fileobj is listener:
+        accept(listener)
+    elif key.fileobj is LINKS.hub:
+        for fields, body in LINKS.hub.receive():
+            relayed(fields, body)
+    elif key.fileobj is LINKS.supervisor:
+        for fields, _ in LINKS.supervisor.receive():
+            if 'handoff' in fields:
+                handoff()
+    else:
+        client = key.data
+        try:
+            if events & selectors.EVENT_WRITE:
+                client.flush()
+            if events & selectors.EVENT_READ:
+                receive(client)
+        except (StopIteration, OSError) as ended:
+            logging.info('%s closed: %s', client, ended)
+            hangup(client)
+        except Exception:  # pylint: disable=broad-except
+            # whatever one client sent, it mustn't stop the loop for all
+            logging.exception('%s failed, hanging up', client)
+            hangup(client)
+
+def accept(listener):
+    '''
+    take new connection from the listening socket
+    '''
+    try:
+        connection, address = listener.accept()
+    except BlockingIOError:  # someone else got it first
+        return
+    if sum(isinstance(key.data, Client)
+           for key in SELECTOR.get_map().values()) >= MAX_CONNECTIONS:
+        refuse(connection, address)
+        connection.close()
+        return
+    connection.setblocking(False)
+    client = Client(connection, address)
+    SELECTOR.register(client, selectors.EVENT_READ, client)
+    logging.debug('accepted connection from %s', address)
+
+def expire(now=None):
+    '''
+    event loop's HTTP_TIMEOUT: hang up on clients that sent part of a
+    request, or kept the connection alive, and then went quiet
+    '''
+    now = now or time.monotonic()
+    for key in list(SELECTOR.get_map().values()):
+        client = key.data
+        if isinstance(client, Client) and not client.websocket and (
+                now - client.active > HTTP_TIMEOUT):
+            logging.info('%s timed out', client)
+            hangup(client)
+
+def receive(client):
+    '''
+    read whatever is available and act on any complete requests or messages
+    '''
+    if not read(client):
+        return
+    while client.received and not client.websocket:
+        if not serve_request(client):
+            break
+    if client.websocket:
+        if client.received:  # frames which arrived along with the upgrade
+            client.decoder.feed(client.received)
+            BYTES_RECEIVED.add(len(client.received))
+            client.received.clear()
+        answer(client)
+
+def read(client):
+    '''
+    read whatever is available: into the decoder of a websocket, or the
+    buffered request of an HTTP connection
+
+    returns False if nothing was, after all
+    '''
+    try:
+        if client.websocket:
+            received = client.decoder.recv_into(client.connection)
+            if not received:
+                raise StopIteration('remote end closed')
+            BYTES_RECEIVED.add(received)
+        else:
+            data = client.connection.recv(BUFFERSIZE)
+            if not data:
+                raise StopIteration('remote end closed')
+            client.received += data
+            client.active = time.monotonic()
+    except BlockingIOError:
+        return False
+    except BufferError as error:
+        raise StopIteration(error) from error
+    return True
+
+def serve_request(client):
+    '''
+    run http.server on one complete buffered request
+
+    returns False if the request has not yet been completely received.
+    a request whose body is still arriving is spooled to a temporary file,
+    so a large upload doesn't have to fit in memory.
+    '''
+    if client.spool is not None:
+        count = min(client.pending, len(client.received))
+        client.spool.write(client.received[:count])
+        del client.received[:count]
+        client.pending -= count
+        if client.pending:
+            return False
+        request, client.spool = client.spool, None
+        request.seek(0)
+    else:
+        end = client.received.find(b'\r\n\r\n')
+        if end == -1:
+            if len(client.received) > MAXPACKET:
+                raise StopIteration('request headers too long')
+            return False
+        end += 4
+        headers = parse_headers(BytesIO(client.received[
+            client.received.find(b'\r\n') + 2:end]))
+        length = request_length(headers)
+        if length is None:
+            client.send(BAD_REQUEST)
+            raise StopIteration('bad Content-Length')
+        end += length
+        if len(client.received) < end:
+            # closed by http.server once handled, or hangup() if cut off
+            # pylint: disable=consider-using-with
+            client.spool = SpooledTemporaryFile(SPOOL_SIZE)
+            client.pending = end
+            return serve_request(client)
+        request = BytesIO(bytes(client.received[:end]))
+        del client.received[:end]
+    buffered = Buffered(request)
+    http = LoopHandler(buffered, client.address, SELECTOR)
+    client.send(buffered.written)
+    if http.upgraded:
+        logging.debug('websocket %s opened by %s', http.upgraded, client)
+        client.upgrade(http.session, http.deflate, http.binary)
+        ping(client)  # send a ping to break the ice
+    elif http.close_connection:
+        raise StopIteration('HTTP connection closed')
+    return True
+
+def hangup(client):
+    '''
+    forget about client, and close its socket
+    '''
+    if client.session is not None:
+        client.session.clients.discard(client)
+    CONNECTIONS.discard(client)
+    client.closed = True
+    SELECTOR.unregister(client)
+    if client.deflate is not None:
+        logging.info('%s compression: %s', client, client.deflate)
+    if client.spool is not None:  # upload was cut off
+        client.spool.close()
+    try:  # ignore failure on shutdown
+        client.connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    client.connection.close()
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+'''
+counters and latency histograms, cheap enough to update on every frame
+
+each thread adds to its own shard of the counts, so nothing is locked
+while counting; the shards are only summed when the metrics are rendered,
+as plain text in the Prometheus exposition format. shards of threads that
+have exited are folded into one whenever a thread starts counting, so a
+server that is never scraped doesn't keep one for every thread it had
+'''
+import threading
+from bisect import bisect_left
+
+# seconds, from a fast keystroke to a stalled phone
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                   .1, .25, .5, 1, 2.5, 5)
+# pylint: disable=consider-using-f-string
+
+class Registry:
+    '''
+    all metrics, and the per-thread shards holding their counts
+
+    >>> registry = Registry()
+    >>> frames = Counter('frames_total', 'frames seen', registry)
+    >>> frames.add()
+    >>> thread = threading.Thread(target=frames.add, args=(2,))
+    >>> thread.start(); thread.join()
+    >>> print(registry.render(), end='')
+    # HELP frames_total frames seen
+    # TYPE frames_total counter
+    frames_total 3
+    >>> for _ in range(3):
+    ...     thread = threading.Thread(target=frames.add)
+    ...     thread.start(); thread.join()
+    >>> len(registry.shards), registry.totals()
+    (2, [6])
+    '''
+    def __init__(self):
+        self.metrics = []  # in the order registered
+        self.size = 0  # slots allocated in each shard
+        self.lock = threading.Lock()  # for new metrics and threads only
+        self.shards = {}  # counts by thread
+        self.retired = []  # counts from threads that have exited
+        self.local = threading.local()
+
+    def allocate(self, metric, count):
+        '''
+        register metric, returning first of `count` slots reserved for it
+        '''
+        with self.lock:
+            start, self.size = self.size, self.size + count
+            for shard in [self.retired, *self.shards.values()]:
+                shard.extend([0] * count)
+            self.metrics.append(metric)
+        return start
+
+    def shard(self):
+        '''
+        this thread's counts
+        '''
+        try:
+            return self.local.shard
+        except AttributeError:
+            with self.lock:
+                self.retire()
+                shard = self.local.shard = [0] * self.size
+                self.shards[threading.current_thread()] = shard
+            return shard
+
+    def retire(self):
+        '''
+        fold the counts of exited threads into `retired`
+
+        must be called with the lock held
+        '''
+        for thread in [thread for thread in self.shards
+                       if not thread.is_alive()]:
+            for index, count in enumerate(self.shards.pop(thread)):
+                self.retired[index] += count
+
+    def totals(self):
+        '''
+        counts summed over all threads, folding in those of exited threads
+        '''
+        with self.lock:
+            self.retire()
+            return [sum(counts) for counts in zip(
+                self.retired, *self.shards.values())]
+
+    def render(self):
+        '''
+        all metrics as text
+        '''
+        totals, lines = self.totals(), []
+        for metric in self.metrics:
+            lines.extend(metric.render(totals))
+        return ''.join(line + '\n' for line in lines)
+
+REGISTRY = Registry()
+
+class Counter:
+    '''
+    number that only goes up, such as frames or bytes sent
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, description, registry=REGISTRY):
+        self.name, self.description = name, description
+        self.registry = registry
+        self.slot = registry.allocate(self, 1)
+
+    def add(self, amount=1):
+        '''
+        count `amount` more
+        '''
+        self.registry.shard()[self.slot] += amount
+
+    def header(self):
+        '''
+        HELP and TYPE lines
+        '''
+        return ['# HELP %s %s' % (self.name, self.description),
+                '# TYPE %s %s' % (self.name, self.kind)]
+
+    def render(self, totals):
+        '''
+        lines of text for this metric
+        '''
+        return self.header() + ['%s %s' % (self.name, number(
+            totals[self.slot]))]
+
+class Histogram(Counter):
+    '''
+    counts of values, such as latencies, falling into fixed buckets
+
+    >>> registry = Registry()
+    >>> latency = Histogram('latency_seconds', 'latency', registry, (.1, 1))
+    >>> for seconds in .05, .5, .5, 2:
+    ...     latency.observe(seconds)
+    >>> print(registry.render(), end='')
+    # HELP latency_seconds latency
+    # TYPE latency_seconds histogram
+    latency_seconds_bucket{le="0.1"} 1
+    latency_seconds_bucket{le="1"} 3
+    latency_seconds_bucket{le="+Inf"} 4
+    latency_seconds_sum 3.05
+    latency_seconds_count 4
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, description, registry=REGISTRY,
+                 buckets=LATENCY_BUCKETS):
+        # pylint: disable=super-init-not-called
+        self.name, self.description = name, description
+        self.registry = registry
+        self.buckets = tuple(sorted(buckets))
+        # one count per bucket, one for values beyond them, and the sum
+        self.slot = registry.allocate(self, len(self.buckets) + 2)
+
+    def observe(self, value):
+        '''
+        count value in its bucket, and add it to the sum
+        '''
+        shard = self.registry.shard()
+        shard[self.slot + bisect_left(self.buckets, value)] += 1
+        shard[self.slot + len(self.buckets) + 1] += value
+
+    def render(self, totals):
+        lines, count = self.header(), 0
+        slots = totals[self.slot:self.slot + len(self.buckets) + 2]
+        for bucket, observed in zip(self.buckets + ('+Inf',), slots):
+            count += observed
+            lines.append('%s_bucket{le="%s"} %d' % (
+                self.name, number(bucket), count))
+        lines.append('%s_sum %s' % (self.name, number(slots[-1])))
+        lines.append('%s_count %d' % (self.name, count))
+        return lines
+
+class Gauge(Counter):
+    '''
+    value taken when rendered, such as clients connected
+
+    `function` returns a number, or if `label` is given, a dict of numbers
+    by that label's values; or by tuples of values, if `label` is a tuple
+
+    >>> registry = Registry()
+    >>> _ = Gauge('queued', 'frames queued', registry,
+    ...           lambda: {'a': 1, 'b"': 2}, 'client')
+    >>> _ = Gauge('rtt', 'round trips', registry,
+    ...           lambda: {('a', '+Inf'): 3}, ('client', 'le'))
+    >>> print(registry.render(), end='')
+    # HELP queued frames queued
+    # TYPE queued gauge
+    queued{client="a"} 1
+    queued{client="b\\""} 2
+    # HELP rtt round trips
+    # TYPE rtt gauge
+    rtt{client="a",le="+Inf"} 3
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, description, registry=REGISTRY, function=None,
+                 label=None):
+        # pylint: disable=super-init-not-called
+        self.name, self.description = name, description
+        self.function, self.label = function, label
+        self.slot = registry.allocate(self, 0)
+
+    def render(self, totals):
+        values = self.function()
+        if self.label is None:
+            return self.header() + ['%s %s' % (self.name, number(values))]
+        if isinstance(self.label, tuple):
+            labels = self.label
+        else:
+            labels = (self.label,)
+            values = {(key,): value for key, value in values.items()}
+        return self.header() + ['%s{%s} %s' % (self.name, ','.join(
+            '%s="%s"' % (label, str(key).replace('\\', r'\\').replace(
+                '"', r'\"')) for label, key in zip(labels, keys)
+        ), number(value)) for keys, value in values.items()]
+
+def number(value):
+    '''
+    value as text, without a needless fractional part
+
+    >>> number(3.0), number(.25), number('+Inf')
+    ('3', '0.25', '+Inf')
+    '''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
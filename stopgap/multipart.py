@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+'''
+uploads: multipart/form-data bodies, read a chunk at a time
+
+each part is spooled to a temporary file as it arrives, so a large file
+never has to fit in memory, nor the whole body be read before parsing
+'''
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from http.client import parse_headers
+
+UPLOAD_CHUNK = 65536  # bytes read at a time from a multipart/form-data POST
+SPOOL_SIZE = 1048576  # uploaded parts larger than this go to a temporary file
+MAX_PART_HEADERS = 16384  # bytes
+# pylint: disable=consider-using-f-string
+
+def read_multipart(rfile, boundary, length, chunksize=UPLOAD_CHUNK):
+    r'''
+    read multipart/form-data body of given length, a chunk at a time
+
+    returns list of (headers, file) pairs, one for each part, with the
+    contents of each part spooled to a temporary file and rewound
+
+    >>> body = (b'--xyz\r\nContent-Disposition: form-data; name="a"\r\n\r\n'
+    ...         b'one\r\n--xyz\r\nContent-Disposition: form-data; name="b"; '
+    ...         b'filename="b.txt"\r\n\r\nline\r\n--xy\r\n\r\n--xyz--\r\n')
+    >>> for headers, part in read_multipart(BytesIO(body), b'xyz',
+    ...                                     len(body), chunksize=3):
+    ...     print(headers.get_filename(), part.read())
+    None b'one'
+    b.txt b'line\r\n--xy\r\n'
+    >>> read_multipart(BytesIO(body), b'xyz', len(body) - 10)
+    Traceback (most recent call last):
+      ...
+    ValueError: multipart body ended before closing boundary
+    '''
+    reader = Multipart(boundary)
+    try:
+        while reader.state != 'epilogue':
+            if reader.advance():
+                continue
+            if length <= 0:
+                raise ValueError(
+                    'multipart body ended before closing boundary')
+            data = rfile.read(min(chunksize, length))
+            if not data:
+                raise ValueError('connection closed during upload')
+            length -= len(data)
+            reader.buffer += data
+        while length > 0:  # discard epilogue
+            data = rfile.read(min(chunksize, length))
+            if not data:
+                break
+            length -= len(data)
+    except ValueError:
+        reader.close()
+        raise
+    return reader.parts
+
+class Multipart:
+    r'''
+    state of reading a multipart/form-data body: what has been read but
+    not yet dealt with, and the parts found so far
+
+    >>> reader = Multipart(b'xyz')
+    >>> reader.buffer += b'--xyz\r\n\r\nbare\r\n--xyz--'
+    >>> while reader.advance():
+    ...     pass
+    >>> reader.state, [part.read() for headers, part in reader.parts]
+    ('epilogue', [b'bare'])
+    '''
+    def __init__(self, boundary):
+        self.delimiter = b'\r\n--' + boundary
+        self.buffer = bytearray(b'\r\n')  # so first boundary looks the same
+        self.parts, self.part, self.state = [], None, 'preamble'
+
+    def advance(self):
+        '''
+        deal with what the buffer holds, as far as the current state goes
+
+        returns True if that moved on to another state, False if more
+        must be read first
+        '''
+        if self.state in ('preamble', 'body'):
+            return self.text()
+        if self.state == 'boundary':
+            return self.boundary()
+        return self.headers()
+
+    def text(self):
+        '''
+        preamble, thrown away, or body of a part, spooled, up to the next
+        delimiter
+        '''
+        index = self.buffer.find(self.delimiter)
+        if index == -1:
+            # keep what could be the start of a delimiter
+            index = max(len(self.buffer) - len(self.delimiter) + 1, 0)
+        if self.part is not None:
+            self.part.write(self.buffer[:index])
+        del self.buffer[:index]
+        if not self.buffer.startswith(self.delimiter):
+            return False
+        del self.buffer[:len(self.delimiter)]
+        self.state = 'boundary'
+        return True
+
+    def boundary(self):
+        '''
+        what follows a delimiter: the end of the body, or another part
+        '''
+        if len(self.buffer) < 2:
+            return False
+        if self.part is not None:
+            self.part.seek(0)
+            self.part = None
+        if self.buffer.startswith(b'--'):
+            self.state = 'epilogue'
+            return True
+        if not self.buffer.startswith(b'\r\n'):
+            raise ValueError('garbage after boundary')
+        del self.buffer[:2]
+        self.state = 'headers'
+        return True
+
+    def headers(self):
+        '''
+        headers of a part, once all are in, starting its spooled body
+        '''
+        if self.buffer.startswith(b'\r\n'):  # part without headers
+            end = 2
+        else:
+            end = self.buffer.find(b'\r\n\r\n') + 4
+            if end < 4:
+                if len(self.buffer) > MAX_PART_HEADERS:
+                    raise ValueError('part headers too long')
+                return False
+        headers = parse_headers(BytesIO(bytes(self.buffer[:end])))
+        del self.buffer[:end]
+        # closed by uploaded_file(), or by close() if the upload fails
+        # pylint: disable=consider-using-with
+        self.part = SpooledTemporaryFile(SPOOL_SIZE)
+        self.parts.append((headers, self.part))
+        self.state = 'body'
+        return True
+
+    def close(self):
+        '''
+        discard every part, the upload having failed
+        '''
+        for _, part in self.parts:
+            part.close()
+
+def uploaded_file(parts):
+    '''
+    (headers, file) of the first part that is a file, closing the others
+
+    headers are as parsed, so `headers.get_filename()` works
+
+    raises ValueError if there is no such part
+    '''
+    upload = None
+    for headers, part in parts:
+        if upload is None and headers.get_filename() is not None:
+            upload = headers, part
+        else:
+            part.close()
+    if upload is None:
+        raise ValueError('no file among %d parts uploaded' % len(parts))
+    return upload
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+'''
+what the hub and its workers do with each other's messages
+
+with WORKERS > 1, the process started forks that many workers, all
+accepting connections on the same port, and becomes their hub. workers
+pass it key events and uploads, each over a Bus of its own; the hub
+sequences, applies and journals them, and relays each to every worker in
+the same order, so that every worker's copy of a session stays the same
+as the hub's.
+'''
+import os, logging  # pylint: disable=multiple-imports
+from bus import LINKS
+from sessions import SESSIONS, SESSIONS_LOCK, Event, opened, sequenced, \
+    restore, broadcast, suggest
+from transfer import load
+from handlers import greet
+
+def sequence(buses, bus, fields, body):
+    '''
+    hub's handling of one message from a worker's `bus`
+    '''
+    if 'open' in fields:
+        session = opened(fields['open'])
+        session.workers.add(bus.worker)
+        with session.sequencer.lock:
+            bus.post({'opened': session.name,
+                      'serial': session.sequencer.serial,
+                      'caret': session.document.caret,
+                      'filename': session.edit_file['name']},
+                     str(session.document).encode())
+        return
+    if 'close' in fields:
+        release(fields['close'], bus.worker)
+        return
+    session = opened(fields.get('session', ''))
+    with session.sequencer.lock:
+        if 'key' in fields:
+            event = sequenced(session, Event(
+                fields['key'], fields['origin'], fields['echo']),
+                fields['sent'])
+            if event is None:
+                return
+            fields = dict(fields, key=event.message, worker=bus.worker)
+            body = b''
+        elif 'load' in fields:
+            session.edit_file['name'] = fields['load']
+            load(session, body)
+            fields = dict(fields, serial=session.sequencer.serial)
+        else:
+            logging.warning('unknown message %s from %s', fields, bus)
+            return
+        for worker in buses:
+            try:
+                worker.post(fields, body)
+            except OSError as failed:  # replaced when the hub sees EOF
+                logging.error('cannot relay to %s: %s', worker, failed)
+
+def release(name, worker):
+    '''
+    hub's note that a worker no longer has a copy of a session, closing
+    it when no worker does
+    '''
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(name)
+        if not name or session is None:
+            return
+        session.workers.discard(worker)
+        if session.workers:
+            return
+        del SESSIONS[name]
+    logging.info('closing %s', session)
+    session.close()
+
+def relayed(fields, body):
+    '''
+    worker's handling of one message relayed by the hub
+
+    messages for sessions this worker has no copy of are ignored
+    '''
+    if 'opened' in fields:
+        session = SESSIONS.get(fields['opened'])
+        if session is None or session.ready:
+            return
+        with session.sequencer.lock:
+            restore(session, fields, body.decode())
+            session.ready = True
+            waiting, session.waiting = session.waiting, []
+            for client, args in waiting:
+                greet(client, args)
+        return
+    session = SESSIONS.get(fields.get('session', ''))
+    if session is None or not session.ready:
+        return
+    with session.sequencer.lock:
+        if 'key' in fields:
+            message = fields['key']
+            event = session.sequencer.stamp(Event(
+                message, fields['origin'], fields['echo']),
+                serial=message['serial'])
+            session.document.apply(message)
+            sender = None
+            if not fields['echo'] and fields['worker'] == LINKS.hub.worker:
+                sender = next((client for client in list(session.clients)
+                               if id(client) == fields['sender']), None)
+            broadcast(session, event, sender)
+            suggest(session)
+        elif 'load' in fields:
+            session.edit_file['name'] = fields['load']
+            load(session, body, fields['serial'])
+
+def listen():
+    '''
+    threaded engine's reader of what the hub relays
+    '''
+    try:
+        while True:
+            for fields, body in LINKS.hub.receive():
+                relayed(fields, body)
+    except (EOFError, OSError) as ended:
+        logging.info('worker %d exiting: %s', LINKS.hub.worker, ended)
+        os._exit(1)  # pylint: disable=protected-access
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+'''
+replay key events from a keylog against a running stopgap.py
+
+    python3 replay.py [DIRECTORY [FROM [TO]]]
+
+sends the key events logged in DIRECTORY (default SAVE_DIR) from FROM up
+to TO (as for keylog.py) to the server, as one editor typing them all,
+then reports how long they took to send, and for the server to echo
+them back. the environment sets where and how:
+
+LOCAL, PORT: the server, as for stopgap.py
+REPLAY_SESSION: session to type into, default the unnamed one
+REPLAY_SPEED: 1 (the default) to keep the original timing, 2 for twice
+  as fast, and so on; 0 for as fast as the server will take them
+'''
+# pylint: disable=multiple-imports
+import sys, os, time, logging
+from urllib.parse import quote
+from keylog import Reader, RECORD, TIME, KEY_RECORD, KEY_ECHO
+from loadtest import Editor
+
+ADDRESS = os.getenv('LOCAL') or '127.0.0.1'
+PORT = int(os.getenv('PORT') or 8000)
+SESSION = os.getenv('REPLAY_SESSION') or ''
+SPEED = float(os.getenv('REPLAY_SPEED') or 1)
+DRAIN = 10  # seconds to wait for echoes after the last event is sent
+# pylint: disable=consider-using-f-string
+
+def replay(directory, start=None, end=None):
+    '''
+    send the logged events to the server, returning (events sent, seconds
+    to send them, events echoed, seconds until the last echo came back)
+
+    the server takes each editor's events in order, so once the last one
+    to be echoed has come back, it has taken all of them
+    '''
+    editor = Editor(0, PORT, ADDRESS, '/?session=%s' % quote(SESSION),
+                    origin='replay%d' % os.getpid())
+    echoes = {'count': 0, 'latest': 0}  # echoed, and latest `sent` of them
+    began = time.perf_counter()
+    with Reader(directory) as log:
+        with log.records(*log.span(start, end)) as records:
+            sent, final = send(editor, records, echoes, began)
+    sending = time.perf_counter() - began
+    deadline = time.monotonic() + DRAIN
+    while echoes['latest'] < final and time.monotonic() < deadline:
+        receive(editor, echoes)
+        time.sleep(.001)
+    if echoes['latest'] < final:
+        logging.warning('gave up waiting for echoes after %d seconds', DRAIN)
+    return sent, sending, echoes['count'], time.perf_counter() - began
+
+def send(editor, records, echoes, began):
+    '''
+    send each of the logged records, when it's due, numbering them anew;
+    returns how many were sent, and the number of the last to be echoed
+    '''
+    final = sent = 0
+    logged = TIME.unpack_from(records)[0] if records else 0
+    for offset in range(0, len(records), RECORD.size):
+        sent += 1
+        record = bytearray(records[offset + TIME.size:offset + RECORD.size])
+        KEY_RECORD.pack_into(record, 0, 0, sent,
+                             *KEY_RECORD.unpack_from(record)[2:])
+        if SPEED:
+            due = (TIME.unpack_from(records, offset)[0] - logged) / SPEED
+            while time.perf_counter() - began < due:
+                receive(editor, echoes)
+                time.sleep(min(due - (time.perf_counter() - began), .01))
+        if record[8] & KEY_ECHO:
+            final = sent
+        editor.send(record, 'binary')
+        receive(editor, echoes)
+    return sent, final
+
+def receive(editor, echoes):
+    '''
+    take what the server has sent, counting the key events echoed
+    '''
+    editor.flush()
+    for opcode, payload in editor.frames():
+        if opcode == 'binary' and payload[:1] < b'\x80':
+            for offset in range(0, len(payload), KEY_RECORD.size):
+                sent = KEY_RECORD.unpack_from(payload, offset)[1]
+                echoes['count'] += 1
+                echoes['latest'] = max(echoes['latest'], sent)
+        else:
+            list(editor.keys(opcode, payload))  # pings, document chunks
+
+def main(directory=None, start=None, end=None):
+    '''
+    replay, and report
+    '''
+    sent, sending, echoed, elapsed = replay(
+        directory or os.getenv('SAVE_DIR') or 'saved', start, end)
+    print('%d events sent in %.3f seconds (%.0f per second)' % (
+        sent, sending, sent / (sending or 1e-9)))
+    print('%d echoed in %.3f seconds (%.0f per second)' % (
+        echoed, elapsed, echoed / (elapsed or 1e-9)))
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    main(*sys.argv[1:])
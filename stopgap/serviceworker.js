@@ -0,0 +1,35 @@
+// keeps the editor page on the device, so only the WebSocket has to go
+// over the network on later loads. stopgap.py fills in VERSION, a hash of
+// the page and everything in it, and MANIFEST, the files to keep; when any
+// of them changes, so does this script, and the browser reinstalls it.
+const VERSION = "unversioned";
+const MANIFEST = ["stopgap.html"];
+self.addEventListener("install", function(event) {
+    event.waitUntil(caches.open(VERSION).then(function(cache) {
+        return cache.addAll(MANIFEST);
+    }).then(function() {
+        return self.skipWaiting();
+    }));
+});
+self.addEventListener("activate", function(event) {
+    event.waitUntil(caches.keys().then(function(names) {
+        return Promise.all(names.filter(function(name) {
+            return name != VERSION;
+        }).map(function(name) {
+            return caches.delete(name);
+        }));
+    }).then(function() {
+        return self.clients.claim();
+    }));
+});
+self.addEventListener("fetch", function(event) {
+    const name = new URL(event.request.url).pathname.split("/").pop();
+    if (event.request.method != "GET" || !MANIFEST.includes(name)) return;
+    // `?session=NAME` makes no difference to the page itself
+    event.respondWith(caches.open(VERSION).then(function(cache) {
+        return cache.match(name, {ignoreSearch: true});
+    }).then(function(cached) {
+        return cached || fetch(event.request);
+    }));
+});
+// vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
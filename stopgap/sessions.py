@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+'''
+editing sessions: each one's editors, document and journal, and the key
+events that made it
+
+every key event gets the next serial number from its session's
+Sequencer, which keeps the latest for editors that reconnect, and is
+applied to the session's copy of the document, journaled, and queued for
+its editors, framed once for each encoding. a session nobody has been
+connected to for SESSION_IDLE seconds is closed, and reopened from its
+journal when next asked for.
+'''
+# pylint: disable=multiple-imports
+import os, re, time, struct, logging
+from urllib.parse import parse_qs, urlsplit
+from threading import Lock, RLock
+from document import Document
+from chords import Chord
+from suggest import Index, wordlist, words, prefix, PREFIX_MAX, WORDLIST
+from journal import Journal, SAVE_DIR
+from keylog import KeyLog, clipped, encode_key
+from bus import LINKS
+from wsserver import package, pack
+from client import CONNECTIONS, control
+from metrics import Histogram, Gauge
+
+REPLAY_SIZE = 4096  # key events kept for clients resuming after a dropout
+# key events go as KEY_RECORDs, laid out in keylog.py. serials stay below
+# 2**31 while transfer ids are above it, so a frame of records is never
+# mistaken for a chunk.
+SERIAL = struct.Struct('>I')  # at start of record, restamped in place
+# with SUGGESTIONS=N, editors are sent up to N completions of the word
+# being typed after each key, from WORDLIST and the document's own words
+SUGGESTIONS = int(os.getenv('SUGGESTIONS') or 0)
+# every key event sequenced also goes into a binary log beside the journal,
+# which keylog.py analyzes and replay.py plays back, unless KEYLOG=0
+KEYLOGGING = (os.getenv('KEYLOG') or '1') != '0'
+WORDS = None  # Index of WORDLIST, copied for each session, once loaded
+# each session (`?session=NAME` on the page's URL) has its own editors and
+# document, journaled in SAVE_DIR/sessions/NAME; the unnamed session's are
+# in SAVE_DIR itself, and it is never evicted
+SESSIONS = {}  # by name
+SESSIONS_LOCK = Lock()
+SESSION_NAME = re.compile(r'[A-Za-z0-9_-]{0,64}')
+SESSION_IDLE = float(os.getenv('SESSION_IDLE') or 600)  # seconds
+FANOUT_SECONDS = Histogram('stopgap_fanout_seconds',
+                           'time to queue each key event for all editors')
+SUGGEST_SECONDS = Histogram('stopgap_suggest_seconds',
+                            'time to find completions after each key event')
+Gauge('stopgap_sessions', 'sessions open', function=lambda: len(SESSIONS))
+Gauge('stopgap_clients', 'editors connected',
+      function=lambda: len(editors()))
+Gauge('stopgap_queue_frames', 'frames waiting to be sent, by client',
+      function=lambda: {client.label(): len(client.queue)
+                        for client in editors()}, label='client')
+Gauge('stopgap_queue_bytes', 'bytes waiting to be sent, by client',
+      function=lambda: {client.label(): client.queued
+                        for client in editors()}, label='client')
+# pylint: disable=consider-using-f-string
+
+class Event:
+    '''
+    stamped key event, encoded as JSON or as a record only once needed
+    '''
+    __slots__ = ('message', 'origin', 'echo', 'encoded')
+
+    def __init__(self, message, origin=None, echo=True, record=None):
+        self.message = message
+        self.origin = origin  # page it came from
+        self.echo = echo  # whether it goes back to that page too
+        self.encoded = [None, record]  # JSON, and record if possible
+
+    def json(self):
+        '''
+        message as JSON
+        '''
+        if self.encoded[0] is None:
+            self.encoded[0] = pack(self.message)
+        return self.encoded[0]
+
+    def record(self):
+        '''
+        message as binary record, or None if it won't fit in one
+        '''
+        if self.encoded[1] is None:
+            self.encoded[1] = encode_key(self.message) or False
+        return self.encoded[1] or None
+
+    def logged(self, sent):
+        '''
+        record for the key log, which must be made before the event is
+        sent: the record it came in as, if it did; otherwise one with its
+        `sent` count and `echo` too, its key clipped to fit, or None if of a
+        keytype that has no code
+
+        >>> from keylog import decode_key
+        >>> event = Event({'key': 'Escape' * 4, 'serial': 1}, echo=False)
+        >>> decode_key(event.logged(3))[0]['key']
+        'EscapeEscapeEscapeEsc'
+        '''
+        return self.encoded[1] or encode_key(dict(
+            self.message, key=clipped(self.message.get('key', '')),
+            sent=sent, echo=self.echo))
+
+class Sequencer:
+    '''
+    serial numbers for key events from all clients, and recent history
+    '''
+    def __init__(self, size=REPLAY_SIZE):
+        self.lock = RLock()  # also held while broadcasting, to keep order
+        self.serial = 0
+        self.start = 0  # events up to here don't apply to current document
+        self.size = size
+        self.ring = [None] * size  # Events by serial
+        self.sent = {}  # latest count of messages sent, by origin
+
+    def stamp(self, event, sent=None, serial=None):
+        '''
+        give Event the next serial number, and remember it for replay
+
+        if the event arrived as a binary record, its serial is set there
+        too, so it can be sent on as it is. a worker process passes the
+        `serial` the hub already gave it instead.
+
+        returns the event, or None if it is a duplicate: one whose `sent`
+        count is no greater than one seen before from its origin
+
+        >>> from keylog import decode_key
+        >>> sequencer = Sequencer(2)
+        >>> sequencer.stamp(Event({'key': 'a'}, 'page'), 1).json()
+        b'{"key":"a","serial":1}'
+        >>> sequencer.stamp(Event({'key': 'a'}, 'page'), 1) is None
+        True
+        >>> record = bytearray(encode_key({'key': 'b', 'direction': 'up'}))
+        >>> _ = sequencer.stamp(Event(decode_key(record)[0], record=record))
+        >>> decode_key(record)[0]
+        {'key': 'b', 'direction': 'up', 'serial': 2}
+        >>> sequencer.stamp(Event({'key': 'c'}), serial=5).json()
+        b'{"key":"c","serial":5}'
+        '''
+        with self.lock:
+            if event.origin is not None and sent is not None:
+                if sent <= self.sent.get(event.origin, 0):
+                    return None
+                self.sent[event.origin] = sent
+            # serial numbers must be nonzero, so increment first.
+            self.serial = self.serial + 1 if serial is None else serial
+            event.message['serial'] = self.serial
+            if event.encoded[1] is not None:
+                SERIAL.pack_into(event.encoded[1], 0, self.serial)
+            self.ring[self.serial % self.size] = event
+            return event
+
+    def replay(self, since, origin=None):
+        '''
+        Events after serial number `since`, or None if some have already
+        been forgotten, or the server has restarted since the client saw
+        serial `since`
+
+        events which were not echoed to `origin` originally are skipped
+
+        >>> sequencer = Sequencer(2)
+        >>> for key in 'abc':
+        ...     _ = sequencer.stamp(Event({'key': key}, 'page', key != 'c'))
+        >>> [event.json() for event in sequencer.replay(1)]
+        [b'{"key":"b","serial":2}', b'{"key":"c","serial":3}']
+        >>> [event.json() for event in sequencer.replay(1, 'page')]
+        [b'{"key":"b","serial":2}']
+        >>> sequencer.replay(0) is None
+        True
+        >>> sequencer.replay(4) is None
+        True
+        >>> sequencer.restart()
+        >>> sequencer.replay(2) is None, sequencer.replay(3)
+        (True, [])
+        '''
+        with self.lock:
+            if since < self.start or not 0 <= self.serial - since <= self.size:
+                return None
+            return [
+                event for event in (
+                    self.ring[serial % self.size]
+                    for serial in range(max(since, 0) + 1, self.serial + 1)
+                )
+                if event.echo or origin is None or event.origin != origin
+            ]
+
+    def restart(self):
+        '''
+        forget history, because the document has been replaced
+        '''
+        with self.lock:
+            self.start = self.serial
+
+class Session:
+    '''
+    one editing setup: its editors, its document, and the key events that
+    made it
+
+    in a worker process, a session other than the default one is a copy
+    of the hub's, and isn't `ready` until the hub has sent it over
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, name=''):
+        self.name = name
+        self.clients = set()  # editors
+        self.sequencer = Sequencer()  # its lock guards everything here
+        self.document = Document()
+        self.edit_file = {  # file from `open` menu
+            'headers': None,
+            'body': None,
+            'name': 'untitled.txt'  # as saved in the journal's FILES
+        }
+        self.transfers = {}  # recent transfers by id, to resume them
+        self.journal = None  # only in the hub, or the only process
+        self.keylog = None  # likewise, if KEYLOGGING
+        self.active = time.monotonic()  # last used, for eviction
+        self.ready = True
+        self.waiting = []  # (client, greeting) until ready
+        self.workers = set()  # in the hub, workers with copies of it
+        self.chords = {}  # Chord by origin, if the server resolves them
+        self.index = None  # words to suggest, made when first needed
+        self.typing = ('', 0)  # word before the caret, and where that was
+        self.suggested = None  # (prefix, completions) editors last got
+        self.closed = False
+
+    def __repr__(self):
+        return '<Session %r>' % self.name
+
+    def open(self):
+        '''
+        recover the session from its journal, and keep journaling it
+        '''
+        self.journal = Journal(os.path.join(SAVE_DIR, 'sessions', self.name)
+                               if self.name else SAVE_DIR)
+        recover(self)
+        self.start()
+
+    def start(self):
+        '''
+        start journaling, and key logging unless KEYLOG=0
+        '''
+        if KEYLOGGING:
+            self.keylog = KeyLog(self.journal.directory)
+            self.keylog.open()
+            self.journal.keylog = self.keylog
+        self.journal.start()
+
+    def close(self):
+        '''
+        snapshot the session and stop journaling it, if this process was
+        '''
+        with self.sequencer.lock:
+            self.closed = True
+            if self.journal is not None:
+                checkpoint(self)
+                self.journal.close()
+            if self.keylog is not None:
+                self.keylog.close()
+            if self.edit_file['body'] is not None:
+                self.edit_file['body'].close()
+
+def session_name(path):
+    '''
+    name of session requested by URL path, '' for the default
+
+    raises ValueError for a name that won't do as a directory name
+
+    >>> session_name('/stopgap.html?session=kitchen'), session_name('/')
+    ('kitchen', '')
+    >>> session_name('/?session=../etc')
+    Traceback (most recent call last):
+        ...
+    ValueError: bad session name '../etc'
+    '''
+    name = parse_qs(urlsplit(path).query).get('session', [''])[0]
+    if not SESSION_NAME.fullmatch(name):
+        raise ValueError('bad session name %r' % name)
+    return name
+
+def opened(name):
+    '''
+    session by name, opening it if need be
+
+    a worker asks the hub for it, and greetings wait until it arrives
+    '''
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(name)
+        if session is None:
+            session = SESSIONS[name] = Session(name)
+            if LINKS.hub is not None:
+                session.ready = False
+                LINKS.hub.post({'open': name})
+            else:
+                session.open()
+        session.active = time.monotonic()
+        return session
+
+def evict(now=None):
+    '''
+    close sessions nobody has been connected to for SESSION_IDLE seconds
+
+    a worker tells the hub, which closes its own copy once no worker has
+    one any more
+    '''
+    now = time.monotonic() if now is None else now
+    attached = {client.session for client in list(CONNECTIONS)}
+    with SESSIONS_LOCK:
+        idle = [session for name, session in SESSIONS.items()
+                if name and session not in attached and
+                now - session.active > SESSION_IDLE]
+        for session in idle:
+            del SESSIONS[session.name]
+    for session in idle:
+        logging.info('evicting idle %s', session)
+        session.close()
+        if LINKS.hub is not None:
+            LINKS.hub.post({'close': session.name})
+
+def editors():
+    '''
+    editor clients of all sessions
+    '''
+    return [client for session in list(SESSIONS.values())
+            for client in list(session.clients)]
+
+SESSIONS[''] = Session()
+
+def checkpoint(session, save=False):
+    '''
+    snapshot document for the journal, and write it to its file if saving
+
+    must be called with the session's sequencer lock held
+    '''
+    session.journal.snapshot(
+        str(session.document), save, serial=session.sequencer.serial,
+        caret=session.document.caret, sent=dict(session.sequencer.sent),
+        filename=session.edit_file['name'])
+
+def recover(session):
+    '''
+    restore session's document as it was before a crash or restart
+    '''
+    header, text, events = session.journal.recover()
+    restore(session, header, text)
+    for event in events:
+        session.document.apply(event)
+        session.sequencer.serial = event['serial']
+        if 'origin' in event:
+            session.sequencer.sent[event['origin']] = event['sent']
+    session.sequencer.restart()  # nothing before now is left to replay
+
+def restore(session, header, text):
+    '''
+    set session's document, serial, filename and counts of messages sent
+    from a snapshot
+    '''
+    session.document.load(text, header['caret'])
+    session.index = None
+    session.edit_file['name'] = header.get('filename') or (
+        session.edit_file['name'])
+    session.sequencer.serial = header['serial']
+    session.sequencer.sent = dict(header.get('sent') or {})
+    session.sequencer.restart()
+
+def chorded(session, message, origin, sent):
+    '''
+    `chord` event, naming the softkeys in it, for the GKOS softkey event
+    that completes a chord; None for the others
+
+    >>> session = Session()
+    >>> [chorded(session, {'key': key, 'direction': direction}, 'o', sent)
+    ...  for sent, (key, direction) in enumerate([
+    ...      ('a', 'down'), ('b', 'down'), ('b', 'up'), ('a', 'up')], 1)]
+    [None, None, {'key': 'ab', 'direction': 'up', 'keytype': 'chord'}, None]
+    '''
+    with session.sequencer.lock:
+        chord = session.chords.setdefault(origin, Chord())
+        keys = chord.add(message.get('key'), message.get('direction'), sent)
+    if keys is None:
+        return None
+    return dict(message, key=keys, keytype='chord')
+
+def sequenced(session, event, sent=None):
+    '''
+    stamp key Event, apply it to the session's document, and journal it
+
+    returns the event, or None for a duplicate. must be called with the
+    session's sequencer lock held
+    '''
+    if session.sequencer.stamp(event, sent) is None:
+        logging.info('ignoring resent %s from %s', event.message,
+                     event.origin)
+        return None
+    session.active = time.monotonic()
+    key = session.document.apply(event.message)
+    if event.origin is not None and sent is not None:
+        # with the count, so a resent event is still known after a restart
+        session.journal.append(dict(event.message, origin=event.origin,
+                                    sent=sent))
+    else:
+        session.journal.append(event.message)
+    if session.keylog is not None:
+        record = event.logged(sent)
+        if record:  # unless of a keytype that has no code
+            session.keylog.append(record, time.time())
+    if key == 'Alt-S' or session.journal.due():
+        checkpoint(session, save=key == 'Alt-S')
+    return event
+
+def suggest(session):
+    '''
+    send the session's editors completions of the word before the caret,
+    unless they have them already, first counting any word just finished
+
+    must be called with the session's sequencer lock held
+    '''
+    if not SUGGESTIONS or not session.clients:
+        return
+    started, document = time.perf_counter(), session.document
+    index = session.index or indexed(session)
+    typed = prefix(document.before(PREFIX_MAX))
+    word, caret = session.typing
+    if word and not typed and document.caret > caret:
+        index.add(word)
+    session.typing = typed, document.caret
+    completions = index.complete(typed, SUGGESTIONS) if typed else []
+    # no completions is the same whatever the prefix, and needn't be resent
+    suggested = typed if completions else '', completions
+    SUGGEST_SECONDS.observe(time.perf_counter() - started)
+    if suggested != session.suggested:
+        session.suggested = suggested
+        frame = control('suggest', prefix=suggested[0], words=completions)
+        for client in list(session.clients):
+            client.send(frame)
+
+def indexed(session):
+    '''
+    Index of WORDLIST and the words in the session's document, loading
+    the list the first time
+    '''
+    global WORDS  # pylint: disable=global-statement
+    if WORDS is None:
+        started, WORDS = time.perf_counter(), Index(wordlist())
+        WORDS.prime(SUGGESTIONS)
+        logging.info('indexed %d words from %s in %.3f seconds',
+                     len(WORDS.words), WORDLIST,
+                     time.perf_counter() - started)
+    session.index = WORDS.copy()
+    session.index.update(words(str(session.document)))
+    session.typing, session.suggested = ('', 0), None
+    return session.index
+
+def broadcast(session, event, sender=None):
+    '''
+    queue key event for the session's editors, except sender if given
+
+    it is framed at most once in each encoding, and the same frame queued
+    for every client using that encoding
+    '''
+    started, frames = time.perf_counter(), {}
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('sending %s to %s, except %s',
+                      event.message, session.clients, sender)
+    for client in list(session.clients):
+        if client is sender:
+            continue
+        if client.binary not in frames:
+            record = client.binary and event.record()
+            frames[client.binary] = package(record, 'binary') if record else (
+                package(event.json()))
+        client.send(frames[client.binary], [event])
+    FANOUT_SECONDS.observe(time.perf_counter() - started)
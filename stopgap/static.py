@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+'''
+static files kept in memory, compressed ahead of time, with strong ETags
+
+a file is read, hashed and compressed once, and again only when its
+modification time or size changes; so a phone reloading the page gets
+`304 Not Modified`, or at worst the gzipped copy, without the server
+touching the disk or compressing anything
+
+the editor page can also be had as one bundle, its stylesheets and script
+inlined and minified, so it loads in a single round trip; and with a
+service worker that keeps the bundle on the device for later loads
+'''
+import os, re, gzip, json, logging  # pylint: disable=multiple-imports
+from hashlib import sha1
+from threading import Lock
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+CACHE_MAX = int(os.getenv('STATIC_CACHE_MAX') or 1048576)  # bytes per file
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                'image/svg+xml')
+CACHE = {}  # Assets by path, or by (kind, path) for generated ones
+# stylesheets and scripts in a page that can be inlined into its bundle
+LINKED = re.compile(r'<link rel="stylesheet" href="([^":/]+)">'
+                    r'|<script src="([^":/]+)"></script>')
+LOCK = Lock()  # only so that two threads don't load the same file at once
+# pylint: disable=consider-using-f-string
+
+class Asset:
+    r'''
+    contents of a file, in each encoding worth having, with its ETag
+
+    >>> asset = Asset(b'body { margin: 0 }\n' * 50, 'text/css', (1, 2))
+    >>> len(asset.encodings['gzip']) < len(asset.encodings[None])
+    True
+    >>> asset.etag
+    '"a87f92b0720cc919"'
+    >>> asset.variant('gzip')
+    '"a87f92b0720cc919-gzip"'
+    >>> Asset(b'\x89PNG', 'image/png', (1, 2)).encodings.keys()
+    dict_keys([None])
+    '''
+    def __init__(self, contents, content_type, stamp):
+        self.content_type = content_type
+        self.stamp = stamp  # (mtime, size) it was read at
+        self.etag = '"%s"' % sha1(contents).hexdigest()[:16]
+        self.encodings = {None: contents}
+        if content_type.startswith(COMPRESSIBLE):
+            compressed = gzip.compress(contents, mtime=0)
+            if len(compressed) < len(contents):
+                self.encodings['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(contents)
+                if len(compressed) < len(contents):
+                    self.encodings['br'] = compressed
+
+    def variant(self, encoding):
+        '''
+        ETag of the given encoding: strong ETags differ for every one
+        '''
+        if encoding is None:
+            return self.etag
+        return self.etag[:-1] + '-%s"' % encoding
+
+    def negotiate(self, accepted):
+        '''
+        best encoding of those in an Accept-Encoding header, None for none
+
+        >>> Asset(b'a' * 100, 'text/plain', (1, 2)).negotiate('gzip, br')
+        'gzip'
+        >>> Asset(b'a' * 100, 'text/plain', (1, 2)).negotiate('gzip;q=0')
+        '''
+        offered = {}
+        for item in (accepted or '').split(','):
+            coding, _, quality = item.strip().partition(';q=')
+            try:
+                offered[coding.strip().lower()] = float(quality or 1)
+            except ValueError:
+                continue
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encodings and offered.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+    def matches(self, if_none_match):
+        '''
+        whether an If-None-Match header names any encoding of this asset
+
+        >>> asset = Asset(b'a' * 100, 'text/plain', (1, 2))
+        >>> asset.matches('"x", ' + asset.variant('gzip')), asset.matches('')
+        (True, False)
+        '''
+        tags = [tag.strip() for tag in (if_none_match or '').split(',')]
+        return '*' in tags or any(
+            tag.removeprefix('W/') in map(self.variant, self.encodings)
+            for tag in tags)
+
+def cached(path, content_type):
+    '''
+    Asset for file at path, reloading it if changed, or None if it is too
+    big to keep in memory
+
+    raises OSError if the file can't be read
+    '''
+    status = os.stat(path)
+    stamp = (status.st_mtime_ns, status.st_size)
+    if status.st_size > CACHE_MAX:
+        return None
+    asset = CACHE.get(path)
+    if asset is None or asset.stamp != stamp:
+        with LOCK:
+            asset = CACHE.get(path)
+            if asset is None or asset.stamp != stamp:
+                with open(path, 'rb') as infile:
+                    contents = infile.read()
+                asset = CACHE[path] = Asset(contents, content_type, stamp)
+                logging.info('cached %s, %d bytes as %s', path, len(contents),
+                             {encoding: len(body) for encoding, body
+                              in asset.encodings.items()})
+    return asset
+
+def stamped(paths):
+    '''
+    what a generated Asset is checked against: each file's path, mtime
+    and size
+
+    raises OSError if a file can't be found
+    '''
+    return tuple((path, status.st_mtime_ns, status.st_size)
+                 for path, status in ((path, os.stat(path)) for path in paths))
+
+def linked(page):
+    '''
+    names of stylesheets and scripts the page links to
+
+    >>> linked('<link rel="stylesheet" href="a.css"><script src="a.js">'
+    ...        '</script><script src="http://b/b.js"></script>')
+    ['a.css', 'a.js']
+    '''
+    return [''.join(names) for names in LINKED.findall(page)]
+
+def minify_css(text):
+    '''
+    stylesheet without comments or unneeded whitespace
+
+    >>> minify_css('/* reset */\\nbody {\\n\\tmargin: 0;\\n'
+    ...            '\\tpadding: 0 1px;\\n}\\n')
+    'body{margin:0;padding:0 1px}'
+    '''
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r' ?([{};,]) ?', r'\1', text)
+    return text.replace(': ', ':').replace(';}', '}').strip()
+
+def minify_js(text):
+    '''
+    script without indentation, blank lines, or comments on lines of
+    their own or after the end of a statement
+
+    line breaks are kept, so automatic semicolon insertion still works,
+    and nothing inside a line is touched but a trailing comment
+
+    >>> print(minify_js('/* setup\\n   more */\\nif (a) {\\n    // a\\n'
+    ...       '    b = "ws://" + c;  // b\\n\\n}\\n'))
+    if (a) {
+    b = "ws://" + c;
+    }
+    '''
+    text = re.sub(r'^[ \t]*/\*.*?\*/[ \t]*\n', '', text,
+                  flags=re.M | re.S)
+    lines = []
+    for line in text.splitlines():
+        line = re.sub(r'([;{},])\s+//\s.*$', r'\1', line.strip())
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines).replace('</script', '<\\/script')
+
+def minify_html(text):
+    '''
+    page without comments or indentation
+
+    not for pages with text in `<pre>` or `<textarea>` spanning lines
+
+    >>> minify_html('<div>\\n  <p>a</p>\\n</div>\\n<!--\\n  vim\\n-->\\n')
+    '<div>\\n<p>a</p>\\n</div>'
+    '''
+    text = re.sub(r'<!--.*?-->', '', text, flags=re.S)
+    return '\n'.join(line.strip() for line in text.splitlines()
+                     if line.strip())
+
+def inline(match, directory):
+    '''
+    what a stylesheet or script link in a page is replaced with
+    '''
+    stylesheet, script = match.groups()
+    with open(os.path.join(directory, stylesheet or script),
+              encoding='utf-8') as infile:
+        text = infile.read()
+    if stylesheet:
+        return '<style>%s</style>' % minify_css(text)
+    return '<script>\n%s\n</script>' % minify_js(text)
+
+def bundled(path):
+    '''
+    Asset of the page at path with its stylesheets and scripts inlined,
+    rebuilt if any of them has changed
+
+    raises OSError if any of them can't be read
+    '''
+    directory = os.path.dirname(path)
+    asset = CACHE.get(('bundle', path))
+    if asset is None or asset.stamp != stamped(
+            entry[0] for entry in asset.stamp):
+        with LOCK:
+            with open(path, encoding='utf-8') as infile:
+                page = infile.read()
+            parts = [os.path.join(directory, name) for name in linked(page)]
+            stamp = stamped([path] + parts)
+            bundle = LINKED.sub(lambda match: inline(match, directory),
+                                minify_html(page))
+            asset = CACHE[('bundle', path)] = Asset(
+                bundle.encode(), 'text/html', stamp)
+            logging.info('bundled %s with %s: %d bytes, ETag %s', path,
+                         parts, len(bundle), asset.etag)
+    return asset
+
+def service_worker(path, page, bundle=True):
+    '''
+    Asset of the service worker script at path, set to keep the page
+    (bundled, or else with the files it links to) on the device, in a cache
+    named for their contents: any change to them changes the script, so
+    the browser installs it anew, replacing what it kept
+
+    raises OSError if the script or page can't be read
+    '''
+    directory, name = os.path.split(page)
+    if bundle:
+        manifest, version = [name], bundled(page).etag.strip('"')
+    else:
+        manifest = [name] + linked(
+            cached(page, 'text/html').encodings[None].decode())
+        version = sha1(repr(stamped(
+            os.path.join(directory, name) for name in manifest)).encode()
+                      ).hexdigest()[:16]
+    stamp = stamped([path]) + (version,)
+    asset = CACHE.get(('worker', path))
+    if asset is None or asset.stamp != stamp:
+        with open(path, encoding='utf-8') as infile:
+            script = infile.read()
+        script = re.sub(r'^const VERSION = .*$', 'const VERSION = %s;' %
+                        json.dumps(version), script, count=1, flags=re.M)
+        script = re.sub(r'^const MANIFEST = .*$', 'const MANIFEST = %s;' %
+                        json.dumps(manifest), script, count=1, flags=re.M)
+        asset = CACHE[('worker', path)] = Asset(
+            script.encode(), 'application/javascript', stamp)
+    return asset
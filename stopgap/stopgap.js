@@ -28,6 +28,7 @@ window.onload = function() {
     const background = document.getElementById("background");
     const fakeCaret = document.getElementById("fake-caret");
     const keyboard = document.getElementById("keyboard");
+    const suggestions = document.getElementById("suggestions");
     let webSocket = null;  // set this up later
     let untimedChord = 0;  // simplest possible chording technique
     let readyToRead = false;  // becomes true on GKOS keydown
@@ -53,87 +54,10 @@ window.onload = function() {
     const META = C;
     const ALT = LEFT_ALT | RIGHT_ALT;
     const CTRL = LEFT_CTRL | RIGHT_CTRL;
-    const mapping = { // chords to characters (GKOS standard for English)
-        /* NOTE: I'm using END (cf. 'End') for what looks like a "Play" button
-           in the GKOS test page, and HOME for its reverse. Neither does
-           anything in the test page, so I'm not sure of their intended
-           purposes */
-        '_|_|_|_|_|_': ['', '', '', ''],
-        'A|_|_|_|_|_': ['a', 'A', '1', '1'],
-        'B|_|_|_|_|_': ['b', 'B', '2', '2'],
-        'A|B|_|_|_|_': ['o', 'O', '+', '+'],
-        '_|_|C|_|_|_': ['c', 'C', '3', '3'],
-        'A|_|C|_|_|_': ['th', 'Th', ')', ')'],
-        '_|B|C|_|_|_': ['s', 'S', '*', '*'],
-        'A|B|C|_|_|_': ['Backspace', 'Backspace', 'Backspace', 'Backspace'],
-        '_|_|_|D|_|_': ['d', 'D', '4', '4'],
-        'A|_|_|D|_|_': ['Up', 'Up', 'Up', 'Up'],
-        '_|B|_|D|_|_': ["'", '"', "'", '"'],
-        'A|B|_|D|_|_': ['p', 'P', '%', '%'],
-        '_|_|C|D|_|_': ['!', '|', '!', '|'],
-        'A|_|C|D|_|_': ['that ', 'That ', ']', ']'],
-        '_|B|C|D|_|_': ['t', 'T', '$', '$'],
-        'A|B|C|D|_|_': ['Left', 'Left', 'Left', 'Left'],
-        '_|_|_|_|E|_': ['e', 'E', '5', '5'],
-        'A|_|_|_|E|_': ['-', '_', '-', '_'],
-        '_|B|_|_|E|_': ['SHIFT', 'SHIFT', 'SHIFT', 'SHIFT'],
-        'A|B|_|_|E|_': ['q', 'Q', '=', '='],
-        '_|_|C|_|E|_': [',', ';', ',', ';'],
-        'A|_|C|_|E|_': ['the ', 'The ', '>', '>'],
-        '_|B|C|_|E|_': ['u', 'U', '€', '€'],
-        'A|B|C|_|E|_': ['HOME', 'HOME', 'HOME', 'HOME'],
-        '_|_|_|D|E|_': ['g', 'G', '0', '0'],
-        'A|_|_|D|E|_': ['h', 'H', '7', '7'],
-        '_|B|_|D|E|_': ['i', 'I', '8', '8'],
-        'A|B|_|D|E|_': ['PgUp', 'PgUp', 'PgUp', 'PgUp'],
-        '_|_|C|D|E|_': ['j', 'J', '9', '9'],
-        'A|_|C|D|E|_': ['to ', 'To ', '', '\u030c'],
-        '_|B|C|D|E|_': ['/', '\u0301', '/', '\u0301'], // forward slash, accent
-        'A|B|C|D|E|_': ['Escape', 'Escape', 'Escape', 'Escape'],
-        '_|_|_|_|_|F': ['f', 'F', '6', '6'],
-        'A|_|_|_|_|F': ['?', '~', '?', '~'],
-        '_|B|_|_|_|F': ['.', ':', '.', ':'],
-        'A|B|_|_|_|F': ['r', 'R', '^', '^'],
-        '_|_|C|_|_|F': ['Down', 'Down', 'Down', 'Down'],
-        'A|_|C|_|_|F': ['of ', 'Of ', '}', '}'],
-        '_|B|C|_|_|F': ['v', 'V', '£', '£'],
-        'A|B|C|_|_|F': ['Home', 'Home', 'Home', 'Home'],
-        '_|_|_|D|_|F': ['w', 'W', '(', '('],
-        'A|_|_|D|_|F': ['x', 'X', '[', '['],
-        '_|B|_|D|_|F': ['y', 'Y', '<', '<'],
-        'A|B|_|D|_|F': ['Ins', 'Ins', 'Ins', '°'],
-        '_|_|C|D|_|F': ['z', 'Z', '{', '{'],
-        'A|_|C|D|_|F': ['SYMB', 'SYMB', 'SYMB', 'SYMB'],
-        '_|B|C|D|_|F': ['with ', 'With ', '§', '§'],
-        'A|B|C|D|_|F': ['Ctrl', 'Ctrl', 'Ctrl', 'Ctrl'],
-        '_|_|_|_|E|F': ['k', 'K', '#', '#'],
-        'A|_|_|_|E|F': ['l', 'L', '@', '@'],
-        '_|B|_|_|E|F': ['m', 'M', '½', '½'],
-        'A|B|_|_|E|F': ['\\', '\u0300', '\\', '\u0300'], // back slash, accent
-        '_|_|C|_|E|F': ['n', 'N', '&', '&'],
-        'A|_|C|_|E|F': ['and ', 'And ', 'μ', 'μ'],
-        '_|B|C|_|E|F': ['PgDn', 'PgDn', 'PgDn', 'PgDn'],
-        'A|B|C|_|E|F': ['Alt', 'Alt', 'Alt', 'Alt'],
-        '_|_|_|D|E|F': [' ', ' ', ' ', ' '], // original GKOS [' ', '', '', '']
-        'A|_|_|D|E|F': ['Right', 'Right', 'Right', 'Right'],
-        '_|B|_|D|E|F': ['END', 'END', 'END', 'END'],
-        'A|B|_|D|E|F': ['Enter', 'Enter', 'Enter', 'Enter'],
-        '_|_|C|D|E|F': ['End', 'End', 'End', 'End'],
-        'A|_|C|D|E|F': ['\t', '\t', '\t', '\t'], // Tab
-        '_|B|C|D|E|F': ['Delete', 'Delete', 'Delete', 'Delete'],
-        'A|B|C|D|E|F': ['ABC123', 'ABC123', 'ABC123', 'ABC123']
-    };
-    // for ES6 we could have used [D|E|F] etc., above but not for ES5.
-    // so we add the *real* keys now, using eval.
-    Object.keys(mapping).forEach(function(key) {
-        const value = eval(key); // bit-OR the values together
-        mapping[value] = mapping[key][0];
-        mapping[value | X] = mapping[key][1]; // shifted
-        mapping[value | Y] = mapping[key][2]; // numbers mode
-        mapping[value | Z] = mapping[key][3]; // SYMBols mode
-        delete mapping[key]; // no more need for text key
-    });
-    console.debug("mapping: " + JSON.stringify(mapping));
+    // chords to characters (GKOS standard for English), indexed by the
+    // chord's bits ORed with the shift: compiled by chords.py into chords.js
+    const mapping = CHORDS.layouts.gkos;
+    console.debug("chord table version " + CHORDS.version);
     class KeyDown extends KeyboardEvent {
         constructor(key, code, serial, keytype) {
             super("keydown", {key: key, code: code});
@@ -162,6 +86,36 @@ window.onload = function() {
         end: editWindow.selectionEnd
     };
     let hasFocus = editWindow;
+    // lines of a document too large to have whole, if that's what we have:
+    // first line, count of lines, lines in all, and where the first starts
+    let view = null;
+    const current = function() {
+        // text and selection, in whichever of edit window and background
+        if (hasFocus == editWindow) {
+            return {
+                text: editWindow.value,
+                start: editWindow.selectionStart,
+                end: editWindow.selectionEnd
+            };
+        }
+        return {
+            text: background.firstChild.textContent,
+            start: caretPosition.start,
+            end: caretPosition.end
+        };
+    };
+    const newlines = function(text) {
+        return text.split("\n").length - 1;
+    };
+    const lineOffset = function(text, line) {
+        // where line number `line` (from 0) of text starts, or its end
+        let offset = 0;
+        while (line-- > 0) {
+            offset = text.indexOf("\n", offset) + 1;
+            if (offset == 0) return text.length;
+        }
+        return offset;
+    };
     editWindow.addEventListener("focusout", function() {
         const editText = editWindow.value;
         caretPosition.start = editWindow.selectionStart;
@@ -214,6 +168,13 @@ window.onload = function() {
         }
     };
     const deleteSelected = function() {
+        if (view) {
+            const shown = current();
+            const breaks = newlines(shown.text.substring(shown.start,
+                                                         shown.end));
+            view.lines -= breaks;
+            view.total -= breaks;
+        }
         if (hasFocus == editWindow) return editWindowDeleteSelected();
         else return backgroundDeleteSelected();
     };
@@ -239,6 +200,10 @@ window.onload = function() {
         ]);
     };
     const insertString = function(string) {
+        if (view) {
+            view.lines += newlines(string);
+            view.total += newlines(string);
+        }
         if (hasFocus == editWindow) return editWindowInsertString(string);
         else return backgroundInsertString(string);
     };
@@ -282,12 +247,13 @@ window.onload = function() {
             }
             console.debug("sending keydown '" + event.key +
                           "' through webSocket tunnel");
-            webSocket.send(JSON.stringify({
+            tunnel({
                 key: event.key,
                 direction: "down",
                 echo: echo,
-                keytype: event.keytype
-            }));
+                keytype: event.keytype,
+                modifiers: modifierBits(event) || undefined
+            });
             return false;  // stop propagation and default action
         }
     });
@@ -297,6 +263,14 @@ window.onload = function() {
     document.body.addEventListener("keyup", function(event) {
         let echo = true;
         if (event.serial) {
+            if (event.keytype == "chord") {
+                // the server resolved the chord, sending only its keys
+                untimedChord = 0;
+                for (const component of event.key) {
+                    untimedChord |= GKOSKeys[component].value;
+                }
+                readyToRead = true;
+            }
             let key = mapping[untimedChord | shift] || '';
             if (readyToRead) {
                 if (untimedChord || shift) {
@@ -322,12 +296,13 @@ window.onload = function() {
             }
             console.debug("sending keyup '" + event.key +
                           "' through webSocket tunnel");
-            webSocket.send(JSON.stringify({
+            tunnel({
                 key: event.key,
                 direction: "up",
                 echo: echo,
-                keytype: event.keytype
-            }));
+                keytype: event.keytype,
+                modifiers: modifierBits(event) || undefined
+            });
             return false;  // stop propagation and default action
         }
     });
@@ -338,6 +313,11 @@ window.onload = function() {
             console.debug("ignoring keypress while edit window has focus");
         }
     });
+    const modifierBits = function(event) {
+        // state of modifier keys when a hardware key was pressed
+        return (event.shiftKey ? 1 : 0) | (event.ctrlKey ? 2 : 0) |
+            (event.altKey ? 4 : 0) | (event.metaKey ? 8 : 0);
+    };
     const sendKey = function(key, code, serial, direction, keytype) {
         const event = new (direction == "up" ? KeyUp : KeyDown)(
             key, code, serial, keytype
@@ -422,9 +402,13 @@ window.onload = function() {
             console.debug("Displaying file open dialog");
             document.getElementById("file-open").style.display = "block";
         },
+        "Alt-S": function(event, key) {
+            console.info("server is saving the document");
+        },
         Backspace: function(event, key) {
             console.debug("Backspace received with caretPosition " +
                           JSON.stringify(caretPosition));
+            if (offPage(true)) return;
             const selected = caretPosition.end - caretPosition.start;
             // if there is selected text already, simply remove it on backspace
             // otherwise "select" the final character and remove it.
@@ -437,6 +421,7 @@ window.onload = function() {
             modifiers |= LEFT_CTRL;
         },
         Enter: function(event, key) {
+            if (offPage(false)) return;
             deleteSelected();
             console.debug("implementing <ENTER> key");
             insertString(endOfLine);
@@ -456,6 +441,7 @@ window.onload = function() {
             }
         },
         default: function(event, key) {
+            if (key.length == 1 && offPage(false)) return;
             deleteSelected();
             if (key.length == 1) {
                 console.debug("inserting character '" + key + "'");
@@ -540,34 +526,326 @@ window.onload = function() {
     editWindow.focus();
     keyboardInit(GKOSKeys);
     // all interaction with server henceforth will be over a WebSocket
-    // try-catch doesn't work here, see stackoverflow.com/a/31003057/493161
-    webSocket = new WebSocket("ws://" + location.host);
-    webSocket.onmessage = function(event) {
-        let message = null;
-        console.debug("Data received: " + event.data);
-        try {
-            message = JSON.parse(event.data);
-            sendKey(message.key, message.code, message.serial,
-                    message.direction, message.keytype);
-        } catch (parseError) {
-            console.error("unexpected message: " + parseError);
-            message = event.data;
+    // identify this page to the server, so it can resume after a dropout
+    const origin = Math.random().toString(36).slice(2);
+    let lastSerial = 0;  // most recent key event received
+    let sentCount = 0;  // lets server discard messages we resend
+    let retryDelay = 500;  // milliseconds, doubled on each failure
+    const outbox = [];  // recently sent messages, to resend on reconnect
+    let receiving = null;  // document arriving from server in chunks
+    // key events as binary records, if the server agrees to it:
+    // serial, count sent, flags, keytype, modifier bits, then the key
+    const KEY_PROTOCOL = "stopgap.binary";
+    const KEY_RECORD_SIZE = 32;
+    const KEY_DOWN = 1, KEY_ECHO = 2;
+    const KEYTYPES = [undefined, "gkos", "chord"];
+    const textEncoder = new TextEncoder(), textDecoder = new TextDecoder();
+    const encodeKey = function(message) {
+        // returns null if the message won't fit in a record
+        const key = textEncoder.encode(message.key);
+        const keytype = KEYTYPES.indexOf(message.keytype);
+        if (key.length > KEY_RECORD_SIZE - 11 || keytype < 0) return null;
+        const record = new ArrayBuffer(KEY_RECORD_SIZE);
+        const view = new DataView(record);
+        view.setUint32(4, message.sent);
+        view.setUint8(8, (message.direction == "down" ? KEY_DOWN : 0) |
+                         (message.echo ? KEY_ECHO : 0));
+        view.setUint8(9, keytype);
+        view.setUint8(10, message.modifiers || 0);
+        new Uint8Array(record, 11).set(key);
+        return record;
+    };
+    const decodeKey = function(view, offset) {
+        const message = {
+            key: textDecoder.decode(new Uint8Array(
+                view.buffer, offset + 11, KEY_RECORD_SIZE - 11
+            )).replace(/\0+$/, ""),
+            direction: view.getUint8(offset + 8) & KEY_DOWN ? "down" : "up",
+            serial: view.getUint32(offset)
+        };
+        const keytype = KEYTYPES[view.getUint8(offset + 9)];
+        const modifiers = view.getUint8(offset + 10);
+        if (keytype) message.keytype = keytype;
+        if (modifiers) message.modifiers = modifiers;
+        return message;
+    };
+    const transmit = function(message) {
+        const record = webSocket.protocol == KEY_PROTOCOL &&
+            encodeKey(message);
+        webSocket.send(record || JSON.stringify(message));
+    };
+    const loadDocument = function(text, caret) {
+        // whole document from server, replacing whatever we have
+        untimedChord = 0;
+        readyToRead = false;
+        shift = modifiers = _;
+        view = null;
+        showText(text, caret);
+    };
+    const showText = function(text, caret) {
+        caretPosition.start = caretPosition.end = caret;
+        if (hasFocus == editWindow) {
+            editWindow.value = text;
+            editWindow.selectionStart = editWindow.selectionEnd = caret;
+        } else {
+            replaceChildren(background.firstChild, [
+                document.createTextNode(text.substring(0, caret)),
+                fakeCaret,
+                document.createTextNode(text.substring(caret))
+            ]);
         }
     };
-    webSocket.onclose = function(event) {
-        console.debug("Connection closed, code: " +
-            event.code + ", reason: \"" +
-            event.reason + "\", was clean: " + event.wasClean);
-        console.debug("You may close this window.");
+    const requestPage = function(fields) {
+        // ask for lines of a large document, saying which we have seen
+        // every key event for, by the last serial
+        fields.control = "page";
+        fields.serial = lastSerial;
+        view.requested = true;
+        if (webSocket && webSocket.readyState == WebSocket.OPEN) {
+            webSocket.send(JSON.stringify(fields));
+        }
     };
-    webSocket.onerror = function(event) {
-        console.warn("Connection closed due to error", event);
+    const offPage = function(deleting) {
+        /* whether the caret is off the lines of a large document that we
+           have, where an edit can't be shown. if so, ask for the page
+           around the caret, which will have the edit made already */
+        if (!view) return false;
+        if (view.away === null) {
+            const shown = current();
+            const last = view.line + view.lines >= view.total;
+            if (shown.start >= (deleting ? 1 : 0) &&
+                    (shown.end < shown.text.length || last)) {
+                return false;
+            }
+            view.away = view.offset + shown.start;
+        }
+        console.debug("caret is off the page, at " + view.away);
+        if (!view.requested) requestPage({caret: true});
+        return true;
     };
-    webSocket.onopen = function(event) {
-        console.info("Connection opened to " + location.host);
-        webSocket.send("stopgap editor");
+    const scrolled = function(event) {
+        // nearing either end of the lines we have of a large document,
+        // ask for more that way, to replace those furthest from view
+        const element = event.target;
+        if (!view || view.requested || element !=
+                (hasFocus == editWindow ? editWindow : background)) return;
+        const step = Math.ceil(view.window / 2);
+        const margin = element.clientHeight;
+        const below = element.scrollHeight - element.scrollTop - margin;
+        let line = null;
+        if (element.scrollTop < margin && view.line > 0) {
+            line = Math.max(view.line - step, 0);
+        } else if (below < margin && view.line + view.lines < view.total) {
+            line = view.line + view.lines + step - view.window;
+        }
+        if (line !== null) requestPage({
+            line: line,
+            lines: view.window,
+            held: [view.line, view.lines]
+        });
     };
+    editWindow.addEventListener("scroll", scrolled);
+    background.addEventListener("scroll", scrolled);
+    const applyKey = function(message) {
+        if (message.serial <= lastSerial) {
+            return console.debug("already saw " + message.serial);
+        }
+        lastSerial = message.serial;
+        sendKey(message.key, message.code, message.serial,
+                message.direction, message.keytype);
+    };
+    const finishTransfer = function() {
+        const done = receiving;
+        receiving = null;
+        console.info("received document of " + done.data.length +
+                     " bytes, current to serial " + done.serial);
+        loadDocument(textDecoder.decode(done.data), done.caret);
+        lastSerial = done.serial;
+        // key events that arrived meanwhile apply to the new document
+        done.pending.forEach(applyKey);
+    };
+    const receiveKeys = function(buffer) {
+        // one or more key event records
+        const view = new DataView(buffer);
+        for (let offset = 0; offset < buffer.byteLength;
+                offset += KEY_RECORD_SIZE) {
+            receiveKey(decodeKey(view, offset));
+        }
+    };
+    const receiveKey = function(message) {
+        if (message.control) return controls[message.control](message);
+        if (receiving) return receiving.pending.push(message);
+        applyKey(message);
+    };
+    const receiveChunk = function(buffer) {
+        // transfer id, 64-bit offset, then the bytes themselves
+        const view = new DataView(buffer);
+        const transfer = view.getUint32(0);
+        const offset = view.getUint32(4) * 2 ** 32 + view.getUint32(8);
+        if (!receiving || transfer != receiving.transfer ||
+                offset != receiving.received) {
+            return console.warn("ignoring stray chunk at " + offset);
+        }
+        const chunk = new Uint8Array(buffer, 12);
+        receiving.data.set(chunk, offset);
+        receiving.received += chunk.length;
+        webSocket.send(JSON.stringify({
+            control: "ack",
+            transfer: transfer,
+            offset: receiving.received
+        }));
+        if (receiving.received == receiving.data.length) finishTransfer();
+    };
+    const controls = {
+        snapshot: function(message) {
+            if (receiving && receiving.transfer == message.transfer) {
+                console.info("resuming transfer at " + message.offset);
+            } else {
+                receiving = {
+                    transfer: message.transfer,
+                    serial: message.serial,
+                    caret: message.caret,
+                    data: new Uint8Array(message.size),
+                    pending: []
+                };
+            }
+            receiving.received = message.offset;
+            if (message.offset == message.size) finishTransfer();
+        },
+        page: function(message) {
+            // lines of a document too large to send whole: either all
+            // of them, or those above and below the lines to keep
+            const element = hasFocus == editWindow ? editWindow : background;
+            let text = message.text;
+            let top = null;  // line to show at the top
+            if (text === undefined) {
+                const shown = current().text;
+                top = view.line + element.scrollTop * view.lines /
+                    (element.scrollHeight || 1);
+                text = message.above + shown.substring(
+                    lineOffset(shown, message.keep[0] - view.line),
+                    lineOffset(shown, message.keep[1] - view.line)
+                ) + message.below;
+            }
+            view = {
+                line: message.line,
+                lines: message.lines,
+                total: message.total,
+                offset: message.offset,
+                window: message.window,
+                away: null,  // caret, if off these lines
+                requested: false
+            };
+            lastSerial = Math.max(lastSerial, message.serial);
+            let caret = message.caret - message.offset;
+            if (caret < 0 || caret > text.length) {
+                view.away = message.caret;
+                caret = caret < 0 ? 0 : text.length;
+            }
+            showText(text, caret);
+            const lineHeight = element.scrollHeight / Math.max(view.lines, 1);
+            if (top === null) {  // new place, so show the caret
+                top = view.line + newlines(text.substring(0, caret)) -
+                    element.clientHeight / lineHeight / 2;
+            }
+            element.scrollTop = (top - view.line) * lineHeight;
+        },
+        suggest: function(message) {
+            // completions of the word being typed: choosing one types
+            // the rest of it, and a space, as if from a hardware keyboard
+            replaceChildren(suggestions, message.words.map(function(word) {
+                const button = document.createElement("button");
+                const rest = word.slice(message.prefix.length) + " ";
+                button.type = "button";
+                button.appendChild(document.createTextNode(word));
+                button.addEventListener("click", function() {
+                    for (const character of rest) {
+                        tunnel({
+                            key: character,
+                            direction: "down",
+                            echo: true
+                        });
+                    }
+                });
+                return button;
+            }));
+        }
+    };
+    const tunnel = function(message) {
+        message.sent = ++sentCount;
+        outbox.push(message);
+        if (outbox.length > 256) outbox.shift();
+        if (webSocket && webSocket.readyState == WebSocket.OPEN) {
+            transmit(message);
+        } else {
+            console.warn("not connected, will send on reconnect");
+        }
+    };
+    const connect = function() {
+        // try-catch doesn't work here, see stackoverflow.com/a/31003057/493161
+        // `?session=NAME` on the page's URL picks the editing session
+        webSocket = new WebSocket("ws://" + location.host + "/" +
+                                  location.search,
+                                  [KEY_PROTOCOL, "stopgap.json"]);
+        webSocket.binaryType = "arraybuffer";
+        webSocket.onmessage = function(event) {
+            let message = null;
+            if (event.data instanceof ArrayBuffer) {
+                // chunk transfer ids have the top bit set, serials don't
+                if (new Uint8Array(event.data, 0, 1)[0] & 0x80) {
+                    return receiveChunk(event.data);
+                }
+                return receiveKeys(event.data);
+            }
+            console.debug("Data received: " + event.data);
+            try {
+                message = JSON.parse(event.data);
+                // a slow client may get several key events in one array
+                [].concat(message).forEach(receiveKey);
+            } catch (parseError) {
+                console.error("unexpected message: " + parseError);
+                message = event.data;
+            }
+        };
+        webSocket.onclose = function(event) {
+            console.debug("Connection closed, code: " +
+                event.code + ", reason: \"" +
+                event.reason + "\", was clean: " + event.wasClean);
+            console.info("reconnecting in " + retryDelay + "ms");
+            window.setTimeout(connect, retryDelay);
+            retryDelay = Math.min(retryDelay * 2, 8000);
+        };
+        webSocket.onerror = function(event) {
+            console.warn("Connection closed due to error", event);
+        };
+        webSocket.onopen = function(event) {
+            console.info("Connection opened to " + location.host);
+            retryDelay = 500;
+            // send last serial seen only when resuming, not on first load,
+            // and how much of any document we were in the middle of getting
+            let greeting = "stopgap editor " + origin;
+            if (receiving) {
+                greeting += " " + receiving.serial + " " +
+                    receiving.transfer + " " + receiving.received;
+            } else if (lastSerial) {
+                greeting += " " + lastSerial;
+            }
+            webSocket.send(greeting);
+            if (view) view.requested = false;  // that answer isn't coming
+            // server ignores any of these it already has
+            outbox.forEach(transmit);
+        };
+    };
+    connect();
     console.info("WebSocket connection initialized");
+    // keep this page on the device for next time, which browsers only
+    // allow for pages from localhost or over https
+    if ("serviceWorker" in navigator && window.isSecureContext) {
+        navigator.serviceWorker.register("serviceworker.js").catch(
+            function(error) {
+                console.warn("service worker not registered: " + error);
+            });
+    }
 };
 console.info("stopgap.js loaded");
 // vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -2,281 +2,108 @@
 '''
 server for stopgap implementation
 '''
-import sys, os, logging, socket, json, re  # pylint: disable=multiple-imports
+# pylint: disable=multiple-imports
+import sys, os, time, socket, logging, signal, selectors
 import posixpath as httppath
-from http.server import SimpleHTTPRequestHandler, HTTPStatus, test as serve
-from http.client import parse_headers
-from io import BytesIO
-#from urllib.parse import parse_qs
-from threading import Thread, enumerate as threading_enumerate
-from select import select
-from wsserver import create_key, launch_websocket, package, MAXPACKET, FIN, \
-    OPCODE, SUPPORTED, MASKED, PAYLOAD_SIZE, CLOSE, PINGS, FAVICONS
+from http.server import HTTPServer, test as serve
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, enumerate as threading_enumerate
+from journal import Journal
+from bus import Bus, LINKS
+from client import CONNECTIONS, WRITER, MAX_CONNECTIONS, HTTP_TIMEOUT, \
+    HEARTBEAT_TICK, refuse, heartbeat
+from sessions import SESSIONS, recover, evict
+from supervisor import HANDOFF, supervise, supervised, attend, adopt
+from handlers import WebSocketHandler, handler
+from relay import sequence, release, listen
+from wsserver import background
+from loop import loop_serve
 
 ADDRESS = os.getenv('LOCAL') or '127.0.0.1'
 PORT = os.getenv('PORT') or 8000
+# `threads` for a pool of HTTP threads, and then a thread per websocket,
+# `loop` to serve everything from a single `selectors` event loop
+ENGINE = os.getenv('ENGINE') or 'threads'
+# processes accepting connections on the same port, more than 1 to use more
+# than one core. the process started becomes the hub: it gives key events
+# their serial numbers and journals them, and relays them to the workers
+WORKERS = int(os.getenv('WORKERS') or 1)
+# SUPERVISE=1 runs the server as the child of a supervisor, which holds the
+# listening socket. on SIGHUP (`make restart`) the supervisor starts another
+# child, running whatever code is now on disk, and the old one hands it
+# every websocket, so editors carry on typing without reconnecting
+SUPERVISE = bool(os.getenv('SUPERVISE'))
+# HTTP requests are handled by a pool of HTTP_THREADS threads, websockets
+# getting threads of their own once upgraded. a connection that finds them
+# all busy with HTTP_BACKLOG more waiting gets a quick `503 Service
+# Unavailable`, as does one over MAX_CONNECTIONS.
+HTTP_THREADS = int(os.getenv('HTTP_THREADS') or 16)
+HTTP_BACKLOG = int(os.getenv('HTTP_BACKLOG') or 32)
 KEYS = [chr(n).encode() for n in range(32, 127)]
-CLIENTS = set()
-FILE_CONTENT = 'multipart/form-data; boundary='
-EDIT_FILE = {  # file from `open` menu
-    'headers': None,
-    'body': None
-}
-# pylint: disable=consider-using-f-string
 
-class WebSocketHandler(SimpleHTTPRequestHandler):
+class PooledServer(HTTPServer):
     '''
-    subclass to take care of some things differently from system library
+    threaded engine's server, handling requests in a bounded pool of
+    threads, and turning connections away when it's saturated
     '''
-    def do_GET(self):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(HTTP_THREADS, 'http')
+        self.admitted = 0  # connections being handled or waiting for it
+        self.lock = Lock()
+        HANDOFF.server = self
+
+    def server_bind(self):
         '''
-        handle WebSocket requests
+        use the supervisor's listening socket, if there is one
         '''
-        logging.debug('handling GET request for %s', self.path)
-        logging.debug('socket at do_GET(): %s', self.connection)
-        return super().do_GET()
+        if LINKS.listener is None:
+            super().server_bind()
+            return
+        self.socket.close()
+        self.socket = LINKS.listener
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name, self.server_port = socket.getfqdn(host), port
 
-    def do_POST(self):  # pylint: disable=invalid-name
+    def process_request(self, request, client_address):
         '''
-        handle POST calls with command functions
+        queue connection for the pool, unless it's full
         '''
-        logging.debug('handling POST request for %s', self.path)
-        command = self.path.lstrip('/')
-        if command in dir(self) and callable(getattr(self, command)):
-            return getattr(self, command)()
-        logging.debug('POST headers: %s', self.headers)
-        content_length = int(self.headers.get('content-length', '0'))
-        content_type = self.headers.get('content-type')
-        response = None
-        if content_length > 0 and content_type.startswith(FILE_CONTENT):
-            boundary = content_type[len(FILE_CONTENT):].strip('-').encode()
-            pattern = re.compile(rb'(?:\r\n)?-*%s-*\r\n' % boundary)
-            raw_content = self.rfile.read(content_length)
-            logging.debug('raw_content: %s, boundary: %s',
-                          raw_content, boundary)
-            content, count = pattern.subn(b'', raw_content)
-            if count == 2:
-                bytesource = BytesIO(content)
-                EDIT_FILE['headers'] = dict(parse_headers(bytesource).items())
-                EDIT_FILE['body'] = bytesource.read()
-                logging.info('file being edited: %s', EDIT_FILE)
-                response = 'file contents arriving over websocket'
-            else:
-                logging.error('%d copies of boundary string found', count)
-                logging.error('not accepting file contents for editing')
-        else:
-            logging.error(
-                'POST content %d bytes, type %s not supported',
-                 content_length, content_type
-            )
-            response = 'file contents unavailable, check log'
-        self.send_response(HTTPStatus.NOT_MODIFIED, response)
-        self.end_headers()
-        return None
+        with self.lock:
+            saturated = (self.admitted >= HTTP_THREADS + HTTP_BACKLOG or
+                         self.admitted + len(CONNECTIONS) >= MAX_CONNECTIONS)
+            if not saturated:
+                self.admitted += 1
+        if saturated:
+            refuse(request, client_address)
+            self.shutdown_request(request)
+            return
+        request.settimeout(HTTP_TIMEOUT)
+        self.pool.submit(self.process_request_thread, request, client_address)
 
-    def send_head(self):
+    def process_request_thread(self, request, client_address):
         '''
-        handle favicon.ico and websocket requests internally
+        handle connection in a thread of the pool
         '''
-        logging.debug('WebSocketHandler.send_head() called')
-        if httppath.basename(self.path).startswith(FAVICONS):
-            logging.debug('sending fake (empty) favicon.ico')
-            self.send_response(HTTPStatus.OK, 'providing empty icon')
-            self.send_header('Content-type', 'image/png')
-            self.send_header('Content-Length', '0')
-            self.end_headers()
-            return None
-        if 'Sec-WebSocket-Key' in self.headers:
-            logging.debug('websocket request received')
-            if os.getenv('FORCE_WS_ERROR'):  # `make FORCE_WS_ERROR=1`
-                logging.debug('pretending not to recognize WS request')
-                self.send_response(HTTPStatus.NOT_IMPLEMENTED,
-                                   'pretending not to recognize, for debugging'
-                )
-                self.end_headers()
-                return None
-            nonce = self.headers['Sec-WebSocket-Key'].encode()
-            self.send_response_only(HTTPStatus.SWITCHING_PROTOCOLS,
-                                    'switching protocols')
-            self.send_header('Upgrade', 'websocket')
-            self.send_header('Connection', 'Upgrade')
-            self.send_header('Sec-WebSocket-Accept', create_key(nonce).decode())
-            self.end_headers()
-            # disable keep-alive from this point
-            # pylint: disable=attribute-defined-outside-init
-            self.close_connection = True
-            logging.debug('sent upgrade response')
-            logging.debug('socket before launch_websocket: %s', self.connection)
-            launch_websocket(nonce.decode(), self.connection, handler)
-            return None
-        return super().send_head()
-
-def handler(connection):
-    '''
-    handle two-way communications with websocket client
-    '''
-    # pylint: disable=too-many-locals, too-many-branches, too-many-statements
-    logging.debug('thread starting handle(%s)', connection)
-    opcode = None
-    previous = packet = b''
-    serial = 0  # serial number for keyhits
-    # pylint: disable=too-many-nested-blocks
-    ping(connection)  # send a ping to break the ice
-    while True: # receive keyhits and dispatch them back out to all threads
         try:
-            if PINGS['received']:
-                connection.send(package(PINGS['received'][-1]), 'pong')
-                PINGS['received'][:] = []  # erase this and any prior pings
-            logging.debug('awaiting packet on %s', connection)
-            # attempted fix for when we get a truncated packet with only
-            # the first two bytes, as happened in commit 17aed9a3
-            packet = packet or (previous + connection.recv(MAXPACKET))
-            logging.debug('packet: %s...', packet[:64])
-            offset = 0
-            serialized = None  # for joining key with serial number
-            if len(packet) >= 2:
-                if (packet[offset] & FIN) != FIN:
-                    logging.error('we only support unfragmented messages')
-                    raise NotImplementedError('fragments not supported')
-                if len(packet) == MAXPACKET:
-                    logging.error('large packets not supported')
-                    raise StopIteration('packet too large, cannot re-sync')
-                opcode = OPCODE[packet[offset] & 0xf]
-                logging.debug('opcode: %s', opcode)
-                if opcode not in SUPPORTED:
-                    logging.error('we only support opcodes %s', SUPPORTED)
-                    logging.error('offending opcode: %d', opcode)
-                    raise NotImplementedError('opcode not supported')
-                masked = bool(packet[offset + 1] & MASKED)
-                if not masked:
-                    logging.error('unmasked client data violates standard')
-                    raise NotImplementedError('unmasked data not supported')
-                payload_size = packet[offset + 1] & PAYLOAD_SIZE
-                offset += 2  # move to masking key (for short payload anyway)
-                if payload_size == 126:
-                    payload_size = int.from_bytes(
-                        packet[offset + 2:offset + 4], 'big'
-                    )
-                    offset += 2
-                elif payload_size == 127:
-                    payload_size = int.from_bytes(
-                        packet[offset + 2: offset + 6], 'big'
-                    )
-                    offset += 4
-                masking_key = packet[offset:offset + 4]
-                logging.debug('masking key: %s', masking_key)
-                offset += 4  # skip past masking key to payload
-                payload = bytearray(packet[offset:])
-                if len(payload) > payload_size:
-                    logging.error('payload unexpected size: %s', payload)
-                    logging.info('assuming we got more than one packet')
-                    # split off additional packet[s]
-                    packet = bytes(payload[payload_size:])
-                    payload = payload[:payload_size]
-                    previous = b''
-                elif len(payload) < payload_size:
-                    logging.error('received truncated packet %s', packet)
-                    previous = packet
-                    packet = b''
-                else:
-                    previous = packet = b''
-                for i in range(payload_size):
-                    payload[i] = payload[i] ^ masking_key[i % 4]
-                logging.info('payload: %s', payload)
-                if opcode == 'close':
-                    code, reason = (
-                        int.from_bytes(payload[:2], 'big'),
-                        payload[2:]
-                    )
-                    logging.warning('client closed connection: %d, %s',
-                                    code, reason)
-                    raise StopIteration('remote end initiated closure')
-                if opcode == 'ping':
-                    if len(payload) <= 125:
-                        PINGS['received'].append(payload)
-                        PINGS['received'][0:-2] = []  # only keep last 2
-                    else:
-                        logging.error('ping payload must not exceed 125 bytes')
-                elif opcode == 'pong':
-                    if PINGS['sent']:
-                        if payload != PINGS['sent'][-1]:
-                            logging.error(
-                                'pong payload %s does not match our ping %s',
-                                payload, PINGS['sent'][-1]
-                            )
-                        else:
-                            logging.info('received pong for ping %s', payload)
-                    else:
-                        logging.warning('pong %s unsolicited', payload)
-                    PINGS['sent'][:] = []  # erase any sent pings
-                elif payload == b'stop':
-                    connection.send(package(
-                        CLOSE.to_bytes(2, 'big') +
-                            b"server closed on client's request",
-                        'close')
-                    )
-                elif payload == b'stopgap editor':
-                    logging.info('stopgap editor found at %s', connection)
-                    CLIENTS.add(connection)
-                else:
-                    try:
-                        message = json.loads(payload)
-                    except json.JSONDecodeError:
-                        logging.warning('could not decode %r', payload)
-                        continue
-                    # serial numbers must be nonzero, so increment first.
-                    # same key/serial number gets sent to all clients.
-                    serial += 1
-                    echo = message.pop('echo')
-                    message.update({'serial': serial})
-                    serialized = pack(message)
-                    for client in list(CLIENTS):
-                        if client is connection and not echo:
-                            logging.debug('not echoing %s back to sender %s',
-                                          message['key'], client)
-                        else:
-                            try:
-                                logging.debug("sending key %r to %s",
-                                              message['key'], client)
-                                client.send(package(serialized))
-                            except OSError as broken:
-                                logging.warning(
-                                    'removing client %s after failed send: %s',
-                                    client, broken
-                                )
-                                CLIENTS.remove(client)
-            elif not packet:
-                raise StopIteration('remote end closed unexpectedly')
-            else:
-                raise ValueError('insufficient packet length: %d' % len(packet))
-        except (NotImplementedError, ValueError, IndexError) as error:
-            logging.error('error in processing message: %s', error)
-        except (StopIteration, ConnectionResetError, BrokenPipeError) as ended:
-            logging.info('remote end closed: %s', ended)
-            try:  # ignore failure on shutdown
-                connection.shutdown(socket.SHUT_WR)
-                connection.close()
-            finally:
-                threads = threading_enumerate()
-                logging.debug('threads remaining: %s', threads)
-                sys.exit(0)
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.admitted -= 1
 
-def background():
-    '''
-    iPhone trick for running from iSH
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
-    runs in separate thread to keep server active while browser in foreground
+class ReusePortServer(PooledServer):
     '''
-    try:
-        with open('/dev/location', encoding='utf-8') as infile:
-            logging.debug('keepalive thread launched in background')
-            while select([infile], [], [infile]):
-                location = infile.read()
-                logging.debug('location: %r', location)
-                if not location:
-                    break
-    except FileNotFoundError:
-        logging.debug('no /dev/location file found')
+    threaded engine's server, sharing its port with other workers
+    '''
+    allow_reuse_port = True
 
 def dispatch(path):
     '''
@@ -284,58 +111,169 @@ def dispatch(path):
     '''
     command = httppath.splitext(httppath.split(path)[1])[0]
     logging.debug('command: %s', command)
-    if command == 'stopgap':
-        logging.debug('launching HTTP server')
-        keepalive = Thread(target=background, daemon=True)
-        keepalive.start()
-        try:
-            serve(HandlerClass=WebSocketHandler, bind=ADDRESS,
-                  protocol='HTTP/1.1', port=PORT)
-        except OSError as failed:
-            logging.critical('cannot bind %s:%s: %s', ADDRESS, PORT, failed)
-            sys.exit(1)
-        finally:  # KeyboardInterrupt already trapped and sys.exit() called
-            threads = threading_enumerate()
-            logging.debug('threads: %s', threads)
-            logging.debug('waiting for keepalive thread to exit')
-    else:
+    if command != 'stopgap':
         logging.error('no longer supports CGI scripts')
+        return
+    if SUPERVISE:
+        if WORKERS > 1:
+            logging.critical('SUPERVISE is for WORKERS=1 only')
+            sys.exit(1)
+        supervise(ADDRESS, PORT)
+        return
+    launch()
 
-def get_ip_address(remote='1.1.1.1', port=33434):
+def launch():
+    '''
+    recover the default session, fork the workers if there are to be any,
+    and serve until told to stop
     '''
-    returns external (NAT, if used) IP address of Internet-connected machine
+    # SIGHUP (`make restart`) is for the supervisor: anything else,
+    # which would otherwise die of it, ignores it, as do workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if os.getenv('STOPGAP_SUPERVISOR'):
+        supervised()
+    default = SESSIONS['']
+    default.journal = Journal()
+    recover(default)
+    buses = []
+    for worker in range(WORKERS if WORKERS > 1 else 0):
+        buses.append(spawn(worker, buses))
+    default.start()
+    logging.debug('launching HTTP server')
+    keepalive = Thread(target=background, daemon=True)
+    keepalive.start()
+    try:
+        if buses:
+            hub(buses)
+        else:
+            work()
+    except OSError as failed:
+        logging.critical('cannot bind %s:%s: %s', ADDRESS, PORT, failed)
+        sys.exit(1)
+    except EOFError as ended:  # event loop's supervisor has gone
+        logging.info('exiting: %s', ended)
+    finally:  # KeyboardInterrupt already trapped and sys.exit() called
+        shutdown(buses)
+
+def shutdown(buses):
+    '''
+    stop the workers, and close every session
+    '''
+    for bus in buses:
+        bus.close()  # which tells the worker to exit
+        try:
+            os.waitpid(bus.pid, 0)
+        except ChildProcessError:  # already gone
+            pass
+    for session in list(SESSIONS.values()):
+        session.close()
+    threads = threading_enumerate()
+    logging.debug('threads: %s', threads)
+    logging.debug('waiting for keepalive thread to exit')
 
-    https://stackoverflow.com/a/25850698/493161
+def work():
+    '''
+    serve HTTP and websockets with the chosen ENGINE
+    '''
+    if ENGINE == 'loop':
+        loop_serve(ADDRESS, PORT, WORKERS > 1)
+    else:
+        WRITER.start()
+        Thread(target=heartbeats, daemon=True).start()
+        if LINKS.hub is not None:
+            Thread(target=listen, daemon=True).start()
+        if LINKS.supervisor is not None:
+            Thread(target=attend, daemon=True).start()
+        for client in adopt():
+            Thread(target=handler, args=(client.connection, client.session),
+                   kwargs={'client': client}, daemon=True).start()
+        serve(HandlerClass=WebSocketHandler, ServerClass=ReusePortServer
+              if WORKERS > 1 else PooledServer, bind=ADDRESS,
+              protocol='HTTP/1.1', port=PORT)
+        with HANDOFF.condition:  # stopped for handoff, which will exit
+            HANDOFF.condition.wait_for(lambda: not HANDOFF.frozen)
 
-    uses innocuous traceroute port 33434 by default, even though UDP doesn't
-    actually send a packet on `connect`
+def spawn(worker, buses):
+    '''
+    fork a worker process, returning the hub's Bus to it
 
-    1.1.1.1 is a public cloudflare DNS service
+    the worker starts with a copy of the default session's document and
+    replay history as they are now, and keeps them up to date from what
+    the hub relays; other sessions it asks the hub for as needed. it exits
+    with status 2 if it can't serve at all, so the hub knows better than
+    to replace it.
     '''
-    address = None
+    # pylint: disable=protected-access, broad-except
+    ours, theirs = socket.socketpair(socket.AF_UNIX)
+    pid = os.fork()
+    if pid:
+        theirs.close()
+        logging.info('started worker %d, pid %d', worker, pid)
+        return Bus(ours, worker, pid)
+    ours.close()
+    for bus in buses:  # those of the other workers
+        bus.close()
+    LINKS.hub = Bus(theirs, worker)
+    for name in [name for name in SESSIONS if name]:
+        del SESSIONS[name]  # the hub's, which it may close any time
+    SESSIONS[''].journal = None  # only the hub journals
     try:
-        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        probe.connect((remote, port))
-        address = probe.getsockname()[0]
-    except (OSError, IndexError, RuntimeError) as problem:
-        logging.error('Cannot determine IP address: %s', problem)
-    return address
+        work()
+    except (KeyboardInterrupt, SystemExit):
+        os._exit(0)
+    except EOFError as ended:
+        logging.info('worker %d exiting: %s', worker, ended)
+    except OSError as failed:
+        logging.critical('worker %d cannot serve: %s', worker, failed)
+        os._exit(2)
+    except Exception:
+        logging.exception('worker %d failed', worker)
+    os._exit(1)
 
-def pack(message_dict):
+def hub(buses):
     '''
-    pack message, passed as dict, into shortest possible JSON bytestring
+    sequence key events from all workers, and relay them to every one
+
+    a worker that dies is replaced
     '''
-    return json.dumps(message_dict, separators=(',', ':')).encode()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    selector = selectors.DefaultSelector()
+    for bus in buses:
+        selector.register(bus, selectors.EVENT_READ)
+    try:
+        while True:
+            for key, _ in selector.select():
+                bus = key.fileobj
+                try:
+                    for fields, body in bus.receive():
+                        sequence(buses, bus, fields, body)
+                except EOFError as ended:
+                    selector.unregister(bus)
+                    bus.close()
+                    status = os.waitstatus_to_exitcode(
+                        os.waitpid(bus.pid, 0)[1])
+                    if status == 2:
+                        logging.critical('%s, giving up', ended)
+                        sys.exit(1)
+                    logging.error('%s, status %d, replacing it', ended,
+                                  status)
+                    for name in list(SESSIONS):
+                        release(name, bus.worker)
+                    buses[bus.worker] = spawn(bus.worker, buses)
+                    selector.register(buses[bus.worker],
+                                      selectors.EVENT_READ)
+    except KeyboardInterrupt:
+        logging.info('keyboard interrupt received, exiting')
+        sys.exit(0)
 
-def ping(connection):
+def heartbeats():
     '''
-    send ping packet
+    threaded engine's timer for `heartbeat`
     '''
-    payload = str(PINGS['serial']).encode()
-    PINGS['serial'] += 1
-    connection.send(package(payload, 'ping'))
-    PINGS['sent'].append(payload)
-    PINGS['sent'][0:-2] = []  # only keep last 2
+    while True:
+        time.sleep(HEARTBEAT_TICK)
+        heartbeat()
+        evict()
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+'''
+completions of the word being typed, from a word list and the words of
+the document itself
+
+words are kept in a sorted list, so those starting with a prefix are a
+slice found by `bisect`; the best few for each prefix asked for are kept,
+and updated in place as words are typed, so asking again costs a lookup
+'''
+import os, re, heapq, logging  # pylint: disable=multiple-imports
+from bisect import bisect_left, insort
+from collections import Counter
+
+# one word per line, optionally followed by how common it is, as a count
+WORDLIST = os.getenv('WORDLIST') or '/usr/share/dict/words'
+WORD = re.compile(r"[^\W\d_]{2,}")  # words worth suggesting, in a text
+PREFIX = re.compile(r"[^\W\d_]*$")  # word being typed, at end of a text
+PREFIX_MAX = 32  # characters before the caret searched for it
+LAST = '\U0010ffff'  # sorts after any character a word can have
+# pylint: disable=consider-using-f-string
+
+def prefix(text):
+    '''
+    letters at the end of text, that a completion would continue
+
+    >>> prefix('Hello, wor'), prefix('Hello, '), prefix("it's")
+    ('wor', '', 's')
+    '''
+    return PREFIX.search(text).group()
+
+def words(text):
+    '''
+    Counter of the words in text, lowercased
+
+    >>> sorted(words('The cat, the hat, a 2nd hat.').items())
+    [('cat', 1), ('hat', 2), ('nd', 1), ('the', 2)]
+    '''
+    return Counter(word.lower() for word in WORD.findall(text))
+
+def wordlist(path=WORDLIST):
+    '''
+    Counter of the words in a word list, each counted once unless a
+    count follows it; empty if there is no such file
+    '''
+    counts = Counter()
+    try:
+        with open(path, encoding='utf-8', errors='replace') as infile:
+            for line in infile:
+                word, _, count = line.strip().partition(' ')
+                if WORD.fullmatch(word):
+                    counts[word.lower()] += int(count or 1)
+    except OSError as failed:
+        logging.warning('no word list for suggestions: %s', failed)
+    return counts
+
+class Best(list):
+    '''
+    best completions of a prefix, and how many of them were asked for
+    '''
+    __slots__ = ('wanted',)
+
+    def __init__(self, completions, wanted):
+        super().__init__(completions)
+        self.wanted = wanted
+
+class Index:
+    '''
+    words by prefix, ranked by how often they've been seen, then by length
+
+    >>> index = Index({'the': 5, 'then': 2, 'there': 2, 'this': 1})
+    >>> index.complete('th', 3)
+    ['the', 'then', 'there']
+    >>> index.complete('the', 3)
+    ['then', 'there']
+    >>> for _ in range(4):
+    ...     index.add('there')
+    >>> index.complete('th', 3), index.complete('Thi', 3)
+    (['there', 'the', 'then'], ['This'])
+    >>> index.add('thorn')
+    >>> index.complete('tho', 3), index.complete('x', 3)
+    (['thorn'], [])
+    >>> index.update({'than': 9, 'the': 1})
+    >>> index.complete('th', 3)
+    ['than', 'the', 'there']
+    '''
+    def __init__(self, counts=None):
+        self.counts = Counter(counts or {})
+        self.words = sorted(self.counts)
+        self.best = {}  # the most completions ever asked for, by prefix
+
+    def copy(self):
+        '''
+        independent Index with the same words, and what it has found
+        '''
+        index = Index.__new__(Index)
+        index.counts = self.counts.copy()
+        index.words = self.words.copy()
+        index.best = self.best.copy()  # lists are replaced, never changed
+        return index
+
+    def rank(self, word):
+        '''
+        sort key, the best completions coming first
+        '''
+        return -self.counts[word], len(word), word
+
+    def update(self, counts):
+        '''
+        add many words at once, such as a whole document's
+        '''
+        new = [word for word in counts if word not in self.counts]
+        self.counts.update(counts)
+        self.words = sorted(self.words + new)  # two runs, merged by sort
+        self.rerank(counts)
+
+    def add(self, word):
+        '''
+        count one more use of word, as when it has just been typed
+        '''
+        word = word.lower()
+        if word not in self.counts:
+            insort(self.words, word)
+        self.counts[word] += 1
+        self.rerank([word])
+
+    def rerank(self, changed):
+        '''
+        keep the best completions found so far right, after the changed
+        words were counted again: they are the only ones that can move
+        '''
+        more = {}
+        for word in changed:
+            for length in range(len(word) + 1):
+                if word[:length] in self.best:
+                    more.setdefault(word[:length], set()).add(word)
+        for start, moved in more.items():
+            best = self.best[start]
+            self.best[start] = Best(sorted(set(best) | moved, key=self.rank)[
+                :best.wanted], best.wanted)
+
+    def prime(self, count):
+        '''
+        find the best completions of every one-letter prefix, the slowest
+        to find, ahead of time
+        '''
+        for letter in {word[:1] for word in self.words}:
+            self.complete(letter, count)
+
+    def complete(self, typed, count):
+        '''
+        up to `count` words starting with what was typed, longer than it,
+        in the same case as far as it goes
+        '''
+        start = typed.lower()
+        best = self.best.get(start)
+        if best is None or best.wanted < count + 1:
+            low = bisect_left(self.words, start)
+            high = bisect_left(self.words, start + LAST, low)
+            # one extra, in case the prefix itself is among them
+            best = self.best[start] = Best(heapq.nsmallest(
+                count + 1, self.words[low:high], key=self.rank), count + 1)
+        return [typed + word[len(typed):] for word in best
+                if len(word) > len(typed)][:count]
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+'''
+running the server as the child of a supervisor, which holds the
+listening socket, so that it can be replaced by one running new code
+without anybody having to reconnect
+
+on SIGHUP (`make restart`) the supervisor starts another child, and the
+old one stops reading and hands it every websocket by way of the
+supervisor: the socket itself, what had arrived of its next frame and was
+still to be sent, and its editor's place in the key event stream. a child
+that dies is restarted, and one that won't start leaves the old one
+serving.
+'''
+# pylint: disable=multiple-imports
+import sys, os, time, socket, logging, signal, selectors
+from select import select
+from threading import Condition
+from wsserver import package, Deflate
+from journal import SAVE_DIR
+from bus import Bus, LINKS
+from client import Client, Gather, CONNECTIONS, BUFFERSIZE
+from sessions import SESSIONS, opened
+
+# written by the supervisor, so `make restart` signals only a supervisor
+SUPERVISOR_PIDFILE = os.path.join(SAVE_DIR, 'supervisor.pid')
+RESTART_TIMEOUT = float(os.getenv('RESTART_TIMEOUT') or 30)  # seconds
+SERVICE_RESTART = 1012  # websocket close code: reconnect, and all is well
+# pylint: disable=consider-using-f-string
+
+class Handoff:
+    '''
+    state of handing websockets off to the replacement server
+    '''
+    def __init__(self):
+        self.frozen = False  # set once handoff starts, so nothing more is read
+        self.wakeup = None  # pipe, written then, that handler threads poll
+        self.condition = Condition()  # guards the counts
+        self.running = 0  # threaded engine's websocket handlers
+        self.parked = 0  # and how many of them have stopped reading
+        self.server = None  # threaded engine's HTTP server, to stop accepting
+        self.handed = []  # messages from the server this one replaces
+
+    def prepare(self):
+        '''
+        make the pipe that wakes handler threads when handoff starts
+        '''
+        self.wakeup = os.pipe()
+
+    def freeze(self):
+        '''
+        stop handler threads reading, and the server accepting
+        '''
+        with self.condition:
+            self.frozen = True
+        os.write(self.wakeup[1], b'\0')
+        if self.server is not None:
+            self.server.shutdown()
+
+    def admit(self):
+        '''
+        count in a websocket handler thread, unless handoff has started
+        '''
+        with self.condition:
+            if self.frozen:
+                return False
+            self.running += 1
+            return True
+
+    def leave(self):
+        '''
+        count out a websocket handler thread, which has finished
+        '''
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+HANDOFF = Handoff()
+
+def supervise(address, port):
+    '''
+    hold the listening socket, and keep a server running on it as a child
+    process: replaced on SIGHUP by a new one, to which the old one hands
+    its websockets, and restarted should it die
+
+    the child exits with status 2 if it can't serve at all, as a worker
+    does, and then the supervisor gives up
+    '''
+    listener = socket.create_server((address, int(port)))
+    os.set_inheritable(listener.fileno(), True)
+    signals, wakeup = socket.socketpair()
+    signal.signal(signal.SIGHUP, lambda *args: wakeup.send(b'\0'))
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    os.makedirs(SAVE_DIR, exist_ok=True)
+    with open(SUPERVISOR_PIDFILE, 'w', encoding='ascii') as pidfile:
+        pidfile.write('%d\n' % os.getpid())
+    child = start(listener)
+    try:
+        while child is not None:
+            ready = select([child, signals], [], [])[0]
+            if signals in ready:
+                signals.recv(BUFFERSIZE)
+                child = restart(listener, child)
+                continue
+            try:
+                list(child.receive())  # it has nothing to say but this
+            except EOFError:
+                child.close()
+                status = os.waitstatus_to_exitcode(
+                    os.waitpid(child.pid, 0)[1])
+                if status == 2:
+                    logging.critical('server cannot serve, giving up')
+                    sys.exit(1)
+                logging.error('server exited with status %d, restarting',
+                              status)
+                child = start(listener)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        logging.info('keyboard interrupt received, exiting')
+        sys.exit(0)
+    finally:
+        os.remove(SUPERVISOR_PIDFILE)
+        if child is not None:
+            child.close()
+            os.kill(child.pid, signal.SIGTERM)
+            os.waitpid(child.pid, 0)
+
+def start(listener, successor=False):
+    '''
+    supervisor's new server, running this script afresh on `listener`
+
+    returns Bus to it once it says it's ready, or None if it doesn't
+    within RESTART_TIMEOUT seconds. as a `successor`, it then waits to be
+    handed the websockets of the one it replaces.
+    '''
+    ours, theirs = socket.socketpair(socket.AF_UNIX)
+    os.set_inheritable(theirs.fileno(), True)
+    environment = dict(os.environ, SUPERVISE='',
+                       STOPGAP_SUPERVISOR=str(theirs.fileno()),
+                       STOPGAP_LISTENER=str(listener.fileno()))
+    if successor:
+        environment['STOPGAP_HANDOFF'] = '1'
+    pid = os.posix_spawn(sys.executable, [
+        sys.executable, os.path.abspath(sys.argv[0])], environment)
+    theirs.close()
+    bus = Bus(ours, 0, pid)
+    deadline = time.monotonic() + RESTART_TIMEOUT
+    try:
+        while select([bus], [], [], max(deadline - time.monotonic(), 0))[0]:
+            for fields, _ in bus.receive():
+                if 'ready' in fields:
+                    logging.info('started server, pid %d', pid)
+                    return bus
+        logging.error('server pid %d not ready after %s seconds', pid,
+                      RESTART_TIMEOUT)
+        os.kill(pid, signal.SIGTERM)
+    except EOFError:
+        logging.error('server pid %d exited before it was ready', pid)
+    bus.close()
+    os.waitpid(pid, 0)
+    return None
+
+def restart(listener, child):
+    '''
+    replace child with a new server, relaying it the websockets the old
+    one hands off; returns Bus to whichever is now serving
+
+    if the new one doesn't start, say because the code on disk is broken,
+    the old one carries on as if nothing had happened
+    '''
+    logging.info('replacing server pid %d', child.pid)
+    successor = start(listener, successor=True)
+    if successor is None:
+        logging.error('keeping server pid %d', child.pid)
+        return child
+    child.post({'handoff': True})
+    handed = False
+    try:
+        while not handed:
+            select([child], [], [])
+            for fields, body in child.receive():
+                fds = fields.pop('fds', [])
+                try:
+                    successor.post(fields, body, fds)
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+                handed = 'handed' in fields
+    except EOFError as ended:
+        logging.error('%s during handoff', ended)
+        successor.post({'handed': None})
+    child.close()
+    os.waitpid(child.pid, 0)
+    logging.info('server pid %d replaced by pid %d', child.pid,
+                 successor.pid)
+    return successor
+
+def supervised():
+    '''
+    in a supervisor's child: take the listening socket and the Bus it
+    passed down, and say we're ready; then, if replacing another child,
+    wait for what it hands over, for `adopt`
+    '''
+    LINKS.supervisor = Bus(socket.socket(
+        fileno=int(os.environ.pop('STOPGAP_SUPERVISOR'))), 0)
+    LINKS.listener = socket.socket(
+        fileno=int(os.environ.pop('STOPGAP_LISTENER')))
+    HANDOFF.prepare()
+    LINKS.supervisor.post({'ready': os.getpid()})
+    if os.environ.pop('STOPGAP_HANDOFF', None):
+        handed = HANDOFF.handed
+        while not handed or 'handed' not in handed[-1][0]:
+            handed.extend(LINKS.supervisor.receive())
+
+def attend():
+    '''
+    threaded engine's reader of what the supervisor sends
+    '''
+    try:
+        while True:
+            for fields, _ in LINKS.supervisor.receive():
+                if 'handoff' in fields:
+                    handoff()
+    except (EOFError, OSError) as ended:
+        logging.info('supervisor gone, exiting: %s', ended)
+        os._exit(1)  # pylint: disable=protected-access
+
+def readable(poller):
+    '''
+    threaded handler's wait for input, when supervised, which never
+    returns once handoff has started: the handler's part in it is to stop
+    reading, after acting on everything it had read
+    '''
+    poller.poll()
+    if HANDOFF.frozen:
+        with HANDOFF.condition:
+            HANDOFF.parked += 1
+            HANDOFF.condition.notify_all()
+            HANDOFF.condition.wait_for(lambda: not HANDOFF.frozen)
+
+def handoff():
+    '''
+    hand every websocket, with what's needed to carry on with it, to the
+    server replacing this one, by way of the supervisor; then exit
+
+    connections not yet accepted wait in the listening socket's queue,
+    which the supervisor and the new server share
+    '''
+    logging.info('handing off %d websockets', len(CONNECTIONS))
+    HANDOFF.freeze()
+    with HANDOFF.condition:
+        if not HANDOFF.condition.wait_for(
+                lambda: HANDOFF.parked >= HANDOFF.running,
+                RESTART_TIMEOUT):
+            logging.error('%d handlers still busy, handing off anyway',
+                          HANDOFF.running - HANDOFF.parked)
+    sent = {}
+    for session in list(SESSIONS.values()):
+        sent[session.name] = dict(session.sequencer.sent)
+        session.close()
+    LINKS.supervisor.post({'sent': sent})
+    clients = [client for client in list(CONNECTIONS) if not client.closed]
+    for client in clients:
+        state, data = parting(client)
+        LINKS.supervisor.post({'websocket': state}, data, [client.fileno()])
+    LINKS.supervisor.post({'handed': len(clients)})
+    os._exit(0)  # pylint: disable=protected-access
+
+def parting(client):
+    '''
+    (state, data) of websocket being handed off, data being what had
+    arrived of its next frame, then what was still to be sent it
+
+    one that can't carry on in another process is marked to be closed
+    there, once sent what it was due: one with chunks of a document still
+    to come, or with compression state that can't be copied
+    '''
+    with client.lock:
+        pending = b''.join(b''.join(frame.pieces) if isinstance(
+            frame, Gather) else bytes(frame) for frame, _ in client.queue)
+        pending = pending[client.offset:]
+        client.closed = True  # so nothing more is queued or sent here
+        client.queue.clear()
+    deflate = client.deflate
+    try:
+        received = client.decoder.unparsed()
+        portable = (client.transfer is None or client.transferred >= len(
+            client.transfer.contents)) and (deflate is None or not (
+                deflate.server_takeover or deflate.client_takeover))
+    except BufferError:
+        received, portable = b'', False
+    return {
+        'session': client.session.name,
+        'address': client.address,
+        'origin': client.origin,
+        'binary': client.binary,
+        'editor': client in client.session.clients,
+        'deflate': deflate.response if deflate and portable else None,
+        'received': len(received),
+        'close': not portable,
+    }, received + pending
+
+def adopt(selector=None):
+    '''
+    take over the websockets handed off by the server this one replaced,
+    registering them with the event loop's `selector` if given; returns
+    them, for the threaded engine to start their handlers
+
+    all of them rejoin their sessions before any is read from, so none
+    misses a key event from another
+    '''
+    handed, HANDOFF.handed = HANDOFF.handed, []
+    clients = []
+    for fields, data in handed:
+        for name, sent in fields.get('sent', {}).items():
+            opened(name).sequencer.sent.update(sent)
+        if 'websocket' not in fields:
+            continue
+        state = fields['websocket']
+        connection = socket.socket(fileno=fields['fds'][0])
+        connection.setblocking(selector is None)
+        client = Client(connection, tuple(state['address'] or ()) or None)
+        client.upgrade(opened(state['session']),
+                       Deflate.negotiate(state['deflate']), state['binary'])
+        if selector is not None:  # not read from until adopt() returns
+            selector.register(client, selectors.EVENT_READ, client)
+        resume(client, state, data)
+        clients.append(client)
+    if handed:
+        logging.info('adopted %d websockets', len(clients))
+    return clients
+
+def resume(client, state, data):
+    '''
+    carry on with a websocket handed off by the server this one replaced
+    '''
+    client.origin = state['origin']
+    client.decoder.feed(data[:state['received']])
+    with client.lock:
+        if len(data) > state['received']:
+            client.enqueue(data[state['received']:])
+        if state['close']:
+            client.enqueue(package(SERVICE_RESTART.to_bytes(2, 'big') +
+                                   b'server restarted', 'close'))
+    if state['editor'] and not state['close']:
+        with client.session.sequencer.lock:
+            client.session.clients.add(client)
+    client.flush()
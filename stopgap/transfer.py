@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+'''
+documents sent to editors: in binary chunks that the editor acknowledges,
+or, when large, a page of lines at a time
+
+no more than TRANSFER_WINDOW bytes of a document are sent ahead of the
+editor's acknowledgements, so that key events needn't wait behind the
+whole of it, and an editor that reconnects partway through picks up where
+it left off. a document over PAGE_THRESHOLD characters isn't sent whole:
+the editor gets the lines about the caret, and asks for more as it
+scrolls.
+'''
+import os, mmap, struct, logging  # pylint: disable=multiple-imports
+from wsserver import frame_header
+from client import Gather, control
+from sessions import checkpoint
+
+# documents go to editors in binary chunks: transfer id, offset, then data
+CHUNK_HEADER = struct.Struct('>IQ')
+TRANSFER_CHUNK = 65536  # bytes of document per binary frame
+TRANSFER_WINDOW = 262144  # bytes sent but not yet acknowledged, per client
+RECENT_TRANSFERS = 2
+# documents over PAGE_THRESHOLD characters aren't sent whole: editors get
+# PAGE_LINES lines about the caret, and ask for others as they scroll
+PAGE_THRESHOLD = int(os.getenv('PAGE_THRESHOLD') or 1048576)
+PAGE_LINES = int(os.getenv('PAGE_LINES') or 200)
+# pylint: disable=consider-using-f-string
+
+class Transfer:
+    '''
+    document contents sent to editors in binary chunks
+
+    editors acknowledge chunks as they arrive, and no more than
+    TRANSFER_WINDOW bytes are sent ahead of that, so that key events
+    needn't wait behind a whole large file
+    '''
+    def __init__(self, session, contents, serial, caret):
+        # unique across runs, and with the top bit set, unlike any serial
+        self.id = int.from_bytes(os.urandom(4), 'big') | 0x80000000
+        self.contents = memoryview(contents)
+        self.serial = serial  # last key event already in contents
+        self.caret = caret
+        transfers = session.transfers
+        transfers[self.id] = self
+        while len(transfers) > RECENT_TRANSFERS:
+            del transfers[next(iter(transfers))]
+
+    def __repr__(self):
+        return '<Transfer %08x of %d bytes>' % (self.id, len(self.contents))
+
+    def start(self, client, offset=0):
+        '''
+        begin sending to client, or resume at `offset` bytes
+
+        must be called with the session's sequencer lock held, as must the
+        others below
+        '''
+        logging.info('starting %s to %s at %d', self, client, offset)
+        client.transfer = self
+        client.transferred = client.acknowledged = offset
+        client.send(control('snapshot', transfer=self.id, serial=self.serial,
+                            caret=self.caret, size=len(self.contents),
+                            offset=offset))
+        self.pump(client)
+
+    def pump(self, client):
+        '''
+        send client as many chunks as the window allows
+        '''
+        size = len(self.contents)
+        while client.transferred < size and (
+                client.transferred - client.acknowledged < TRANSFER_WINDOW):
+            offset = client.transferred
+            chunk = self.contents[offset:offset + TRANSFER_CHUNK]
+            if client.deflate is not None:
+                client.send_message(CHUNK_HEADER.pack(self.id, offset), chunk,
+                                    opcode='binary')
+            else:
+                client.send(Gather(
+                    frame_header(CHUNK_HEADER.size + len(chunk), 'binary') +
+                    CHUNK_HEADER.pack(self.id, offset), chunk))
+            client.transferred += len(chunk)
+
+    def acknowledge(self, client, offset):
+        '''
+        client has received `offset` bytes, so send it more
+        '''
+        client.acknowledged = max(client.acknowledged, offset)
+        if client.acknowledged >= len(self.contents):
+            logging.info('%s to %s complete', self, client)
+            client.transfer = None
+        else:
+            self.pump(client)
+
+def snapshot(session):
+    '''
+    Transfer of the session's document as it stands, reusing the latest
+    if current
+
+    must be called with the session's sequencer lock held, so no key event
+    gets between
+    '''
+    transfers, serial = session.transfers, session.sequencer.serial
+    latest = transfers[next(reversed(transfers))] if transfers else None
+    if latest is not None and latest.serial == serial:
+        return latest
+    return Transfer(session, str(session.document).encode(), serial,
+                    session.document.caret)
+
+def load(session, contents, serial=None):
+    '''
+    replace the session's document, and start sending it to its editors
+
+    a worker passes the `serial` the hub had when it loaded the document.
+    must be called with the session's sequencer lock held
+    '''
+    sequencer = session.sequencer
+    session.document.load(str(contents, errors='replace'))
+    session.index = None
+    if serial is not None:
+        sequencer.serial = serial
+    sequencer.restart()
+    if session.journal is not None:
+        checkpoint(session)
+    if len(session.document.rope) > PAGE_THRESHOLD:
+        frame = page(session)
+        for client in list(session.clients):
+            client.send(frame)
+        return
+    transfer = Transfer(session, contents, sequencer.serial, 0)
+    for client in list(session.clients):
+        transfer.start(client)
+
+def page(session, request=None):
+    '''
+    `page` control message, with lines of the session's document for an
+    editor: those it asked for in `request`, or PAGE_LINES about the
+    caret. an editor that says which lines it has, and has seen every key
+    event so far, is sent only the ones it hasn't.
+
+    must be called with the session's sequencer lock held
+    '''
+    document, serial = session.document, session.sequencer.serial
+    held = None
+    if request is None or request.get('caret'):
+        first, count = document.line() - PAGE_LINES // 2, PAGE_LINES
+    else:
+        first = int(request['line'])
+        count = min(int(request['lines']), 4 * PAGE_LINES)
+        if request.get('held') and request.get('serial') == serial:
+            held = tuple(map(int, request['held']))
+    return control('page', serial=serial, caret=document.caret,
+                   window=PAGE_LINES, **document.page(first, count, held))
+
+def mapped(upload):
+    '''
+    contents of spooled upload, mapped into memory rather than read
+    '''
+    upload.rollover()
+    if os.fstat(upload.fileno()).st_size == 0:
+        return b''  # can't mmap an empty file
+    return mmap.mmap(upload.fileno(), 0, access=mmap.ACCESS_READ)
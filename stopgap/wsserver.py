@@ -4,16 +4,19 @@ websocket server
 
 adapted from https://en.wikipedia.org/wiki/WebSocket
 '''
-import sys, os, time, socket, re, logging  # pylint: disable=multiple-imports
-import json
+import sys, os, time, socket, logging  # pylint: disable=multiple-imports
+import selectors
+import json, zlib  # pylint: disable=multiple-imports
 import posixpath as httppath  # for parsing URLs like filepaths
 from base64 import b64encode
 from hashlib import sha1
 from threading import Thread, enumerate as threading_enumerate
 from select import select
-from io import BytesIO
 from http.server import SimpleHTTPRequestHandler, HTTPStatus, test as serve
-from http.client import parse_headers
+try:
+    import numpy
+except ImportError:  # pure Python fallback will be used
+    numpy = None
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
 
 ADDRESS = os.getenv('LOCAL') or '127.0.0.1'
@@ -22,7 +25,7 @@ MAGIC = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'  # from WebSocket RFC6455
 MESSAGES = [b'foo', b'bar', b'baz']  # simulated message stream
 FIN = MASKED = 0b10000000  # bitmask for 'FIN' and 'MASKED' flag bits
 PAYLOAD_SIZE = 0b01111111  # bitmask for payload size
-RSV1 = RSV2 = RSV3 = 0  # reserved bits
+RSV1, RSV2, RSV3 = 0b01000000, 0b00100000, 0b00010000  # reserved bits
 CLOSE = 1000  # normal closure code per RFC 6455
 OPCODE = {
     0: 'continuation',
@@ -44,9 +47,26 @@ OPCODE = {
 }
 # allow reverse lookup, mapping (unique) opcode string to text
 OPCODE.update(dict(map(reversed, OPCODE.items())))
-SUPPORTED = ['text', 'binary', 'close', 'ping', 'pong']
+SUPPORTED = ['continuation', 'text', 'binary', 'close', 'ping', 'pong']
 MAXPACKET = 4096000  # quit on any packets this size or greater
+MAX_CONTROL = 125  # largest close, ping, or pong payload RFC 6455 allows
+BUFFERSIZE = 4096  # initial size of each connection's receive buffer
 MAX_RETRIES = 3
+# socket_serve reads upgrade requests from up to MAX_HANDSHAKES connections
+# at a time, dropping any not complete within HANDSHAKE_TIMEOUT seconds
+MAX_HANDSHAKES = int(os.getenv('MAX_HANDSHAKES') or 64)
+HANDSHAKE_TIMEOUT = float(os.getenv('HANDSHAKE_TIMEOUT') or 10)
+NUMPY_THRESHOLD = 4096  # below this, numpy setup costs more than it saves
+# permessage-deflate (RFC 7692): largest LZ77 window offered, 9 to 15 bits,
+# or 0 not to compress at all; and smallest message worth compressing,
+# so that single keystrokes aren't delayed for no gain
+DEFLATE_WINDOW_BITS = int(os.getenv('DEFLATE_WINDOW_BITS') or 15)
+DEFLATE_THRESHOLD = int(os.getenv('DEFLATE_THRESHOLD') or 256)  # bytes
+DEFLATE_LEVEL = 6  # zlib's default tradeoff of speed against size
+DEFLATE_TAIL = b'\x00\x00\xff\xff'  # ends every message, so isn't sent
+DEFLATE_PARAMETERS = ('server_no_context_takeover',
+                      'client_no_context_takeover',
+                      'server_max_window_bits', 'client_max_window_bits')
 RESPONSE = (
     b'HTTP/1.1 101 Switching Protocols\r\n'
     b'Upgrade: websocket\r\n'
@@ -62,12 +82,6 @@ PINGS = {
     'sent': [],
     'received': []
 }
-UPLOAD = {  # file from `input type="file"`
-    'headers': None,
-    'body': None
-}
-CLIENTS = set()
-FILE_CONTENT = 'multipart/form-data; boundary='
 
 # pylint: disable=consider-using-f-string
 
@@ -83,46 +97,6 @@ class WebSocketHandler(SimpleHTTPRequestHandler):
         logging.debug('socket at do_GET(): %s', self.connection)
         return super().do_GET()
 
-    def do_POST(self):  # pylint: disable=invalid-name
-        '''
-        handle POST calls with command functions
-        '''
-        logging.debug('handling POST request for %s', self.path)
-        command = self.path.lstrip('/')
-        if command in dir(self) and callable(getattr(self, command)):
-            return getattr(self, command)()
-        logging.debug('POST headers: %s', self.headers)
-        content_length = int(self.headers.get('content-length', '0'))
-        content_type = self.headers.get('content-type')
-        response = None
-        if content_length > 0 and content_type.startswith(FILE_CONTENT):
-            boundary = content_type[len(FILE_CONTENT):].strip('-').encode()
-            pattern = re.compile(rb'(?:\r\n)?-*%s-*\r\n' % boundary)
-            raw_content = self.rfile.read(content_length)
-            # we're only accepting uploads with boundary strings top & bottom
-            logging.debug('raw_content: %s, boundary: %s',
-                          raw_content, boundary)
-            # remove the boundary strings, leaving the raw uplaod bytes
-            content, count = pattern.subn(b'', raw_content)
-            if count == 2:
-                bytesource = BytesIO(content)
-                UPLOAD['headers'] = dict(parse_headers(bytesource).items())
-                UPLOAD['body'] = bytesource.read()
-                logging.info('file uploaded: %s', UPLOAD)
-                response = 'file contents arriving over websocket'
-            else:
-                logging.error('%d copies of boundary string found', count)
-                logging.error('not accepting upload')
-        else:
-            logging.error(
-                'POST content %d bytes, type %s not supported',
-                 content_length, content_type
-            )
-            response = 'file contents unavailable, check log'
-        self.send_response(HTTPStatus.NOT_MODIFIED, response)
-        self.end_headers()
-        return None
-
     def send_head(self):
         '''
         handle favicon.ico and websocket requests internally
@@ -144,25 +118,48 @@ class WebSocketHandler(SimpleHTTPRequestHandler):
                 )
                 self.end_headers()
                 return None
-            nonce = self.headers['Sec-WebSocket-Key'].encode()
-            self.send_response_only(HTTPStatus.SWITCHING_PROTOCOLS,
-                                    'switching protocols')
-            self.send_header('Upgrade', 'websocket')
-            self.send_header('Connection', 'Upgrade')
-            self.send_header('Sec-WebSocket-Accept', create_key(nonce).decode())
-            self.end_headers()
-            # disable keep-alive from this point
-            # pylint: disable=attribute-defined-outside-init
-            self.close_connection = True
-            logging.debug('sent upgrade response')
-            logging.debug('socket before launch_websocket: %s', self.connection)
-            launch_websocket(nonce.decode(), self.connection, handler)
-            return None
+            return self.send_upgrade()
+        return self.send_static()
+
+    def send_upgrade(self):
+        '''
+        accept websocket request, and hand the connection to `demo`
+        '''
+        nonce = self.headers['Sec-WebSocket-Key'].encode()
+        self.switch_protocols(nonce)
+        logging.debug('socket before launch_websocket: %s', self.connection)
+        launch_websocket(nonce.decode(), self.connection, demo)
+
+    def switch_protocols(self, nonce, headers=()):
+        '''
+        send `101 Switching Protocols`, with any extra `headers` as (name,
+        value) pairs, after which the connection is the websocket's
+        '''
+        self.send_response_only(HTTPStatus.SWITCHING_PROTOCOLS,
+                                'switching protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', create_key(nonce).decode())
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        # disable keep-alive from this point
+        # pylint: disable=attribute-defined-outside-init
+        self.close_connection = True
+        logging.debug('sent upgrade response')
+
+    def send_static(self):
+        '''
+        serve anything else as SimpleHTTPRequestHandler would
+        '''
         return super().send_head()
 
 def socket_serve(address=ADDRESS, port=PORT):
     '''
     Create socket and listen
+
+    upgrade requests are read as they arrive, from all connections at once,
+    so one slow to send its request, or that never does, holds up no others
     '''
     websocket = socket.socket()
     # allow listening even if client is already attempting to connect
@@ -176,22 +173,65 @@ def socket_serve(address=ADDRESS, port=PORT):
     websocket.bind((address, port))
     logging.debug('listening on %s', websocket)
     websocket.listen()
+    websocket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(websocket, selectors.EVENT_READ)
     while True:
-        connection = websocket.accept()[0]
-        nonce = b''
-        # Parse request
-        packet = connection.recv(MAXPACKET)
-        for line in packet.split(b'\r\n'):
-            logging.debug('received line: %s', line)
-            if line.startswith(b'Sec-WebSocket-Key'):
-                nonce = line.split(b":")[1].strip()
-        if nonce:
-            response = RESPONSE % create_key(nonce)
-            sent = connection.send(response)
-            logging.debug('sent response %r, %d bytes', response, sent)
-            launch_websocket(nonce.decode(), connection, demo)
-        else:
-            logging.warning('ignoring packet %s', packet)
+        for key, _ in selector.select(1):
+            if key.fileobj is websocket:
+                try:
+                    connection = websocket.accept()[0]
+                except BlockingIOError:
+                    continue
+                if len(selector.get_map()) > MAX_HANDSHAKES:
+                    logging.warning('too many handshakes, dropping %s',
+                                    connection)
+                    connection.close()
+                    continue
+                connection.setblocking(False)
+                selector.register(connection, selectors.EVENT_READ, {
+                    'packet': bytearray(),
+                    'deadline': time.monotonic() + HANDSHAKE_TIMEOUT})
+                continue
+            connection, pending = key.fileobj, key.data
+            try:
+                data = connection.recv(MAXPACKET)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            pending['packet'] += data
+            if data and b'\r\n\r\n' not in pending['packet'] and (
+                    len(pending['packet']) < MAXPACKET):
+                continue
+            selector.unregister(connection)
+            handshake(connection, bytes(pending['packet']))
+        now = time.monotonic()
+        for key in list(selector.get_map().values()):
+            if key.data is not None and key.data['deadline'] < now:
+                logging.warning('handshake timed out: %s', key.fileobj)
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+
+def handshake(connection, packet):
+    '''
+    answer upgrade request, and launch demo on the websocket
+    '''
+    nonce = b''
+    # Parse request
+    for line in packet.split(b'\r\n'):
+        logging.debug('received line: %s', line)
+        if line.startswith(b'Sec-WebSocket-Key'):
+            nonce = line.split(b":")[1].strip()
+    if nonce:
+        connection.setblocking(True)
+        response = RESPONSE % create_key(nonce)
+        sent = connection.send(response)
+        logging.debug('sent response %r, %d bytes', response, sent)
+        launch_websocket(nonce.decode(), connection, demo)
+    else:
+        logging.warning('ignoring packet %s', packet)
+        connection.close()
 
 def create_key(nonce):
     '''
@@ -200,7 +240,7 @@ def create_key(nonce):
     logging.debug('found nonce: %s', nonce)
     return b64encode(sha1(nonce + MAGIC).digest())
 
-def launch_websocket(nonce, connection, websocket_handler):
+def launch_websocket(nonce, connection, websocket_handler, *args):
     '''
     launch thread to handle websocket
 
@@ -209,10 +249,12 @@ def launch_websocket(nonce, connection, websocket_handler):
     connection (rfile of the socket) to disappear shortly after the first
     `send`, when called with a dup'd connection UNLESS the original socket
     is closed. I don't understand why, just found out experimentally.
+
+    any `args` are passed to the handler after the connection.
     '''
     socketcopy = connection.dup()
     connection.close()
-    thread = Thread(target=websocket_handler, args=(socketcopy,),
+    thread = Thread(target=websocket_handler, args=(socketcopy, *args),
                     name=nonce, daemon=True)
     thread.start()
 
@@ -223,8 +265,7 @@ def demo(connection):
     # pylint: disable=too-many-locals, too-many-branches, too-many-statements
     logging.debug('thread starting handle(%s)', connection)
     counter = retries = 0
-    opcode = None
-    previous = packet = b''
+    decoder = FrameDecoder()
     closed = False
     ping(connection)  # send a ping to break the ice
     while True: # send messages and show responses from the client
@@ -244,77 +285,18 @@ def demo(connection):
                 raise send_failed
         try:
             if PINGS['received']:
-                connection.send(package(PINGS['received'][-1]), 'pong')
+                connection.send(package(PINGS['received'][-1], 'pong'))
                 PINGS['received'][:] = []  # erase this and any prior pings
             logging.debug('awaiting packet on %s', connection)
-            # attempted fix for when we get a truncated packet with only
-            # the first two bytes, as happened in commit 17aed9a3
-            packet = packet or (previous + connection.recv(MAXPACKET))
-            logging.debug('packet: %s...', packet[:64])
-            offset = 0
-            if len(packet) >= 2:
-                if (packet[offset] & FIN) != FIN:
-                    logging.error('we only support unfragmented messages')
-                    raise NotImplementedError('fragments not supported')
-                if len(packet) == MAXPACKET:
-                    logging.error('large packets not supported')
-                    raise StopIteration('packet too large, cannot re-sync')
-                opcode = OPCODE[packet[offset] & 0xf]
-                logging.debug('opcode: %s', opcode)
-                if opcode not in SUPPORTED:
-                    logging.error('we only support opcodes %s', SUPPORTED)
-                    logging.error('offending opcode: %d', opcode)
-                    raise NotImplementedError('opcode not supported')
-                masked = bool(packet[offset + 1] & MASKED)
-                if not masked:
-                    logging.error('unmasked client data violates standard')
-                    raise NotImplementedError('unmasked data not supported')
-                payload_size = packet[offset + 1] & PAYLOAD_SIZE
-                offset += 2  # move to masking key (for short payload anyway)
-                if payload_size == 126:
-                    payload_size = int.from_bytes(
-                        packet[offset + 2:offset + 4], 'big'
-                    )
-                    offset += 2
-                elif payload_size == 127:
-                    payload_size = int.from_bytes(
-                        packet[offset + 2: offset + 6], 'big'
-                    )
-                    offset += 4
-                masking_key = packet[offset:offset + 4]
-                logging.debug('masking key: %s', masking_key)
-                offset += 4  # skip past masking key to payload
-                payload = bytearray(packet[offset:])
-                if len(payload) > payload_size:
-                    logging.error('payload unexpected size: %s', payload)
-                    logging.info('assuming we got more than one packet')
-                    # split off additional packet[s]
-                    packet = bytes(payload[payload_size:])
-                    payload = payload[:payload_size]
-                    previous = b''
-                elif len(payload) < payload_size:
-                    logging.error('received truncated packet %s', packet)
-                    previous = packet
-                    packet = b''
-                else:
-                    previous = packet = b''
-                for i in range(payload_size):
-                    payload[i] = payload[i] ^ masking_key[i % 4]
+            if not decoder.recv_into(connection):
+                raise StopIteration('remote end closed unexpectedly')
+            for opcode, payload in decoder:
                 logging.info('payload: %s', payload)
                 if opcode == 'close':
-                    code, reason = (
-                        int.from_bytes(payload[:2], 'big'),
-                        payload[2:]
-                    )
-                    logging.warning('client closed connection: %d, %s',
-                                    code, reason)
-                    raise StopIteration('remote end initiated closure')
+                    raise closed_remotely(payload)
                 if opcode == 'ping':
-                    if len(payload) <= 125:
-                        PINGS['received'].append(payload)
-                        PINGS['received'][0:-2] = []  # only keep last 2
-                    else:
-                        logging.error('ping payload must not exceed 125 bytes')
+                    PINGS['received'].append(payload)
+                    PINGS['received'][0:-2] = []  # only keep last 2
                 elif opcode == 'pong':
                     if PINGS['sent']:
                         if payload != PINGS['sent'][-1]:
@@ -333,13 +315,10 @@ def demo(connection):
                             b"server closed on client's request",
                         'close')
                     )
-            elif not packet:
-                raise StopIteration('remote end closed unexpectedly')
-            else:
-                raise ValueError('insufficient packet length: %d' % len(packet))
         except (NotImplementedError, ValueError, IndexError) as error:
             logging.error('error in processing message: %s', error)
-        except (StopIteration, ConnectionResetError, BrokenPipeError) as ended:
+        except (StopIteration, ConnectionResetError, BrokenPipeError,
+                BufferError) as ended:
             logging.info('remote end closed: %s', ended)
             try:  # ignore failure on shutdown
                 connection.shutdown(socket.SHUT_WR)
@@ -348,9 +327,8 @@ def demo(connection):
                 threads = threading_enumerate()
                 logging.debug('threads remaining: %s', threads)
                 sys.exit(0)
-        # simulate having to wait for data, if packet not already queued
-        if not packet:
-            time.sleep(1)
+        # simulate having to wait for data
+        time.sleep(1)
 
 def package(payload, opcode='text'):
     r'''
@@ -363,172 +341,392 @@ def package(payload, opcode='text'):
     >>> package(bytes(100000))[:12]
     b'\x81\x7f\x00\x00\x00\x00\x00\x01\x86\xa0\x00\x00'
     '''
-    length = len(payload)
-    if length <= 125:
-        packed = bytes((FIN | OPCODE[opcode], length)) + payload
-        logging.debug('package being sent: %s', packed)
-    elif length <= 65535:  # 16 bits
-        packed = (
-            bytes((FIN | OPCODE[opcode], 126)) + length.to_bytes(2, 'big') +
-            payload
-        )
-        logging.debug('package being sent: %s...', packed[:128])
-    elif length < MAXPACKET - 10:  # 10 bytes for header
-        packed = (
-            bytes((FIN | OPCODE[opcode], 127)) + length.to_bytes(8, 'big') +
-            payload
-        )
-        logging.debug('package being sent: %s...', packed[:128])
-    else:
-        raise BufferError('Package length of %d not permitted' % length)
+    packed = frame_header(len(payload), opcode) + payload
+    if logging.root.isEnabledFor(logging.DEBUG):
+        if len(payload) <= 125:
+            logging.debug('package being sent: %s', packed)
+        else:
+            logging.debug('package being sent: %s...', packed[:128])
     return packed
 
-def handler(connection):
+def frame_header(length, opcode='text', compressed=False):
+    r'''
+    header for unmasked frame with payload of given length
+
+    for sending header and payload without first joining them
+
+    >>> frame_header(1000, 'binary')
+    b'\x82~\x03\xe8'
+    >>> frame_header(10, compressed=True)
+    b'\xc1\n'
     '''
-    handle two-way communications with websocket client
+    first = FIN | OPCODE[opcode] | (RSV1 if compressed else 0)
+    if length <= 125:
+        return bytes((first, length))
+    if length <= 65535:  # 16 bits
+        return bytes((first, 126)) + length.to_bytes(2, 'big')
+    if length < MAXPACKET - 10:  # 10 bytes for header
+        return bytes((first, 127)) + length.to_bytes(8, 'big')
+    raise BufferError('Package length of %d not permitted' % length)
+
+class Deflate:
+    r'''
+    permessage-deflate (RFC 7692) state of one connection, both ways
+
+    with context takeover, each message is compressed using those before
+    it, so every compressed frame must be sent, and in the order compressed
+
+    >>> deflate = Deflate.negotiate(
+    ...     'x-webkit-deflate-frame, permessage-deflate; client_max_window_bits')
+    >>> deflate.response
+    'permessage-deflate; server_max_window_bits=15; client_max_window_bits=15'
+    >>> frame = deflate.package(b'spam, ' * 100)
+    >>> frame[0] == FIN | RSV1 | OPCODE['text'], len(frame) < 30
+    (True, True)
+    >>> deflate.wanted(len(b'spam'), 'text')
+    False
+    >>> deflate.decompress(frame[2:]) == b'spam, ' * 100
+    True
+    >>> deflate.sent[0], deflate.sent[1] == deflate.received[0] < 30
+    (600, True)
+    >>> Deflate.negotiate('permessage-deflate; server_max_window_bits=8')
     '''
-    # pylint: disable=too-many-locals, too-many-branches, too-many-statements
-    logging.debug('thread starting handle(%s)', connection)
-    opcode = None
-    previous = packet = b''
-    serial = 0  # serial number for keyhits
-    # pylint: disable=too-many-nested-blocks
-    ping(connection)  # send a ping to break the ice
-    while True: # receive keyhits and dispatch them back out to all threads
-        try:
-            if PINGS['received']:
-                connection.send(package(PINGS['received'][-1]), 'pong')
-                PINGS['received'][:] = []  # erase this and any prior pings
-            logging.debug('awaiting packet on %s', connection)
-            # attempted fix for when we get a truncated packet with only
-            # the first two bytes, as happened in commit 17aed9a3
-            packet = packet or (previous + connection.recv(MAXPACKET))
-            logging.debug('packet: %s...', packet[:64])
-            offset = 0
-            serialized = None  # for joining key with serial number
-            if len(packet) >= 2:
-                if (packet[offset] & FIN) != FIN:
-                    logging.error('we only support unfragmented messages')
-                    raise NotImplementedError('fragments not supported')
-                if len(packet) == MAXPACKET:
-                    logging.error('large packets not supported')
-                    raise StopIteration('packet too large, cannot re-sync')
-                opcode = OPCODE[packet[offset] & 0xf]
-                logging.debug('opcode: %s', opcode)
-                if opcode not in SUPPORTED:
-                    logging.error('we only support opcodes %s', SUPPORTED)
-                    logging.error('offending opcode: %d', opcode)
-                    raise NotImplementedError('opcode not supported')
-                masked = bool(packet[offset + 1] & MASKED)
-                if not masked:
-                    logging.error('unmasked client data violates standard')
-                    raise NotImplementedError('unmasked data not supported')
-                payload_size = packet[offset + 1] & PAYLOAD_SIZE
-                offset += 2  # move to masking key (for short payload anyway)
-                if payload_size == 126:
-                    payload_size = int.from_bytes(
-                        packet[offset + 2:offset + 4], 'big'
-                    )
-                    offset += 2
-                elif payload_size == 127:
-                    payload_size = int.from_bytes(
-                        packet[offset + 2: offset + 6], 'big'
-                    )
-                    offset += 4
-                masking_key = packet[offset:offset + 4]
-                logging.debug('masking key: %s', masking_key)
-                offset += 4  # skip past masking key to payload
-                payload = bytearray(packet[offset:])
-                if len(payload) > payload_size:
-                    logging.error('payload unexpected size: %s', payload)
-                    logging.info('assuming we got more than one packet')
-                    # split off additional packet[s]
-                    packet = bytes(payload[payload_size:])
-                    payload = payload[:payload_size]
-                    previous = b''
-                elif len(payload) < payload_size:
-                    logging.error('received truncated packet %s', packet)
-                    previous = packet
-                    packet = b''
-                else:
-                    previous = packet = b''
-                for i in range(payload_size):
-                    payload[i] = payload[i] ^ masking_key[i % 4]
-                logging.info('payload: %s', payload)
-                if opcode == 'close':
-                    code, reason = (
-                        int.from_bytes(payload[:2], 'big'),
-                        payload[2:]
-                    )
-                    logging.warning('client closed connection: %d, %s',
-                                    code, reason)
-                    raise StopIteration('remote end initiated closure')
-                if opcode == 'ping':
-                    if len(payload) <= 125:
-                        PINGS['received'].append(payload)
-                        PINGS['received'][0:-2] = []  # only keep last 2
-                    else:
-                        logging.error('ping payload must not exceed 125 bytes')
-                elif opcode == 'pong':
-                    if PINGS['sent']:
-                        if payload != PINGS['sent'][-1]:
-                            logging.error(
-                                'pong payload %s does not match our ping %s',
-                                payload, PINGS['sent'][-1]
-                            )
-                        else:
-                            logging.info('received pong for ping %s', payload)
-                    else:
-                        logging.warning('pong %s unsolicited', payload)
-                    PINGS['sent'][:] = []  # erase any sent pings
-                elif payload == b'stop':
-                    connection.send(package(
-                        CLOSE.to_bytes(2, 'big') +
-                            b"server closed on client's request",
-                        'close')
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, parameters=None, bits=DEFLATE_WINDOW_BITS,
+                 threshold=DEFLATE_THRESHOLD):
+        parameters = parameters or {}
+        unknown = set(parameters).difference(DEFLATE_PARAMETERS)
+        if unknown:
+            raise ValueError('unknown parameters %s' % sorted(unknown))
+        self.server_bits = min(
+            bits, int(parameters.get('server_max_window_bits') or 15))
+        self.client_bits = 15
+        if 'client_max_window_bits' in parameters:
+            self.client_bits = min(
+                bits, int(parameters['client_max_window_bits'] or 15))
+        if not 9 <= min(self.server_bits, self.client_bits) <= 15:
+            # zlib can't compress raw deflate with the 8-bit minimum
+            raise ValueError('window bits must be between 9 and 15')
+        self.server_takeover = 'server_no_context_takeover' not in parameters
+        self.client_takeover = 'client_no_context_takeover' not in parameters
+        self.threshold = threshold
+        self.response = '; '.join(['permessage-deflate'] + [
+            'server_no_context_takeover'
+        ] * (not self.server_takeover) + [
+            'client_no_context_takeover'
+        ] * (not self.client_takeover) + [
+            'server_max_window_bits=%d' % self.server_bits
+        ] + [
+            'client_max_window_bits=%d' % self.client_bits
+        ] * ('client_max_window_bits' in parameters))
+        self.compressor = self.decompressor = None  # made when first needed
+        self.sent = [0, 0]  # bytes before and after compression
+        self.received = [0, 0]  # bytes before and after decompression
+
+    def __repr__(self):
+        return '<Deflate sent %d bytes as %d, received %d bytes as %d>' % (
+            *self.sent, *self.received)
+
+    @classmethod
+    def negotiate(cls, offers, bits=DEFLATE_WINDOW_BITS,
+                  threshold=DEFLATE_THRESHOLD):
+        '''
+        Deflate for the first acceptable offer in a Sec-WebSocket-Extensions
+        request header, or None if there is none (or compression is off)
+        '''
+        if not offers or not bits:
+            return None
+        for offer in offers.split(','):
+            name, *parameters = [item.strip() for item in offer.split(';')]
+            if name != 'permessage-deflate':
+                continue
+            try:
+                return cls({
+                    key.strip(): value.strip().strip('"')
+                    for key, _, value in (
+                        parameter.partition('=') for parameter in parameters
                     )
-                else:
-                    try:
-                        message = json.loads(payload)
-                    except json.JSONDecodeError:
-                        logging.warning('could not decode %r', payload)
-                        continue
-                    # serial numbers must be nonzero, so increment first.
-                    # same key/serial number gets sent to all clients.
-                    serial += 1
-                    echo = message.pop('echo')
-                    message.update({'serial': serial})
-                    serialized = pack(message)
-                    for client in list(CLIENTS):
-                        if client is connection and not echo:
-                            logging.debug('not echoing %s back to sender %s',
-                                          message['key'], client)
-                        else:
-                            try:
-                                logging.debug("sending key %r to %s",
-                                              message['key'], client)
-                                client.send(package(serialized))
-                            except OSError as broken:
-                                logging.warning(
-                                    'removing client %s after failed send: %s',
-                                    client, broken
-                                )
-                                CLIENTS.remove(client)
-            elif not packet:
-                raise StopIteration('remote end closed unexpectedly')
-            else:
-                raise ValueError('insufficient packet length: %d' % len(packet))
-        except (NotImplementedError, ValueError, IndexError) as error:
-            logging.error('error in processing message: %s', error)
-        except (StopIteration, ConnectionResetError, BrokenPipeError) as ended:
-            logging.info('remote end closed: %s', ended)
-            try:  # ignore failure on shutdown
-                connection.shutdown(socket.SHUT_WR)
-                connection.close()
-            finally:
-                threads = threading_enumerate()
-                logging.debug('threads remaining: %s', threads)
-                sys.exit(0)
+                }, bits, threshold)
+            except ValueError as problem:
+                logging.info('declining %r: %s', offer.strip(), problem)
+        return None
+
+    def wanted(self, length, opcode):
+        '''
+        whether a message is big enough to be worth compressing
+        '''
+        return opcode in ('text', 'binary') and length >= self.threshold
+
+    def compress(self, *pieces):
+        '''
+        compress message, given in pieces, for sending
+        '''
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(
+                DEFLATE_LEVEL, zlib.DEFLATED, -self.server_bits)
+        compressed = b''.join(
+            [self.compressor.compress(piece) for piece in pieces] +
+            [self.compressor.flush(zlib.Z_SYNC_FLUSH)])
+        if not self.server_takeover:
+            self.compressor = None
+        if compressed.endswith(DEFLATE_TAIL):
+            compressed = compressed[:-len(DEFLATE_TAIL)]
+        self.sent[0] += sum(len(piece) for piece in pieces)
+        self.sent[1] += len(compressed)
+        return compressed
+
+    def package(self, *pieces, opcode='text'):
+        '''
+        compressed frame for message given in pieces
+        '''
+        compressed = self.compress(*pieces)
+        return frame_header(len(compressed), opcode, True) + compressed
+
+    def decompress(self, payload, limit=MAXPACKET):
+        '''
+        decompress message received with RSV1 set
+
+        raises BufferError if the message can't be decompressed, or would be
+        `limit` bytes or more, since the connection can't continue after that
+        '''
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-self.client_bits)
+        try:
+            message = self.decompressor.decompress(
+                bytes(payload) + DEFLATE_TAIL, limit)
+        except zlib.error as error:
+            raise BufferError('cannot decompress: %s' % error) from error
+        if self.decompressor.unconsumed_tail:
+            raise BufferError('compressed message too large')
+        if not self.client_takeover:
+            self.decompressor = None
+        self.received[0] += len(payload)
+        self.received[1] += len(message)
+        return message
+
+class FrameDecoder:
+    r'''
+    incremental decoder for (masked) frames from a websocket client
+
+    data is received directly into a reusable buffer, which is only grown
+    when a single frame won't fit; iterating over the decoder yields each
+    complete message as (opcode, payload), with fragments reassembled, and
+    decompressed if permessage-deflate was negotiated.
+
+    >>> decoder = FrameDecoder(16)
+    >>> decoder.feed(b'\x01\x82abcd\t\x0b\x89\x80abcd')
+    >>> list(decoder)
+    [('ping', bytearray(b''))]
+    >>> decoder.feed(b'\x80\x82abcd\t\x0b\x81\xfe\x00\x14abcd')
+    >>> list(decoder)
+    [('text', bytearray(b'hihi'))]
+    >>> decoder.feed(b'\x00' * 20)
+    >>> list(decoder)
+    [('text', bytearray(b'abcdabcdabcdabcdabcd'))]
+    >>> len(decoder.buffer)
+    16
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, size=BUFFERSIZE, limit=MAXPACKET):
+        self.size = size  # normal buffer size, grown only for large frames
+        self.limit = limit  # largest frame or message we will accept
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = self.end = 0  # unparsed data is buffer[start:end]
+        self.wanted = 0  # size of incomplete frame at start of buffer
+        self.opcode = self.message = None  # fragmented message in progress
+        self.compressed = False  # whether that message has RSV1 set
+        self.deflate = None  # Deflate, if negotiated
+
+    def recv_into(self, connection):
+        '''
+        receive from connection into free space at end of buffer
+
+        returns number of bytes received, 0 meaning remote end closed
+        '''
+        if self.end == len(self.buffer) or (
+                self.start + self.wanted > len(self.buffer)):
+            self.compact()
+        count = connection.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+    def feed(self, data):
+        '''
+        add data already received by other means
+        '''
+        if self.end + len(data) > len(self.buffer):
+            self.wanted = max(self.wanted, self.end - self.start + len(data))
+            self.compact()
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def unparsed(self):
+        r'''
+        data received but not yet decoded, a partial frame at most, for
+        another decoder to carry on from
+
+        raises BufferError if part of a fragmented message has been decoded
+
+        >>> decoder = FrameDecoder()
+        >>> decoder.feed(b'\x81\x82abcd\t')
+        >>> list(decoder), decoder.unparsed()
+        ([], b'\x81\x82abcd\t')
+        '''
+        if self.message is not None:
+            raise BufferError('fragmented message in progress')
+        return bytes(self.view[self.start:self.end])
+
+    def compact(self):
+        '''
+        move partial frame to start of buffer, reallocating only if needed
+        '''
+        pending = self.end - self.start
+        size = max(self.size, self.wanted, pending)
+        if size != len(self.buffer):
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer, self.view = buffer, memoryview(buffer)
+        elif self.start:  # source and destination overlap, so copy first
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+        self.start, self.end = 0, pending
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            first, masked, key, data = self.frame()
+            fin, opcode = bool(first & FIN), OPCODE[first & 0xf]
+            if not self.valid(first, opcode, masked, len(data)):
+                continue
+            message = self.assemble(fin, opcode, bool(first & RSV1),
+                                    unmask(data, key))
+            if message is not None:
+                return message
+
+    def frame(self):
+        '''
+        take the next complete frame from the buffer, as (first byte,
+        whether masked, masking key, payload), the last two being views of
+        the buffer as it was
+
+        raises StopIteration if there is no complete frame yet
+        '''
+        view, start = self.view, self.start
+        available = self.end - start
+        if available < 2:
+            raise StopIteration
+        first, second = view[start], view[start + 1]
+        size, offset = second & PAYLOAD_SIZE, 2
+        if size == 126:
+            size, offset = int.from_bytes(view[start + 2:start + 4], 'big'), 4
+        elif size == 127:
+            size, offset = int.from_bytes(
+                view[start + 2:start + 10], 'big'), 10
+        masked = bool(second & MASKED)
+        total = offset + 4 * masked + size
+        if available < offset or available < total:
+            self.wanted = total if available >= offset else 0
+            if self.wanted > self.limit:
+                raise BufferError('frame of %d bytes too large' % total)
+            raise StopIteration
+        self.start += total
+        self.wanted = 0
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size:  # done with large frame
+                self.compact()
+        return (first, masked, view[start + offset:start + offset + 4],
+                view[start + offset + 4:start + total])
+
+    def valid(self, first, opcode, masked, size):
+        '''
+        whether a frame is one we can act on, logging why not if it isn't
+        '''
+        if opcode not in SUPPORTED:
+            logging.error('skipping frame with opcode %r', opcode)
+            return False
+        if size > MAX_CONTROL and opcode in ('close', 'ping', 'pong'):
+            logging.error('%s payload must not exceed %d bytes',
+                          opcode, MAX_CONTROL)
+            return False
+        if first & (RSV2 | RSV3) or first & RSV1 and (
+                self.deflate is None or opcode not in ('text', 'binary')):
+            logging.error('skipping %s frame with reserved bits %#x set',
+                          opcode, first & (RSV1 | RSV2 | RSV3))
+            return False
+        if not masked:
+            logging.error('unmasked client data violates standard')
+            return False
+        return True
+
+    def assemble(self, fin, opcode, compressed, payload):
+        '''
+        (opcode, payload) of the message a frame completes, decompressed
+        if need be; None if it doesn't complete one
+        '''
+        if opcode == 'continuation':
+            if self.message is None:
+                logging.error('continuation frame without a message')
+                return None
+            self.message += payload
+            if len(self.message) > self.limit:
+                self.opcode = self.message = None
+                raise BufferError('fragmented message too large')
+            if not fin:
+                return None
+            opcode, payload = self.opcode, self.message
+            compressed = self.compressed
+            self.opcode = self.message = None
+        elif not fin:
+            if opcode not in ('text', 'binary'):
+                logging.error('control frames must not be fragmented')
+                return None
+            if self.message is not None:
+                logging.error('discarding unfinished %s message',
+                              self.opcode)
+            self.opcode, self.message = opcode, payload
+            self.compressed = compressed
+            return None
+        if compressed:
+            payload = self.deflate.decompress(payload, self.limit)
+        return opcode, payload
+
+def closed_remotely(payload):
+    '''
+    log the code and reason of a close frame, returning the StopIteration
+    that ends the connection
+
+    >>> closed_remotely(CLOSE.to_bytes(2, 'big') + b'done')
+    StopIteration('remote end initiated closure')
+    '''
+    code, reason = int.from_bytes(payload[:2], 'big'), payload[2:]
+    logging.warning('client closed connection: %d, %s', code, reason)
+    return StopIteration('remote end initiated closure')
+
+def unmask(payload, masking_key):
+    r'''
+    XOR the whole payload at once with the repeated 4-byte masking key
+
+    uses numpy if available, otherwise one big integer XOR, both of which
+    are many times faster than a Python loop over each byte
+
+    >>> unmask(b'\t\x07\x0f\x08\x0eNC', b'abcd')
+    bytearray(b'hello, ')
+    >>> unmask(b'', b'abcd')
+    bytearray(b'')
+    '''
+    length = len(payload)
+    if numpy is not None and length > NUMPY_THRESHOLD:
+        key = numpy.frombuffer(masking_key, numpy.uint8)
+        unmasked = numpy.frombuffer(payload, numpy.uint8) ^ numpy.resize(
+            key, length)
+        return bytearray(unmasked.tobytes())
+    key = (bytes(masking_key) * ((length >> 2) + 1))[:length]
+    return bytearray((
+        int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')
+    ).to_bytes(length, 'little'))
 
 def background():
     '''